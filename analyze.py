@@ -0,0 +1,226 @@
+"""
+Sizes up a migration without converting anything: how big each flow is, how
+its threads are spread, how many messages will be split for being too long,
+which senders have no Slack user and roughly how big the export will be.
+
+Every flow in input/exports/*/messages.json and every API flow that is
+cached (or staged) is read once with the streaming parser, several flows at
+a time. The users are matched the same way as for the conversion.
+
+The output size is an estimate: each Slack message costs the JSON of an
+empty message with the sender's profile, plus its text, plus a reply entry
+in its thread parent. Text lengths are taken before mentions are rewritten.
+
+Usage: python cli.py analyze --jobs 4
+The report is printed and saved as output/analysis.json.
+"""
+import argparse
+import glob
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import convert
+from json_stream import iter_json_array
+from metrics import Progress
+from slack_export import dump_json_file
+from slack_message import SlackMessage
+from text_transform import message_text
+
+# Upper bounds of the thread size buckets, in messages including the parent
+thread_buckets = (1, 2, 5, 10, 50, 100, 1000, 10000)
+reply_bytes = len('{"user":"U0000000000","ts":"1600000000.000000"},')
+# What a thread parent gets on its first reply, besides the reply entries
+thread_bytes = len(',"replies":[],"reply_users":["U0000000000"],"reply_users_count":1,"reply_count":2,'
+                   '"latest_reply":"1600000000.000000","last_read":"1600000000.000000","subscribed":false'
+                   ',"thread_ts":"1600000000.000000"')
+day = 24 * 60 * 60 * 1000 # in 'sent' units
+
+def find_flows():
+    """
+    (source, flow_param) of every flow we have messages for
+    """
+    flows = [('export', os.path.basename(os.path.dirname(path)))
+             for path in sorted(glob.glob(convert.import_dir + '/*/messages.json'))]
+    if convert.staging:
+        flows += [('api', flow_param) for flow_param in convert.staging.staged_flows()]
+    elif os.path.isdir(convert.cache_dir):
+        cached = set()
+        for file in os.listdir(convert.cache_dir):
+            match = re.fullmatch(r'flow-(.+)\.(cache|json)', file)
+            if match:
+                cached.add(match.group(1))
+        flows += [('api', flow_param) for flow_param in sorted(cached)]
+    return flows
+
+def load_flow_messages(source, flow_param):
+    if source == 'export':
+        return iter_json_array('%s/%s/messages.json' % (convert.import_dir, flow_param))
+    if convert.staging:
+        return convert.staging.iter_messages(flow_param)
+    return convert.api_cache.get('flow-%s' % flow_param, ttl=convert.cache_ttl) or []
+
+def message_bytes(user_id, profile):
+    # The JSON of a message without text, reactions or thread fields
+    message = SlackMessage('', user_id, '00000000-0000-0000-0000-000000000000', profile, None, '1600000000.000000')
+    return len(json.dumps(message.to_slack()))
+
+def reactions_bytes(reactions):
+    return sum(len(',{"name":"","users":[],"count":1}') + len(emoji) + 14 * len(users)
+               for emoji, users in reactions.items())
+
+def analyze_flow(source, flow_param, matched_uids, user_bytes, default_bytes, backlink_bytes):
+    """
+    The numbers of one flow. matched_uids are the Flowdock uids with a Slack
+    user and user_bytes the size of an empty message of each of them.
+    backlink_bytes is the size of the message linking to a Flowdock thread.
+    """
+    max_length = convert.slack_message_max_length
+    stats = {
+        'source': source,
+        'flow': flow_param,
+        'messages': 0,
+        'skipped': 0,
+        'long_messages': 0,
+        'extra_parts': 0,
+        'text_bytes': 0,
+        'estimated_bytes': 0
+    }
+    events = {}
+    days = set() # for the number of day files
+    thread_sizes = {}
+    unmatched = {}
+
+    for fm in load_flow_messages(source, flow_param):
+        stats['messages'] += 1
+        events[fm['event']] = events.get(fm['event'], 0) + 1
+        if fm['event'] == 'file':
+            text_length = len(fm['content']['file_name']) + 120
+        else:
+            text = message_text(fm)
+            if text is None:
+                stats['skipped'] += 1
+                continue
+            # &, < and > are escaped
+            text_length = len(text) + 4 * (text.count('&') + text.count('<') + text.count('>'))
+
+        uid = fm['user']
+        if uid not in matched_uids:
+            unmatched[uid] = unmatched.get(uid, 0) + 1
+        parts = 1
+        if text_length > max_length:
+            # About how split_text cuts them
+            stats['long_messages'] += 1
+            parts = -(-text_length // (max_length - 8))
+            stats['extra_parts'] += parts - 1
+        stats['text_bytes'] += text_length
+        message_size = user_bytes.get(uid, default_bytes)
+        if fm['emojiReactions']:
+            message_size += reactions_bytes(fm['emojiReactions'])
+        stats['estimated_bytes'] += parts * message_size + text_length
+
+        thread_id = fm.get('thread_id')
+        if thread_id:
+            size = thread_sizes.get(thread_id, 0)
+            thread_sizes[thread_id] = size + 1
+            if size == 1:
+                stats['estimated_bytes'] += thread_bytes + backlink_bytes
+            if size:
+                stats['estimated_bytes'] += (reply_bytes + len(',"thread_ts":"","parent_user_id":"U0000000000"') + 17) * parts
+
+        days.add(fm['sent'] // day)
+
+    histogram = dict.fromkeys(['<=%d' % bucket for bucket in thread_buckets] + ['>%d' % thread_buckets[-1]], 0)
+    for size in thread_sizes.values():
+        for bucket in thread_buckets:
+            if size <= bucket:
+                histogram['<=%d' % bucket] += 1
+                break
+        else:
+            histogram['>%d' % thread_buckets[-1]] += 1
+
+    stats.update({
+        'events': events,
+        'threads': len(thread_sizes),
+        'replies': sum(thread_sizes.values()) - len(thread_sizes),
+        'largest_thread': max(thread_sizes.values(), default=0),
+        'thread_sizes': histogram,
+        'days': len(days),
+        'unmatched_users': unmatched
+    })
+    return stats
+
+def analyze(jobs=1):
+    flowdock_users = convert.get_flowdock_users()
+    slack_users = convert.get_slack_users()
+    fd_uid_to_slack_user_map = convert.build_fd_uid_to_slack_user_map(flowdock_users, slack_users)
+    fd_users_index = convert.build_fd_users_index(flowdock_users, slack_users)
+
+    matched_uids = set(fd_uid_to_slack_user_map)
+    user_bytes = {uid: message_bytes(slack_user['id'], convert.build_user_profile(slack_user))
+                  for uid, slack_user in fd_uid_to_slack_user_map.items()}
+    default_bytes = max(user_bytes.values(), default=500)
+    backlink_bytes = message_bytes(convert.import_bot_slack_id, convert.flowdock_bot_profile) + 200
+
+    flows = find_flows()
+    progress = Progress('analyze', len(flows), unit='flows')
+    with ProcessPoolExecutor(max_workers=jobs, initializer=convert.configure, initargs=(convert.config,)) as executor:
+        futures = [executor.submit(analyze_flow, source, flow_param, matched_uids, user_bytes, default_bytes,
+                                   backlink_bytes)
+                   for source, flow_param in flows]
+        results = []
+        for future in futures:
+            results.append(future.result())
+            progress.update(len(results))
+    progress.finish()
+
+    unmatched = {}
+    for result in results:
+        for uid, count in result['unmatched_users'].items():
+            unmatched[uid] = unmatched.get(uid, 0) + count
+    return {
+        'flows': results,
+        'totals': {
+            'flows': len(results),
+            'messages': sum(result['messages'] for result in results),
+            'threads': sum(result['threads'] for result in results),
+            'long_messages': sum(result['long_messages'] for result in results),
+            'estimated_bytes': sum(result['estimated_bytes'] for result in results)
+        },
+        'unmatched_users': [{
+            'uid': uid,
+            'messages': count,
+            'email': fd_users_index.get(uid, {}).get('email'),
+            'name': fd_users_index.get(uid, {}).get('name')
+        } for uid, count in sorted(unmatched.items(), key=lambda item: -item[1])]
+    }
+
+def print_report(report):
+    print('%-30s %10s %8s %8s %8s %6s %10s' % ('flow', 'messages', 'threads', 'largest', 'long', 'days', 'est. MB'))
+    for flow in sorted(report['flows'], key=lambda flow: -flow['estimated_bytes']):
+        print('%-30s %10d %8d %8d %8d %6d %10.1f' % (
+            '%s (%s)' % (flow['flow'], flow['source']), flow['messages'], flow['threads'], flow['largest_thread'],
+            flow['long_messages'], flow['days'], flow['estimated_bytes'] / 1e6))
+    totals = report['totals']
+    print('%-30s %10d %8d %8s %8d %6s %10.1f' % ('total', totals['messages'], totals['threads'], '',
+                                                totals['long_messages'], '', totals['estimated_bytes'] / 1e6))
+    if report['unmatched_users']:
+        print('%d senders without a Slack user, their messages go to the import bot:' % len(report['unmatched_users']))
+        for user in report['unmatched_users'][:20]:
+            print('  %(uid)s %(email)s: %(messages)d messages' % user)
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description='Size up the flows to migrate without converting them')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count(),
+                        help='flows to read in parallel (default: number of CPUs)')
+    parser.add_argument('--output', default=convert.output_path + '/analysis.json')
+    args = parser.parse_args(argv)
+
+    convert.configure(convert.load_configuration())
+    report = analyze(args.jobs)
+    print_report(report)
+    dump_json_file(report, args.output, indent=4)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+"""
+Flowdock file attachments, downloaded into a content-addressed store.
+
+Every file is stored once under the sha256 of its content, as
+<root>/objects/ab/abcdef..., however many times and in however many flows it
+was posted. <root>/index.sqlite maps the Flowdock path of each attachment to
+its sha256, size and content type, so a path is only downloaded once.
+
+ - downloads run several at a time over one pooled connection, with
+   retries and backoff when Flowdock has a problem
+ - with_attachments downloads the files of a flow while it is converted,
+   so the messages are only read once
+ - an interrupted download is kept in <root>/partial/ and continued with a
+   Range request next time
+ - the content is hashed while it arrives and compared to the
+   Content-Length, a file only gets into the store complete and under its
+   real hash. verify() checks the whole store again.
+
+base_url can point to a local stub server for testing.
+
+Usage: python attachments.py --verify attachments
+"""
+import argparse
+import asyncio
+import collections
+import fcntl
+import hashlib
+import os
+import sqlite3
+import threading
+
+import aiohttp
+
+from metrics import Progress
+
+max_retries = 5
+read_size = 1 << 20
+
+schema = '''
+CREATE TABLE IF NOT EXISTS attachments (
+    path TEXT PRIMARY KEY, sha256 TEXT, size INTEGER, content_type TEXT
+);
+CREATE INDEX IF NOT EXISTS attachments_sha256 ON attachments (sha256);
+'''
+
+class IncompleteDownload(Exception):
+    pass
+
+def file_paths(flowdock_messages):
+    """
+    The Flowdock paths of the files posted in flowdock_messages
+    """
+    for fm in flowdock_messages:
+        if fm['event'] == 'file' and fm['content'].get('path'):
+            yield fm['content']['path']
+
+class AttachmentStore:
+    def __init__(self, root):
+        self.root = root
+        self.local = threading.local()
+
+    def connection(self):
+        # Worker processes and threads get their own connection, sqlite ones
+        # can't be shared
+        local = self.local
+        if getattr(local, 'db', None) is None or local.pid != os.getpid():
+            os.makedirs(self.root, exist_ok=True)
+            local.db = sqlite3.connect('%s/index.sqlite' % self.root, timeout=60)
+            local.db.execute('PRAGMA journal_mode = WAL')
+            local.db.executescript(schema)
+            local.pid = os.getpid()
+        return local.db
+
+    def object_path(self, sha256):
+        return '%s/objects/%s/%s' % (self.root, sha256[:2], sha256)
+
+    def partial_path(self, path):
+        return '%s/partial/%s' % (self.root, hashlib.sha1(path.encode()).hexdigest())
+
+    def get(self, path):
+        """
+        (sha256, size, content_type) of the attachment at path, None if it
+        isn't stored
+        """
+        return self.connection().execute('SELECT sha256, size, content_type FROM attachments WHERE path = ?',
+                                         (path,)).fetchone()
+
+    def missing(self, paths):
+        db = self.connection()
+        return [path for path in dict.fromkeys(paths)
+                if db.execute('SELECT 1 FROM attachments WHERE path = ?', (path,)).fetchone() is None]
+
+    def add(self, path, partial_path, sha256, size, content_type):
+        """
+        Move a complete download into the store, unless the same content is
+        there already
+        """
+        object_path = self.object_path(sha256)
+        if os.path.exists(object_path):
+            os.remove(partial_path)
+        else:
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            os.replace(partial_path, object_path)
+        db = self.connection()
+        with db:
+            db.execute('INSERT OR REPLACE INTO attachments VALUES (?, ?, ?, ?)', (path, sha256, size, content_type))
+
+    def verify(self):
+        """
+        Hash every stored file again. Corrupt or missing ones are removed
+        from the store, so the next download fetches them again. Returns the
+        number of bad files.
+        """
+        db = self.connection()
+        bad = 0
+        for (sha256,) in db.execute('SELECT DISTINCT sha256 FROM attachments').fetchall():
+            object_path = self.object_path(sha256)
+            if os.path.exists(object_path) and file_sha256(object_path) == sha256:
+                continue
+            bad += 1
+            if os.path.exists(object_path):
+                os.remove(object_path)
+            with db:
+                db.execute('DELETE FROM attachments WHERE sha256 = ?', (sha256,))
+        return bad
+
+def file_sha256(path, hasher=None):
+    hasher = hasher or hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(read_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+async def download_attachment(session, store, base_url, path):
+    """
+    Download one attachment into the store, continuing a partial download.
+    Flows converted at the same time can post the same file, a download
+    that another process has started is waited for instead. Returns False
+    when that one got the file.
+    """
+    partial_path = store.partial_path(path)
+    os.makedirs(os.path.dirname(partial_path), exist_ok=True)
+    with open(partial_path + '.lock', 'w') as lock:
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(0.1)
+        if store.get(path):
+            return False
+        await download_partial(session, store, base_url, path, partial_path)
+        return True
+
+async def download_partial(session, store, base_url, path, partial_path):
+    # The download itself, with the lock of its partial file held
+    delay = 1
+    for attempt in range(max_retries + 1):
+        # What we have so far is hashed once, the rest as it arrives
+        hasher = hashlib.sha256()
+        offset = 0
+        if os.path.exists(partial_path):
+            file_sha256(partial_path, hasher)
+            offset = os.path.getsize(partial_path)
+        headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+        try:
+            async with session.get(base_url + path, headers=headers) as r:
+                if r.status == 416 or (r.status == 200 and offset):
+                    # The server can't continue from here, start over
+                    os.remove(partial_path)
+                    if r.status == 416:
+                        continue
+                    hasher = hashlib.sha256()
+                    offset = 0
+                if r.status == 429 or r.status >= 500:
+                    if attempt == max_retries:
+                        r.raise_for_status()
+                    retry_after = r.headers.get('Retry-After')
+                    await asyncio.sleep(float(retry_after) if retry_after else delay)
+                    delay *= 2
+                    continue
+                r.raise_for_status()
+
+                size = offset + int(r.headers['Content-Length']) if 'Content-Length' in r.headers else None
+                with open(partial_path, 'ab') as f:
+                    async for chunk in r.content.iter_chunked(read_size):
+                        f.write(chunk)
+                        hasher.update(chunk)
+                    f.flush()
+                    os.fsync(f.fileno())
+                if size is not None and os.path.getsize(partial_path) != size:
+                    raise IncompleteDownload('Got %d of %d bytes of %s' % (os.path.getsize(partial_path), size, path))
+                store.add(path, partial_path, hasher.hexdigest(), os.path.getsize(partial_path),
+                          r.headers.get('Content-Type'))
+                return
+        except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError, IncompleteDownload):
+            # Keep what we got and continue from there
+            if attempt == max_retries:
+                raise
+            await asyncio.sleep(delay)
+            delay *= 2
+    raise IncompleteDownload('Could not download %s' % path)
+
+async def fetch_attachments(paths, store, base_url, token, concurrency=8):
+    """
+    Download the attachments at paths which aren't in the store yet.
+    Returns the counts of downloaded and failed attachments.
+    """
+    paths = store.missing(paths)
+    counts = {'downloaded': 0, 'failed': 0}
+    if not paths:
+        return counts
+    headers = {'Authorization': 'Basic %s' % token}
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    progress = Progress('attachments', len(paths), unit='files')
+
+    async def fetch_one(session, path):
+        async with semaphore:
+            try:
+                await download_attachment(session, store, base_url, path)
+                counts['downloaded'] += 1
+            except (aiohttp.ClientError, asyncio.TimeoutError, IncompleteDownload) as e:
+                print('Could not download %s, rerun to resume: %s' % (path, e))
+                counts['failed'] += 1
+            progress.update(progress.done + 1)
+
+    async with aiohttp.ClientSession(headers=headers, connector=connector) as session:
+        await asyncio.gather(*[fetch_one(session, path) for path in paths])
+    progress.finish()
+    return counts
+
+def download_attachments(paths, store, base_url, token, concurrency=8):
+    return asyncio.run(fetch_attachments(paths, store, base_url, token, concurrency))
+
+class AttachmentFetcher:
+    """
+    Download attachments in the background for other threads, on one event
+    loop in a thread of its own with one pooled session, like
+    flowdock_fetch.FlowFetcher. Each path is downloaded at most once.
+    """
+    def __init__(self, store, base_url, token, concurrency=8):
+        self.store = store
+        self.base_url = base_url
+        self.futures = {} # path -> the concurrent.futures.Future of its download
+        self.counts = {'downloaded': 0, 'failed': 0}
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='attachment-fetcher', daemon=True)
+        self.thread.start()
+        self.session, self.semaphore = self.run(self.open(token, concurrency))
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def open(self, token, concurrency):
+        session = aiohttp.ClientSession(headers={'Authorization': 'Basic %s' % token},
+                                        connector=aiohttp.TCPConnector(limit=concurrency))
+        return session, asyncio.Semaphore(concurrency)
+
+    async def fetch_one(self, path):
+        async with self.semaphore:
+            try:
+                if await download_attachment(self.session, self.store, self.base_url, path):
+                    self.counts['downloaded'] += 1
+            except (aiohttp.ClientError, asyncio.TimeoutError, IncompleteDownload) as e:
+                print('Could not download %s, rerun to resume: %s' % (path, e))
+                self.counts['failed'] += 1
+
+    def fetch(self, path):
+        """
+        Start downloading path unless it is stored or on its way already.
+        Returns the future of its download, None if there is nothing to wait
+        for. A download that fails is counted and leaves the path missing.
+        """
+        if path not in self.futures:
+            self.futures[path] = None if self.store.get(path) else \
+                asyncio.run_coroutine_threadsafe(self.fetch_one(path), self.loop)
+        return self.futures[path]
+
+    def close(self):
+        self.run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+def with_attachments(flowdock_messages, fetcher, window=1000):
+    """
+    Yields flowdock_messages, each file message once its attachment is in
+    the store or failed to download. The files are downloaded with fetcher
+    (an AttachmentFetcher) while the messages go by, up to window messages
+    ahead of the one yielded.
+    """
+    ahead = collections.deque()
+    for fm in flowdock_messages:
+        path = next(file_paths([fm]), None)
+        ahead.append((fm, fetcher.fetch(path) if path else None))
+        if len(ahead) > window:
+            fm, download = ahead.popleft()
+            if download:
+                download.result()
+            yield fm
+    for fm, download in ahead:
+        if download:
+            download.result()
+        yield fm
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the attachment store')
+    parser.add_argument('--verify', metavar='DIR', required=True,
+                        help='hash every file in the store at DIR, removing the bad ones')
+    args = parser.parse_args()
+    print('%d bad files removed' % AttachmentStore(args.verify).verify())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+"""
+Benchmarks for the converter on synthetic flows (see synthetic_flowdock.py).
+
+Scenarios:
+ - generate:  only generating the synthetic messages, to subtract from transform
+ - transform: iter_fd_messages_to_slack over a generated flow
+ - users:     build_fd_uid_to_slack_user_map with size / 100 users (at least 100)
+ - text:      the text rewriting of size messages, reported in MB/s
+ - main:      convert.main() end to end on a generated export
+
+Every scenario and size runs in its own process so the peak memory (max RSS)
+of one doesn't hide the next. Results are written as JSON so runs can be
+compared to find regressions.
+
+Usage: python benchmark.py --sizes 10000,1000000,10000000 --output bench.json
+"""
+import argparse
+import collections
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import yaml
+
+import synthetic_flowdock
+
+scenarios = ['generate', 'transform', 'users', 'text', 'main']
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+# config.yml of the workspace, the other scenarios configure convert with it directly
+benchmark_config = {
+    'flowdock_token': '', 'flowdock_org': 'benchmark', 'slack_api_token': '',
+    'slack_team': 'TBENCHMARK', 'import_bot_slack_id': 'UIMPORTBOT',
+    'exported_flows': ['synthetic'], 'api_flows': []
+}
+
+def users_for_size(size):
+    return max(100, size // 100)
+
+def prepare_workspace(workdir, size, users):
+    """
+    A directory with config.yml, cached users and an exported flow of size
+    messages, which convert.py can run in without network access.
+    """
+    os.makedirs(workdir, exist_ok=True)
+    done_marker = '%s/.prepared' % workdir
+    if os.path.exists(done_marker):
+        return
+
+    flowdock_users = synthetic_flowdock.generate_flowdock_users(users)
+    with open('%s/config.yml' % workdir, 'w') as f:
+        yaml.safe_dump(benchmark_config, f)
+
+    sys.path.insert(0, repo_dir)
+    from cache import Cache
+    from slack_users import SlackUserDirectory
+    cache = Cache('%s/cache' % workdir)
+    cache.set('flowdock-users', flowdock_users)
+    # Where convert.py looks for the Slack users, so it never calls the API
+    directory = SlackUserDirectory('%s/cache/slack-users.sqlite' % workdir)
+    directory.refresh([synthetic_flowdock.generate_slack_users(flowdock_users)])
+    directory.close()
+    cache.set('all-flows', [{'name': 'synthetic', 'parameterized_name': 'synthetic'}])
+
+    synthetic_flowdock.write_export('%s/input/exports/synthetic/messages.json' % workdir,
+                                    synthetic_flowdock.generate_messages(size, flowdock_users))
+    os.makedirs('%s/output' % workdir, exist_ok=True)
+    open(done_marker, 'w').close()
+
+def run_one(scenario, size, workdir, use_tracemalloc, main_args):
+    """
+    Runs a single scenario in this process and returns its result
+    """
+    users = users_for_size(size) if scenario == 'users' else 200
+    if scenario == 'main':
+        prepare_workspace(workdir, size, users)
+    os.makedirs(workdir, exist_ok=True)
+    sys.path.insert(0, repo_dir)
+    import convert
+    convert.set_work_dir(workdir)
+    if scenario != 'main':
+        convert.configure(benchmark_config)
+
+    flowdock_users = synthetic_flowdock.generate_flowdock_users(users)
+    slack_users = synthetic_flowdock.generate_slack_users(flowdock_users)
+
+    if use_tracemalloc:
+        tracemalloc.start()
+    start = time.perf_counter()
+    count = size
+
+    if scenario == 'generate':
+        collections.deque(synthetic_flowdock.generate_messages(size, flowdock_users), maxlen=0)
+    elif scenario == 'transform':
+        user_map = convert.build_fd_uid_to_slack_user_map(flowdock_users, slack_users)
+        users_index = convert.build_fd_users_index(flowdock_users, slack_users)
+        start = time.perf_counter()
+        messages = convert.iter_fd_messages_to_slack(
+            synthetic_flowdock.generate_messages(size, flowdock_users), 'synthetic', user_map, users_index)
+        collections.deque(messages, maxlen=0)
+    elif scenario == 'users':
+        count = users
+        convert.build_fd_uid_to_slack_user_map(flowdock_users, slack_users)
+    elif scenario == 'text':
+        user_map = convert.build_fd_uid_to_slack_user_map(flowdock_users, slack_users)
+        users_index = convert.build_fd_users_index(flowdock_users, slack_users)
+        text_transformer = convert.build_text_transformer(user_map, users_index)
+        texts = [convert.message_text(fm) for fm in synthetic_flowdock.generate_messages(size, flowdock_users)]
+        texts = [text for text in texts if text is not None]
+        text_bytes = sum(len(text) for text in texts)
+        start = time.perf_counter()
+        for text in texts:
+            text_transformer.transform(text)
+    elif scenario == 'main':
+        convert.main(main_args)
+
+    seconds = time.perf_counter() - start
+    result = {
+        'scenario': scenario,
+        'size': size,
+        'items': count,
+        'seconds': round(seconds, 3),
+        'items_per_second': round(count / seconds) if seconds else None,
+        # ru_maxrss is in KiB on Linux and bytes on macOS
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss /
+                             (1 << 20 if sys.platform == 'darwin' else 1 << 10), 1)
+    }
+    if scenario == 'text':
+        result['mb_per_second'] = round(text_bytes / seconds / (1 << 20), 1)
+    if use_tracemalloc:
+        result['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / (1 << 20), 1)
+    return result
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Flowdock to Slack converter')
+    parser.add_argument('--sizes', default='10000',
+                        help='comma separated message counts, e.g. 10000,1000000,10000000')
+    parser.add_argument('--scenarios', default=','.join(scenarios))
+    parser.add_argument('--workdir', help='where to keep generated data between runs (default: a temp dir)')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--tracemalloc', action='store_true', help='also measure the peak Python heap (slow)')
+    parser.add_argument('--main-args', default='', help='extra arguments for convert.py in the main scenario')
+    parser.add_argument('--run-one', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='fd-benchmark-'))
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    if args.run_one:
+        result = run_one(args.run_one, sizes[0], '%s/%d' % (workdir, sizes[0]),
+                         args.tracemalloc, args.main_args.split())
+        # The last line of output is the result, convert.py prints as well
+        print(json.dumps(result))
+        return
+
+    results = []
+    for size in sizes:
+        for scenario in args.scenarios.split(','):
+            command = [sys.executable, os.path.abspath(__file__), '--run-one', scenario,
+                       '--sizes', str(size), '--workdir', workdir, '--main-args=' + args.main_args]
+            if args.tracemalloc:
+                command.append('--tracemalloc')
+            output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print('%(scenario)-10s %(size)10d  %(seconds)9.3fs  %(items_per_second)10s/s  %(peak_rss_mb)8.1f MB' % result)
+            results.append(result)
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+
+if __name__ == '__main__':
+    main()
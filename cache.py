@@ -0,0 +1,141 @@
+"""
+On-disk cache for things we fetch from the Flowdock and Slack APIs.
+
+Each key is stored in its own <cache_dir>/<key>.cache file as a pickle, zlib
+compressed when it is big. That loads many times faster than the indented JSON
+we used before, which matters for multi-GB flow-*.json caches.
+
+ - every get() can pass its own ttl (seconds), older entries are a miss
+ - writes go to a temporary file which is then renamed, so a crash never
+   leaves half a cache file behind
+ - with max_bytes set, the least recently used entries are evicted
+ - hits, misses and stale entries are counted in stats, worker processes
+   hand theirs to add_stats() in the parent
+
+Old <key>.json files from earlier versions are imported on first use.
+"""
+import json
+import os
+import pickle
+import threading
+import time
+import zlib
+
+magic = b'FDC1'
+raw_format = b'\x00'
+zlib_format = b'\x01'
+compress_threshold = 1 << 20 # compress payloads bigger than 1 MiB
+suffix = '.cache'
+
+class Cache:
+    def __init__(self, cache_dir, default_ttl=None, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.default_ttl = default_ttl # None means entries never expire
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'misses': 0, 'stale': 0, 'writes': 0, 'evictions': 0}
+
+    def add_stats(self, stats):
+        # Counted by a worker process with its own copy of the cache
+        for name, value in stats.items():
+            self.stats[name] += value
+
+    def path(self, key):
+        return '%s/%s%s' % (self.cache_dir, key, suffix)
+
+    def legacy_path(self, key):
+        return '%s/%s.json' % (self.cache_dir, key)
+
+    def is_fresh(self, path, ttl):
+        ttl = self.default_ttl if ttl is None else ttl
+        return ttl is None or time.time() - os.path.getmtime(path) <= ttl
+
+    def get(self, key, ttl=None):
+        """
+        Returns the cached value, or None when it is missing or older than ttl
+        """
+        path = self.path(key)
+
+        if not os.path.exists(path):
+            legacy_path = self.legacy_path(key)
+            if os.path.exists(legacy_path) and self.is_fresh(legacy_path, ttl):
+                with open(legacy_path) as f:
+                    value = json.load(f)
+                self.set(key, value)
+                # keep the age of the original entry
+                mtime = os.path.getmtime(legacy_path)
+                os.utime(path, (time.time(), mtime))
+                os.remove(legacy_path)
+                self.stats['hits'] += 1
+                return value
+            self.stats['misses'] += 1
+            return None
+
+        if not self.is_fresh(path, ttl):
+            self.stats['stale'] += 1
+            self.stats['misses'] += 1
+            return None
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        # Remember when we used it for eviction, without changing the mtime
+        # which tells us how old the entry is
+        os.utime(path, (time.time(), os.path.getmtime(path)))
+        self.stats['hits'] += 1
+        return decode(data)
+
+    def contains(self, key, ttl=None):
+        path = self.path(key)
+        if not os.path.exists(path):
+            path = self.legacy_path(key)
+        return os.path.exists(path) and self.is_fresh(path, ttl)
+
+    def set(self, key, value):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path(key)
+        tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.writelines(encode(value))
+        os.replace(tmp_path, path)
+        self.stats['writes'] += 1
+
+        if self.max_bytes:
+            self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes
+        """
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(suffix) and entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        for atime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass # evicted by another thread
+            total -= size
+            self.stats['evictions'] += 1
+
+def encode(value):
+    # Returned as chunks so we don't copy big payloads to prepend the header
+    payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    if len(payload) > compress_threshold:
+        return [magic, zlib_format, zlib.compress(payload, 1)]
+    return [magic, raw_format, payload]
+
+def decode(data):
+    if data[:len(magic)] != magic:
+        raise ValueError('Not a cache file')
+    payload = memoryview(data)[len(magic) + 1:] # avoid copying huge payloads
+    if data[len(magic):len(magic) + 1] == zlib_format:
+        payload = zlib.decompress(payload)
+    return pickle.loads(payload)
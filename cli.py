@@ -0,0 +1,42 @@
+"""
+The command line of the migration, one entry point for all the steps:
+
+  fetch    download messages.json from the Flowdock export archives
+  convert  convert the flows into a Slack export
+  package  build the export again from the converted flows of the last run
+  emoji    download the Flowdock emojis
+  analyze  size up the flows without converting them
+
+Only the module of the command is imported, so each command starts without
+loading the dependencies of the others.
+
+Usage: python cli.py convert --jobs 4
+       python cli.py <command> --help
+"""
+import argparse
+import importlib
+
+# command -> (module, function, description)
+commands = {
+    'fetch': ('fetch_fd_messages', 'main', 'download messages.json from the Flowdock export archives'),
+    'convert': ('convert', 'main', 'convert the flows into a Slack export'),
+    'package': ('convert', 'package_main', 'build the export again from the converted flows of the last run'),
+    'emoji': ('emoji', 'main', 'download the Flowdock emojis'),
+    'analyze': ('analyze', 'main', 'size up the flows without converting them')
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Migrate Flowdock flows to Slack',
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog='commands:\n' + '\n'.join('  %-9s%s' % (command, description)
+                                                                       for command, (_, _, description) in commands.items()))
+    parser.add_argument('command', choices=commands)
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='the options of the command, see <command> --help')
+    args = parser.parse_args(argv)
+
+    module_name, function_name, _ = commands[args.command]
+    command = getattr(importlib.import_module(module_name), function_name)
+    command(args.args, prog='%s %s' % (parser.prog, args.command))
+
+if __name__ == '__main__':
+    main()
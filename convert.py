@@ -1,37 +1,124 @@
+"""
+Converts Flowdock flows into a Slack export.
+
+Importing this module doesn't read config.yml or touch the network, and the
+dependencies that take long to import (slack, requests, aiohttp, yaml) are
+only imported by the functions that use them. configure() sets the module
+up from a configuration; the transform functions, e.g.
+transform_fd_messages_to_slack, also work with the defaults:
+
+    import convert
+    convert.configure(convert.load_configuration())  # or a dict
+    messages = convert.transform_fd_messages_to_slack(flowdock_messages, 'flow', user_map, users_index)
+
+Usage: python cli.py convert --jobs 4, or python convert.py --jobs 4
+"""
 import json
-import yaml
 import os
-import requests
 from time import gmtime, strftime
 import shutil
 from hashlib import blake2b
 import re
-from slack import WebClient
-from slack.errors import SlackApiError
-from datetime import datetime
-from dateutil.relativedelta import relativedelta
+import sys
 import time
-import textwrap
-
-def load_configuration():
-    with open(config_file) as f:
-        return yaml.safe_load(f)
+import argparse
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from cache import Cache
+from json_stream import iter_json_array
+from metrics import Metrics, Progress, profiled
+from pipeline import Pipeline, format_report
+from runner import InOrder, RunManifest
+from shards import ShardWriter, build_shard, build_shards, part_days, plan_shards, shard_index, shard_modes
+from slack_export import ChannelWriter, ZipChannelWriter, dump_json_file
+from slack_message import SlackMessage
+from staging import StagingStore
+from thread_index import ThreadIndex
+from incremental import (NewMessages, StaleStateError, commit_flow_state, load_flow_state, open_flow_threads,
+                         save_flow_state)
+from text_transform import TextTransformer, build_mentions, escape, message_text, split_text
+from user_matching import match_flowdock_users, match_report
 
 config_file = 'config.yml'
-config = load_configuration()
-slack_team = config['slack_team']
-flowdock_org = config['flowdock_org']
-flowdock_url = 'https://api.flowdock.com'
 import_dir = 'input/exports' # Contains a directory per flow
 output_path = 'output'
 cache_dir = 'cache'
+day = 24 * 60 * 60
 output_dir_prefix = output_path + '/slack-export-'
 export_channel_prefix = 'history-'
-import_bot_slack_id = config['import_bot_slack_id']
+state_dir = 'state' # per-flow state for incremental runs
+run_metrics = Metrics()
+
+# Set from the configuration by configure()
+config = {}
+slack_team = None
+flowdock_org = None
+flowdock_url = 'https://api.flowdock.com'
+import_bot_slack_id = None
+# How long cached API responses are used before we fetch them again
+cache_ttl = 30 * day
+users_cache_ttl = 7 * day
+api_cache = Cache(cache_dir, default_ttl=cache_ttl)
+# Optional SQLite store for fetched flows and users instead of api_cache, see staging.py
+staging = None
+attachments = None # the AttachmentStore, with attachments_dir
+output_indent = None # pretty print the channel files, e.g. 4
+# Thread parents kept in memory per flow, the others wait in a ThreadIndex on disk
+thread_cache_size = 100000
+
+# Messages get truncated around 4000 characters. We make it a bit shorter
+# so we can add an explation for the user.
+slack_message_max_length = 3900
+
+def load_configuration(path=None):
+    import yaml
+    with open(path or config_file) as f:
+        return yaml.safe_load(f)
+
+def configure(new_config):
+    """
+    Set the module up from new_config, the contents of config.yml (see
+    config.yml.sample). slack_team, flowdock_org and import_bot_slack_id are
+    required.
+    """
+    global config, slack_team, flowdock_org, flowdock_url, import_bot_slack_id, cache_ttl, users_cache_ttl, \
+        api_cache, staging, attachments, output_indent, thread_cache_size
+    config = new_config
+    slack_team = config['slack_team']
+    flowdock_org = config['flowdock_org']
+    flowdock_url = config.get('flowdock_api_url', 'https://api.flowdock.com')
+    import_bot_slack_id = config['import_bot_slack_id']
+    cache_ttl = config.get('cache_ttl_days', 30) * day
+    users_cache_ttl = config.get('users_cache_ttl_days', 7) * day
+    api_cache = Cache(cache_dir, default_ttl=cache_ttl, max_bytes=config.get('cache_max_bytes'))
+    staging = StagingStore(config['staging_db']) if config.get('staging_db') else None
+    attachments = None
+    if config.get('attachments_dir'):
+        from attachments import AttachmentStore
+        attachments = AttachmentStore(config['attachments_dir'])
+    output_indent = config.get('output_indent')
+    thread_cache_size = config.get('thread_cache_size', 100000)
+    flowdock_bot_profile['team'] = slack_team
 
 flowdock_messages_file = 'input/exports/flowdock-replacement/messages.json'
 
+def set_work_dir(path):
+    """
+    Use config.yml, input/exports, cache, state and output under path instead
+    of the current directory. Call it before configure().
+    """
+    global config_file, import_dir, output_path, cache_dir, output_dir_prefix, state_dir, flowdock_messages_file
+    config_file = os.path.join(path, 'config.yml')
+    import_dir = os.path.join(path, 'input/exports')
+    output_path = os.path.join(path, 'output')
+    cache_dir = os.path.join(path, 'cache')
+    output_dir_prefix = output_path + '/slack-export-'
+    state_dir = os.path.join(path, 'state')
+    flowdock_messages_file = os.path.join(path, 'input/exports/flowdock-replacement/messages.json')
+
 def get_flowdock_url(rest_url, params={}):
+    import requests
     flowdock_headers = {'Authorization': 'Basic %s' % config['flowdock_token']}
     r = requests.get(flowdock_url + rest_url,
                      headers=flowdock_headers,
@@ -39,73 +126,75 @@ def get_flowdock_url(rest_url, params={}):
     r.raise_for_status()
     return r.json()
 
-def get_from_cache(cache_file):
-    cache_file_rel_path = '%s/%s' % (cache_dir, cache_file)
-
-    if os.path.exists(cache_file_rel_path):
-        one_month_ago = datetime.now() - relativedelta(month=1)
-        file_time = datetime.fromtimestamp(os.path.getmtime(cache_file_rel_path))
-        if file_time > one_month_ago:
-            # Cache hit
-            return load_json_file(cache_file_rel_path)
-        return load_json_file(cache_file_rel_path)
-
-    if not os.path.exists(cache_dir):
-        os.mkdir(cache_dir)
-
-    return None
-
 def get_flowdock_users():
-    cache_file = 'flowdock-users.json'
+    cache_key = 'flowdock-users'
 
-    flowdock_users = get_from_cache(cache_file)
-    if flowdock_users:
-        return flowdock_users
+    if staging:
+        if staging.is_fresh(cache_key, users_cache_ttl):
+            return staging.get_users('flowdock')
+    else:
+        flowdock_users = api_cache.get(cache_key, ttl=users_cache_ttl)
+        if flowdock_users:
+            return flowdock_users
 
     flowdock_users = get_flowdock_url('/organizations/%s/users' % flowdock_org)
-    write_json_file(flowdock_users, cache_dir, cache_file)
+    if staging:
+        staging.set_users('flowdock', flowdock_users)
+        staging.mark_fetched(cache_key)
+    else:
+        api_cache.set(cache_key, flowdock_users)
     return flowdock_users
 
 def get_slack_users():
-    cache_file = 'slack-users.json'
-    
-    slack_users = get_from_cache(cache_file)
-    if slack_users:
-        return slack_users
-    
-    # Cache doesn't exist or is stale, so fetch the list from Slack
-
-    client = WebClient(token=config['slack_api_token'])
+    """
+    All the users of the Slack workspace, from the user directory (see
+    slack_users.py), which is refreshed when it is older than the users TTL
+    """
+    from slack import WebClient
+    from slack.errors import SlackApiError
+    from slack_users import SlackUserDirectory, iter_user_pages
 
+    directory = SlackUserDirectory(config['staging_db'] if staging else cache_dir + '/slack-users.sqlite')
     try:
-        response = client.users_list()
-        slack_users = response['members']
-        # Write list to cache
-        write_json_file(slack_users, cache_dir, cache_file)
-        return slack_users
-    except SlackApiError as e:
-        # You will get a SlackApiError if "ok" is False
-        assert e.response["ok"] is False
-        assert e.response["error"]  # str like 'invalid_auth', 'channel_not_found'
-        print(f"Got an error: {e.response['error']}")
+        if not directory.is_fresh(users_cache_ttl):
+            # Always all the pages, the users cached by earlier versions are
+            # only the first one
+            client = WebClient(token=config['slack_api_token'], base_url=config.get('slack_api_url', WebClient.BASE_URL))
+            try:
+                counts = directory.refresh(iter_user_pages(client))
+            except SlackApiError as e:
+                raise RuntimeError('Could not fetch the Slack users: %s' % e.response['error'])
+            print('Slack users: %(users)d, %(added)d added, %(changed)d changed, %(removed)d removed' % counts)
+        return directory.users()
+    finally:
+        directory.close()
 
 def load_json_file(path):
     with open(path) as f:
         return json.load(f)
 
 def build_fd_uid_to_slack_user_map(flowdock_users, slack_users):
-    fd_to_slack_user_map = {} # dict where key is a flowdock uid and value is a slack user
-    for fd_user in flowdock_users:
-        fd_uid = str(fd_user['id']) # keys as strings because they are strings in the messages
-        for slack_user in slack_users:
-            if (slack_user['profile'].get('email') == fd_user['email'] or
-                slack_user.get('real_name') == fd_user['name'].split(' - ')[0]):
-                fd_to_slack_user_map[fd_uid] = slack_user
-                break
-        if not fd_to_slack_user_map.get(fd_uid):
-            print('No match for %s - %s - %s' % (fd_user['email'], fd_user['nick'], fd_user['name']))
-            
-    return fd_to_slack_user_map
+    """
+    Returns a dict where key is a flowdock uid and value is a slack user. Users
+    are matched by email, then name, then nick (see user_matching) and a report
+    of which rule matched each user is written to output/user-matches.json
+    """
+    matches = match_flowdock_users(flowdock_users, slack_users)
+
+    report = match_report(flowdock_users, matches)
+    rule_counts = {}
+    for entry in report:
+        rule = entry['rule'] or 'none'
+        if not entry['rule']:
+            print('No match for %s - %s - %s' % (entry['email'], entry['nick'], entry['name']))
+        rule_counts[rule] = rule_counts.get(rule, 0) + 1
+    print('Matched Flowdock users by: %s' % ', '.join('%s %d' % item for item in rule_counts.items()))
+
+    os.makedirs(output_path, exist_ok=True)
+    write_json_file(report, output_path, 'user-matches.json')
+
+    # keys as strings because they are strings in the messages
+    return { fd_uid:slack_user for (fd_uid, (slack_user, rule)) in matches.items() }
 
 def build_fd_users_index(flowdock_users, slack_users):
     fd_users_index = {}
@@ -113,43 +202,77 @@ def build_fd_users_index(flowdock_users, slack_users):
         fd_users_index[str(user['id'])] = user
     return fd_users_index
 
+def generate_client_msg_id(fm, kind='message'):
+    """
+    Slack messages have an undocumented hash like this:
+    3c0332f2-77d5-404d-a70f-e24f08a39b97
+    make up one that looks the same from the fields of the Flowdock message
+    that never change, so reruns and incremental runs give the same ids.
+    kind keeps the thread backlink of a message apart from the message itself
+    """
+    key = '%s:%s:%s:%s' % (kind, fm.get('flow'), fm['id'], fm['sent'])
+    m = blake2b(key.encode(), digest_size=16).hexdigest()
+    return '%s-%s-%s-%s-%s' % (m[:8], m[8:12], m[12:16], m[16:20], m[20:])
+
+# The profile of the thread backlink messages
+flowdock_bot_profile = {
+    'image_72': 'https://avatars.slack-edge.com/2020-06-02/1171563963329_423169057c2045a4a24f_72.jpg',
+    'avatar_hash': '423169057c20',
+    'display_name': 'Flowdock',
+    'first_name': 'flowdock_migration',
+    'real_name': 'flowdock_migration',
+    'team': None, # slack_team, see configure()
+    'name': 'flowdock',
+    'is_restricted': False,
+    'is_ultra_restricted': False
+}
+
 def generate_flowdock_thread_backlink_message(fm, flow, parent):
     fd_thread_url = 'https://www.flowdock.com/app/{org}/{flow}/threads/{thread_id}'.format(
         org = flowdock_org, flow = flow, thread_id = fm['thread_id']
     )
-    m = blake2b(str(fm).encode(), digest_size=21).hexdigest()
-    msg_id = '{0}-{1}-{2}-{3}-{4}'.format(m[:8], m[9:13], m[14:18], m[19:23], m[24:36])
+    sm = SlackMessage(fd_thread_url, import_bot_slack_id, generate_client_msg_id(fm, 'backlink'),
+                      flowdock_bot_profile, ts='%d.%06d' % divmod(fm['sent'], 1e3))
+    sm.thread_ts = parent.ts
+    sm.parent_user_id = parent.user
+    return sm
+
+def build_text_transformer(fd_uid_to_slack_user_map, fd_users_index):
+    mentions = build_mentions(fd_uid_to_slack_user_map, fd_users_index)
+    return TextTransformer(mentions, config.get('emoji_aliases'))
+
+def build_user_profile(slack_user):
     return {
-        'type': 'message',
-        'text': fd_thread_url,
-        'ts': '%d.%06d' % divmod(fm['sent'], 1e3),
-        'user': import_bot_slack_id,
-        'thread_ts': parent['ts'],
-        'parent_user_id': parent['user'],
+        'image_72': slack_user['profile']['image_72'],
+        'avatar_hash': slack_user['profile']['avatar_hash'],
+        'display_name': slack_user['profile']['display_name'],
+        'real_name': slack_user['profile']['real_name'],
         'team': slack_team,
-        'user_team': slack_team,
-        'source_team': slack_team,
-        'client_msg_id': msg_id,
-        'user_profile': {
-            'image_72': 'https://avatars.slack-edge.com/2020-06-02/1171563963329_423169057c2045a4a24f_72.jpg',
-            'avatar_hash': '423169057c20',
-            'display_name': 'Flowdock',
-            'first_name': 'flowdock_migration',
-            'real_name': 'flowdock_migration',
-            'team': slack_team,
-            'name': 'flowdock',
-            'is_restricted': False,
-            'is_ultra_restricted': False
-        }
+        'name': slack_user['name'],
+        'is_restricted': False,
+        'is_ultra_restricted': False
     }
 
-def format_slack_mention(handle):
-    # '@Foo' becomes '<@foo>'
-    return '<%s>' % handle.group(0).lower()
-
-def transform_fd_message_to_slack(fm, slack_user, fd_uid_to_slack_user_map):
+def attachment_text(content):
     """
-    Map the simpler fields
+    A link to the stored copy of the attachment, or its id in the store
+    without attachments_url. None when it wasn't downloaded.
+    """
+    stored = attachments.get(content['path']) if attachments and content.get('path') else None
+    if not stored:
+        return None
+    sha256, size, content_type = stored
+    if config.get('attachments_url'):
+        return 'Flowdock attachment: <%s/%s/%s|%s> (%d KB)' % (
+            config['attachments_url'].rstrip('/'), sha256[:2], sha256, escape(content['file_name']), -(-size // 1024))
+    return 'Flowdock attachment %s, stored as %s (%d KB)' % (escape(content['file_name']), sha256, -(-size // 1024))
+
+def transform_fd_message_to_slack(fm, slack_user, fd_uid_to_slack_user_map, text_transformer=None, profile=None):
+    """
+    Map the simpler fields. text_transformer rewrites mentions and markup and
+    profile is the user_profile of slack_user, pass them in when converting
+    many messages so they are shared (see build_text_transformer and
+    build_user_profile)
     """
 
     no_attachements_explanation = '''
@@ -157,110 +280,103 @@ def transform_fd_message_to_slack(fm, slack_user, fd_uid_to_slack_user_map):
 
     The original filename was: '''
 
-    # sm = slack message
-    sm = {}
-
-    # turn '@Foo' into '<@foo>' for Slack to see the mentions
-    regex = r"(@+\w+)"
-    slack_text = re.sub(regex, format_slack_mention, str(fm['content']), 0, re.MULTILINE)
-
     if fm['event'] == 'file':
-        sm['type'] = 'message'
-        sm['text'] = no_attachements_explanation + fm['content']['file_name']
-    elif fm['event'] == 'message':
-        sm['type'] = 'message'
-        sm['text'] = slack_text
-    elif fm['event'] == 'comment':
-        sm['type'] = 'message'
-        sm['text'] = slack_text
+        text = attachment_text(fm['content']) or no_attachements_explanation + escape(fm['content']['file_name'])
+    elif fm['event'] in ('message', 'comment'):
+        if text_transformer is None:
+            text_transformer = build_text_transformer(fd_uid_to_slack_user_map, {})
+        # turn '@Foo' into '<@U1234>' for Slack to see the mentions, escape &<>
+        text = text_transformer.transform(message_text(fm))
     else:
         print('Skipping message of unknown type %s' % fm['event'])
         return
 
-    sm['user'] = slack_user['id']
-
-    # Slack messages have an undocumented hash like this:
-    # 3c0332f2-77d5-404d-a70f-e24f08a39b97
-    # make up some random hash that looks the same!
-    m = blake2b(str(fm).encode(), digest_size=21).hexdigest()
-    sm['client_msg_id'] = '{0}-{1}-{2}-{3}-{4}'.format(m[:8], m[9:13], m[14:18], m[19:23], m[24:36])
-
-    sm['team'] = slack_team
-    sm['user_team'] = slack_team
-    sm['source_team'] = slack_team
-
-    sm['user_profile'] = {
-        'image_72': slack_user['profile']['image_72'],
-        'avatar_hash': slack_user['profile']['avatar_hash'],
-        'display_name': slack_user['profile']['display_name'],
-        'real_name': slack_user['profile']['real_name'],
-        'team': slack_team,
-        'name': slack_user['name'],
-        'is_restricted': False,
-        'is_ultra_restricted': False
-    }
+    if profile is None:
+        profile = build_user_profile(slack_user)
 
-    sm['reactions'] = []
+    reactions = []
     for emoji in fm['emojiReactions']:
         users = []
         for fd_uid in fm['emojiReactions'][emoji]:
-            slack_user = fd_uid_to_slack_user_map.get(fd_uid)
-            if slack_user:
-                users.append(slack_user['id'])
+            reaction_user = fd_uid_to_slack_user_map.get(fd_uid)
+            if reaction_user:
+                users.append(reaction_user['id'])
             else:
                 # Avoid duplicate bot users
                 if import_bot_slack_id not in users:
                     users.append(import_bot_slack_id)
 
-        sm['reactions'].append({
-            'name': emoji,
-            'users': users,
-            'count': len(users)
-        })
+        reactions.append((emoji, tuple(users)))
 
-    return sm
+    # sm = slack message
+    return SlackMessage(text, slack_user['id'], generate_client_msg_id(fm), profile, tuple(reactions))
 
 def transform_fd_messages_to_slack(flowdock_messages, flow, fd_uid_to_slack_user_map, fd_users_index):
-    thread_mapping = {} # maps Flowdock thread_id's to Slack parent messages
-    slack_messages = [] # what we return, a list of messages ready for import
+    return [sm for sm, parent in iter_fd_messages_to_slack(flowdock_messages, flow, fd_uid_to_slack_user_map, fd_users_index)]
+
+def lookup_sender(fd_uid, fd_uid_to_slack_user_map, fd_users_index):
+    """
+    The Slack user and user_profile to use for messages of a Flowdock user,
+    the import bot with the Flowdock name when they have no Slack account
+    """
+    flowdock_user = fd_users_index.get(fd_uid) # Can be None
+    slack_user = fd_uid_to_slack_user_map.get(fd_uid) # Can be None
+
+    if not slack_user:
+        slack_user = {
+            'id': import_bot_slack_id,
+            'name': flowdock_user['email'].split('@')[0] if flowdock_user else 'unknown',
+            'profile': {
+                'display_name': flowdock_user['nick'] if flowdock_user else 'unknown',
+                'image_72': '',
+                'avatar_hash': '',
+                'real_name': re.split(' - ', flowdock_user['name'])[0] if flowdock_user else 'unknown'
+            }
+        }
+    return slack_user, build_user_profile(slack_user)
+
+def iter_fd_messages_to_slack(flowdock_messages, flow, fd_uid_to_slack_user_map, fd_users_index, thread_mapping=None):
+    """
+    Generator version of transform_fd_messages_to_slack. flowdock_messages can
+    be any iterable (e.g. iter_json_array) so the whole flow never has to be in
+    memory, only the thread parents we may still need to update.
+
+    Yields (message, parent) tuples where parent is the thread parent the
+    message updated, or None. Thread parents are yielded when they are first
+    seen and are then updated in place as replies arrive.
+
+    thread_mapping can be passed in to continue the threads of an earlier run,
+    or be a ThreadIndex to keep the parents on disk.
+    """
+    if thread_mapping is None:
+        thread_mapping = {} # maps Flowdock thread_id's to Slack parent messages
+    text_transformer = build_text_transformer(fd_uid_to_slack_user_map, fd_users_index)
+    senders = {} # Flowdock uid -> (slack_user, profile), one profile per user
 
     for fm in flowdock_messages:
 
         # Lookup metadata of user that sent this message
         fd_uid = fm['user']
-
-        flowdock_user = fd_users_index.get(fd_uid) # Can be None
-        slack_user = fd_uid_to_slack_user_map.get(fd_uid) # Can be None
-
-        if not slack_user:
-            slack_user = {
-                'id': import_bot_slack_id,
-                'name': flowdock_user['email'].split('@')[0] if flowdock_user else 'unknown',
-                'profile': {
-                    'display_name': flowdock_user['nick'] if flowdock_user else 'unknown',
-                    'image_72': '',
-                    'avatar_hash': '',
-                    'real_name': re.split(' - ', flowdock_user['name'])[0] if flowdock_user else 'unknown'
-                }
-            }
+        sender = senders.get(fd_uid)
+        if sender is None:
+            sender = senders[fd_uid] = lookup_sender(fd_uid, fd_uid_to_slack_user_map, fd_users_index)
+        slack_user, profile = sender
 
         # sm is a single slack message to add to the list
-        sm = transform_fd_message_to_slack(fm, slack_user, fd_uid_to_slack_user_map)
+        sm = transform_fd_message_to_slack(fm, slack_user, fd_uid_to_slack_user_map, text_transformer, profile)
         if not sm:
             # Allow transform_fd_message_to_slack to skip messages
             continue
 
-        # Messages get truncated around 4000 characters. We make it a bit shorter
-        # so we can add an explation for the user.
-        slack_message_max_length = 3900
-        multipart_message_list = []
-        if len(sm['text']) > slack_message_max_length:
-            # We have a long message, we need to split the text into several parts
-            multipart_message_list = textwrap.wrap(sm['text'], width=slack_message_max_length, replace_whitespace=False)
+        text_parts = None
+        if len(sm.text) > slack_message_max_length:
+            # We have a long message, we need to split the text into several
+            # parts, which are made one at a time as we write them
+            text_parts = split_text(sm.text, slack_message_max_length)
 
         # Slack messages have a timestamp followed by . and 6 digits
         sm_ts = '%d.%06d' % divmod(fm['sent'], 1e3)
-        sm['ts'] = sm_ts
+        sm.ts = sm_ts
 
         """
         Threadding: is where this gets ugly
@@ -282,17 +398,17 @@ def transform_fd_messages_to_slack(flowdock_messages, flow, fd_uid_to_slack_user
         # This message might be part of an existing thread. We try to find the parent
         parent = thread_mapping.get(fm.get('thread_id'))
 
-        if not parent and not multipart_message_list:
+        if not parent and not text_parts:
             # This is a single message which is not too long
-            sm['thread_ts'] = sm_ts
+            sm.thread_ts = sm_ts
 
             if 'thread_id' in fm:
                 # Add this message to the map in case there are replies later
                 thread_mapping[fm['thread_id']] = sm
 
-            slack_messages.append(sm)
+            yield sm, None
 
-        if parent or multipart_message_list:
+        if parent or text_parts:
             # This message is from a thread and/or this message is so long we need
             # to make it a thread to group all the parts
 
@@ -305,19 +421,17 @@ def transform_fd_messages_to_slack(flowdock_messages, flow, fd_uid_to_slack_user
                     thread_mapping[fm['thread_id']] = sm
 
             # Add keys to the current message to make it a thread
-            sm['thread_ts'] = parent['ts']
-            sm['parent_user_id'] = parent['user']
+            sm.thread_ts = parent.ts
+            sm.parent_user_id = parent.user
 
-            if multipart_message_list:
+            if text_parts:
                 # Copy sm so we can reuse it for the multi-part messages
                 sm_copy = sm.copy()
-            else:
-                sm_copy = None
 
             # Several updates to the parent message to reflect this new reply
 
             # Parent messages need a list of replies
-            if not parent.get('reply_count'):
+            if not parent.replies:
                 # this is the first reply
 
                 # add a message with the old Flowdock thread in it
@@ -326,22 +440,13 @@ def transform_fd_messages_to_slack(flowdock_messages, flow, fd_uid_to_slack_user
                     thread_backlink = generate_flowdock_thread_backlink_message(
                         fm, flow, parent
                     )
-                    slack_messages.append(thread_backlink)
+                    yield thread_backlink, parent
 
                 # Initialise the thead metadata with this first reply
-                parent['replies'] = [{
-                    'user': import_bot_slack_id,
-                    'ts': parent['ts']
-                }]
-                parent['reply_users'] = [import_bot_slack_id]
-                parent['reply_users_count'] = 1
-
-            replies = parent['replies']
-            replies.append({
-                'user': slack_user['id'],
-                'ts': sm_ts
-            })
-            parent['reply_count'] = len(replies)
+                parent.replies = [(import_bot_slack_id, parent.ts)]
+                parent.reply_users = [import_bot_slack_id]
+
+            parent.replies.append((slack_user['id'], sm_ts))
 
             # We want to mark threads as read so we need to track the last/final
             # timestamp. Initialise it to the current one.
@@ -349,48 +454,38 @@ def transform_fd_messages_to_slack(flowdock_messages, flow, fd_uid_to_slack_user
 
             # Append the current message to the list before we handle
             # multi-part messages and update the parent
-            if not multipart_message_list:
-                slack_messages.append(sm)
+            if not text_parts:
+                yield sm, parent
                 pass
             else:
 
                 # Handle long multi-part messages
-                for count, text_part in enumerate(multipart_message_list):
+                for count, text_part in enumerate(text_parts):
                     # Use a copy of the current message before we added all the thread crap to it
-                    part = sm_copy.copy() if sm_copy else sm.copy()
+                    part = sm_copy.copy()
                     # Increment the timestamp to add these messages to the thread after
                     # the first one. Each message is one second? appart
-                    part_ts = sm['ts'].split('.')
+                    part_ts = sm.ts.split('.')
                     part_ts[0] = int(part_ts[0]) + count + 1
                     part_ts[1] = int(part_ts[1]) + count + 1
                     last_ts = '%d.%06d' % tuple(part_ts)
-                    part['ts'] = last_ts
+                    part.ts = last_ts
                     if count == 0:
-                        part['text'] = text_part
+                        part.text = text_part
                     else:
-                        part['text'] = '*Flowdock imported message continues ...*\n' + text_part
+                        part.text = '*Flowdock imported message continues ...*\n' + text_part
                     # append a message for each part
-                    slack_messages.append(part)
+                    yield part, parent
                     # update the parent
-                    replies = parent['replies']
-                    replies.append({
-                        'user': slack_user['id'],
-                        'ts': last_ts
-                    })
-                    parent['reply_count'] = len(replies)
+                    parent.replies.append((slack_user['id'], last_ts))
 
             # Parent messages also have a list and count of users
             # We only need to update this once for multi-part messages
-            if not slack_user['id'] in parent['reply_users']:
-                parent['reply_users'].append(slack_user['id'])
-                parent['reply_users_count'] = len(parent['reply_users'])
-
-            # some misc fields
-            parent['latest_reply'] = last_ts
-            parent['last_read'] = last_ts # mark all the imports as read
-            parent['subscribed'] = False
+            if not slack_user['id'] in parent.reply_users:
+                parent.reply_users.append(slack_user['id'])
 
-    return slack_messages
+            # some misc fields, last_read and subscribed follow from it
+            parent.latest_reply = last_ts
 
 def generate_channels_list(flows):
     channels = []
@@ -422,79 +517,115 @@ def write_json_file(contents, path, filename):
     with open(path + '/' + filename, 'w') as f:
         json.dump(contents, f, indent=4)
 
-def get_flow_messages(flow_name, flow_param):
+def fetch_flow(flow_name, flow_param, fetcher=None):
     """
-    Flowdock messages are paginated so we need to fetch them 100 at a time
+    Download the messages of a flow into the cache, or the staging store,
+    unless they are there already. Flowdock messages are paginated so this
+    takes a request per 100 of them, see flowdock_fetch. With fetcher (a
+    flowdock_fetch.FlowFetcher) the download shares its session.
     """
-    cache_file = 'flow-%s.json' % flow_param
-
-    messages = get_from_cache(cache_file)
-
-    if messages:
-        print('Found cached messages for %s AKA %s' % (flow_name, flow_param))
-        return messages
+    from flowdock_fetch import download_flows
 
+    key = 'flow-%s' % flow_param
+    if staging.is_fresh(key, cache_ttl) if staging else api_cache.contains(key):
+        return
     print('Downloading messages from %s AKA %s' % (flow_name, flow_param))
-    messages = []
-    id = 0 # We start with the oldest possible message
+    if fetcher:
+        cache_downloaded_flow(flow_param, fetcher.fetch(flow_param))
+        return
+    paths = download_flows([flow_param], config['flowdock_token'], flowdock_org,
+                           cache_dir, flowdock_url)
+    if flow_param not in paths:
+        raise RuntimeError('Could not download messages for %s' % flow_name)
+    cache_downloaded_flow(flow_param, paths[flow_param])
 
-    flowdock_headers = {'Authorization': 'Basic %s' % config['flowdock_token']}
-    messages_url = '{url}/flows/{org}/{flow}/messages'.format(
-        url=flowdock_url,
-        org=flowdock_org,
-        flow=flow_param
-    )
-    session = requests.Session()
-    session.headers=flowdock_headers
-
-    # Check if we can read the flow and fix if needed
-    flow_url = '{url}/flows/{org}/{flow}'.format(url=flowdock_url, org=flowdock_org, flow=flow_param)
-    r = session.get(flow_url)
-    flow_metadata = r.json()
-    if not flow_metadata['open']:
-        r = session.put(flow_url, data={'open': True})
-        r.raise_for_status()
-
-    while True:
-        print('.', end='', flush=True)
-        r = session.get(messages_url, params={
-            'event': 'file,message,comment',
-            'limit': 100, # we fetch the max possible messages
-            'since_id': id,
-            'sort': 'asc'
-        })
-        r.raise_for_status()
-        page = r.json()
-        if page:
-            id = page[-1]['id'] # move the id to the last message
-            messages.extend(page)
-        else:
-            print()
-            break
+def get_flow_messages(flow_name, flow_param):
+    """
+    The messages of a flow, downloaded first if needed. With staging_db this
+    returns an iterator over the staged messages instead of a list.
+    """
+    if staging:
+        if staging.is_fresh('flow-%s' % flow_param, cache_ttl):
+            print('Found staged messages for %s AKA %s' % (flow_name, flow_param))
+            return staging.iter_messages(flow_param)
+    else:
+        messages = api_cache.get('flow-%s' % flow_param)
+        if messages:
+            print('Found cached messages for %s AKA %s' % (flow_name, flow_param))
+            return messages
+
+    fetch_flow(flow_name, flow_param)
+    return staging.iter_messages(flow_param) if staging else api_cache.get('flow-%s' % flow_param)
+
+def cache_downloaded_flow(flow_param, checkpoint):
+    # Move a completed download from its checkpoint file to the cache, or
+    # the staging store
+    from flowdock_fetch import iter_checkpoint, read_checkpoint
+    if staging:
+        staging.add_messages(flow_param, iter_checkpoint(checkpoint), replace=True)
+        staging.mark_fetched('flow-%s' % flow_param)
+    else:
+        api_cache.set('flow-%s' % flow_param, read_checkpoint(checkpoint))
+    os.remove(checkpoint)
+
+def prefetch_flow_messages(flows):
+    """
+    Download all the flows that aren't cached yet, several at a time.
+    Returns the flow_params which could not be downloaded.
+    """
+    from flowdock_fetch import download_flows
 
-    write_json_file(messages, cache_dir, cache_file)
-    return messages
+    if staging:
+        missing = [flow_param for flow_param in flows.values()
+                   if not staging.is_fresh('flow-%s' % flow_param, cache_ttl)]
+    else:
+        missing = [flow_param for flow_param in flows.values()
+                   if not api_cache.contains('flow-%s' % flow_param)]
+    if not missing:
+        return set()
+    print('Downloading messages from %d flows' % len(missing))
+    paths = download_flows(missing, config['flowdock_token'], flowdock_org,
+                           cache_dir, flowdock_url, config.get('fetch_concurrency', 4))
+    for flow_param, checkpoint in paths.items():
+        cache_downloaded_flow(flow_param, checkpoint)
+    return set(missing) - set(paths)
 
 def get_all_flows():
-    cache_file = 'all-flows.json'
+    cache_key = 'all-flows'
 
-    all_flows = get_from_cache(cache_file)
-    if all_flows:
-        return all_flows
+    if staging:
+        if staging.is_fresh(cache_key, cache_ttl):
+            return staging.get_flows()
+    else:
+        all_flows = api_cache.get(cache_key)
+        if all_flows:
+            return all_flows
 
     all_flows = get_flowdock_url('/flows/all')
-    write_json_file(all_flows, cache_dir, cache_file)
+    if staging:
+        staging.set_flows(all_flows)
+        staging.mark_fetched(cache_key)
+    else:
+        api_cache.set(cache_key, all_flows)
     return all_flows
 
-def migrate_flows_to_slack_format(slack_users, fd_uid_to_slack_user_map, fd_users_index):
+def migrate_flows_to_slack_format(slack_users, fd_uid_to_slack_user_map, fd_users_index, jobs=1, incremental=False,
+                                  write_directory=False, compression_level=6, options=None, resume=False,
+                                  sharding=None, keep_parts=False):
     """
-    Writes all the messages into the Slack format and creates a zip file for
-    import into Slack.
+    Writes all the messages into the Slack format and streams them into a zip
+    file for import into Slack. With jobs > 1 the flows are converted in
+    parallel by a pool of worker processes. With incremental only new messages
+    are converted and unchanged flows are left out.
+
+    write_directory writes the old output/slack-export-<ts> directory as well,
+    which is handy for debugging but much slower. options are passed to the
+    conversion workers, see worker_options.
+
+    The export zip is built by run_export, which can resume a run that
+    failed half way, and keeps the parts of the flows with keep_parts.
+    Returns False when flows failed.
     """
-    output_dir = output_dir_prefix + strftime('%Y-%m-%d-%H-%M-%S', gmtime())
-    os.mkdir(output_dir)
-
-    write_json_file(slack_users, output_dir, 'users.json')
 
     # We import the list of flows from our config file AND any that are under
     # input/exports/*/messages.json
@@ -502,14 +633,9 @@ def migrate_flows_to_slack_format(slack_users, fd_uid_to_slack_user_map, fd_user
     # We can't get private flows using the API, so we need to do both :-()
     api_flows = config['api_flows'] 
     exported_flows = config['exported_flows']
-    
-    # Transform the messages from each flow to a Slack channel
-    for flow in exported_flows:
-        try:
-            flowdock_messages = load_json_file('input/exports/%s/messages.json' % flow)
-            transform_and_write_messages(flowdock_messages, flow, flow, fd_uid_to_slack_user_map, fd_users_index, output_dir)
-        except:
-            print('Could not find downloaded messages for %s' % flow)
+
+    # (source, flow_param, flow_name) for every flow we want to convert
+    flow_jobs = [('export', flow, flow) for flow in exported_flows]
 
     # Flows have a name which may be different from what the backend expects
     # the client normally maps the display name ('name') to the real name 
@@ -523,40 +649,647 @@ def migrate_flows_to_slack_format(slack_users, fd_uid_to_slack_user_map, fd_user
     # Filter the dict of flows_name -> flow_param to include only the ones from config.yml
     flows = { flow_name:flow_param for (flow_name,flow_param) in name_to_param_name_map.items() if flow_name in api_flows }
 
-    for flow_name, flow_param in flows.items():
+    flow_jobs += [('api', flow_param, flow_name) for flow_name, flow_param in flows.items()]
+
+    if not write_directory:
+        return run_export(flow_jobs, slack_users, fd_uid_to_slack_user_map, fd_users_index, jobs, incremental,
+                          resume, compression_level, options, sharding, keep_parts)
 
-        flowdock_messages = get_flow_messages(flow_name, flow_param)
-        transform_and_write_messages(flowdock_messages, flow_param, flow_name, fd_uid_to_slack_user_map, fd_users_index, output_dir)
+    with run_metrics.stage('fetch'):
+        prefetch_flow_messages(flows)
 
-    write_json_file(generate_channels_list(flows), output_dir, 'channels.json')
+    output_dir = output_dir_prefix + strftime('%Y-%m-%d-%H-%M-%S', gmtime())
+    os.makedirs(output_dir, exist_ok=True)
+    write_json_file(slack_users, output_dir, 'users.json')
+    with run_metrics.stage('convert'):
+        flow_results = convert_flows(flow_jobs, fd_uid_to_slack_user_map, fd_users_index,
+                                     [output_dir] * len(flow_jobs), jobs, incremental, options)
+    add_flow_metrics(flow_results)
+    channel_names = [result['flow'] for result in flow_results if result['converted']]
+    write_json_file(generate_channels_list(channel_names), output_dir, 'channels.json')
 
     # zip everything up
-    shutil.make_archive(
-        base_name=output_path + '/latest',
-        format='zip',
-        root_dir=output_dir
-    )
+    with run_metrics.stage('package'):
+        shutil.make_archive(
+            base_name=output_path + '/latest',
+            format='zip',
+            root_dir=output_dir
+        )
+    remove_old_exports([output_path + '/latest.zip'])
+    if incremental:
+        commit_flow_states(flow_param for (source, flow_param, flow_name), result in zip(flow_jobs, flow_results)
+                           if result['converted'])
+    return True
+
+def add_flow_metrics(flow_results):
+    # The attachments are downloaded by the conversion, so they are counted
+    # per flow too
+    for flow_metrics in flow_results:
+        run_metrics.flows.append(flow_metrics)
+        for name in ('attachments_downloaded', 'attachments_failed'):
+            if name in flow_metrics:
+                run_metrics.count(name, flow_metrics[name])
+
+def commit_flow_states(flow_params):
+    # The new messages of these flows are in the export now, so the next
+    # incremental run can start after them, see incremental.py
+    for flow_param in flow_params:
+        commit_flow_state(state_dir, flow_param)
+
+def open_run_manifest(resume, incremental):
+    """
+    The manifest of the last run with resume, or of a new run, see runner.py
+    """
+    path = output_path + '/run-manifest.json'
+    old_manifest = RunManifest.load(path) if os.path.exists(path) else None
+    if resume and old_manifest:
+        if old_manifest.options.get('incremental') != incremental:
+            raise RuntimeError('Run %s has to be resumed %s --incremental' % (
+                old_manifest.run, 'with' if old_manifest.options.get('incremental') else 'without'))
+        print('Resuming run %s' % old_manifest.run)
+        return old_manifest
+
+    if old_manifest and os.path.isdir(old_manifest.parts_dir):
+        if all(entry['status'] in ('packaged', 'skipped') for entry in old_manifest.flows.values()):
+            print('Removing the parts kept from run %s' % old_manifest.run)
+        else:
+            print('Discarding the unfinished run %s, use --resume to continue one' % old_manifest.run)
+        shutil.rmtree(old_manifest.parts_dir)
+    timestamp = strftime('%Y-%m-%d-%H-%M-%S', gmtime())
+    return RunManifest(path, timestamp, '%s/parts-%s' % (output_path, timestamp), {'incremental': incremental})
+
+def run_export(flow_jobs, slack_users, fd_uid_to_slack_user_map, fd_users_index, jobs, incremental,
+               resume=False, compression_level=6, options=None, sharding=None, keep_parts=False):
+    """
+    Convert each flow into its own part and build the export from the parts,
+    recording the progress of every flow in the run manifest. Flows that fail
+    don't stop the others. Returns True when the export was built, False
+    when flows failed and the run has to be resumed.
+
+    The flows go through the stages of export_pipeline at the same time, so
+    the next flows are downloaded while one is converted. Without sharding
+    the parts are written into latest.zip as they are converted, with
+    sharding package_export builds the shards once all the parts are there.
+
+    The parts are always written, even when they aren't kept: they let the
+    flows be converted in worker processes, packaged while the next flow is
+    converted and picked up again by --resume. They are the only copy of the
+    days before the export: each day is written into its part once and read
+    once to deflate it into the export (see slack_export.ZipChannelWriter).
+    Their size is recorded as part_bytes in the metrics.
+    """
+    manifest = open_run_manifest(resume, incremental)
+    for flow_job in flow_jobs:
+        manifest.add_flow(*flow_job)
+    os.makedirs(manifest.parts_dir, exist_ok=True)
+    manifest.save()
+
+    entries = manifest.flows
+    writer = None
+    if not sharding:
+        writer = ShardWriter(output_path + '/latest.zip', json.dumps(slack_users, indent=output_indent),
+                             compression_level)
+    try:
+        with run_metrics.stage('pipeline'):
+            pipeline = export_pipeline(manifest, fd_uid_to_slack_user_map, fd_users_index, jobs, incremental,
+                                       options, writer)
+    except BaseException:
+        if writer:
+            writer.discard()
+        raise
+    report = pipeline.report()
+    print(format_report(report))
+    run_metrics.set('pipeline', report)
+
+    counts = manifest.counts()
+    if counts['failed']:
+        if writer:
+            # The parts stay for --resume, which writes them again
+            writer.discard()
+            for key in entries:
+                if entries[key]['status'] == 'written':
+                    manifest.set_status(key, 'converted', save=False)
+            manifest.save()
+        for entry in entries.values():
+            if entry['status'] == 'failed':
+                print('%s failed to %s: %s' % (entry['name'], entry['failed_stage'], entry['error']))
+        print('%d of %d flows failed, rerun with --resume to retry them' % (counts['failed'], len(entries)))
+        return False
+
+    converted = [key for key in entries if entries[key]['status'] != 'skipped']
+    flow_names = [entries[key]['name'] for key in converted]
+    if writer:
+        export_bytes = writer.close(json.dumps(generate_channels_list(flow_names), indent=output_indent))
+        remove_old_exports([writer.path])
+    else:
+        with run_metrics.stage('package'):
+            export_bytes = package_export([manifest.part_path(key) for key in converted], flow_names,
+                                          slack_users, compression_level, sharding, jobs)
+        for key in converted:
+            manifest.set_status(key, 'written', save=False)
+        manifest.save()
+    if incremental:
+        commit_flow_states(entries[key]['flow_param'] for key in converted)
+    run_metrics.set('part_bytes', sum(os.path.getsize(manifest.part_path(key)) for key in converted))
+    if not keep_parts:
+        shutil.rmtree(manifest.parts_dir)
+    for key in converted:
+        manifest.set_status(key, 'packaged', save=False)
+    manifest.save()
+
+    add_flow_metrics(entry['metrics'] for entry in entries.values())
+    run_metrics.set('export_bytes', export_bytes)
+    return True
+
+def package_export(part_paths, flow_names, slack_users, compression_level=6, sharding=None, jobs=1):
+    """
+    Build output/latest-<n>.zip from the parts of the flows, as set by
+    sharding ({'mode', 'max_bytes', 'period'}, see shards.py), and the index
+    output/latest-shards.json. Without sharding it's just output/latest.zip.
+    Returns the size of the zips.
+    """
+    users_json = json.dumps(slack_users, indent=output_indent)
+    channels = generate_channels_list(flow_names)
+    days = [day for part_path in part_paths for day in part_days(part_path)]
+
+    if not sharding:
+        size = build_shard(output_path + '/latest.zip', days, users_json,
+                           json.dumps(channels, indent=output_indent), compression_level)
+        remove_old_exports([output_path + '/latest.zip'])
+        return size
+
+    def channels_json_for(channel_names):
+        names = set(channel_names)
+        return json.dumps([channel for channel in channels if channel['name'] in names], indent=output_indent)
+
+    shards = plan_shards(days, sharding['mode'], sharding.get('max_bytes'), sharding.get('period', 'year'))
+    paths = ['%s/latest-%d.zip' % (output_path, count) for count in range(1, len(shards) + 1)]
+    sizes = build_shards(paths, shards, users_json, channels_json_for, compression_level, jobs)
+    dump_json_file(shard_index(paths, shards, sizes), output_path + '/latest-shards.json', indent=4)
+    remove_old_exports(paths + [output_path + '/latest-shards.json'])
+    print('Wrote %d shards of %s' % (len(shards), ', '.join('%.1f MB' % (size / (1 << 20)) for size in sizes)))
+    return sum(sizes)
+
+def remove_old_exports(keep):
+    """
+    Remove the export zips and shard index in the output directory which
+    aren't in keep, the files of the export just built. Otherwise a sharded
+    run would leave the latest.zip of an unsharded one next to its shards,
+    or the other way round, and the import could pick up the stale one.
+    """
+    for file in os.listdir(output_path):
+        path = '%s/%s' % (output_path, file)
+        if re.fullmatch(r'latest(-\d+)?\.zip|latest-shards\.json', file) and path not in keep:
+            os.remove(path)
+
+def tmp_part_path(part_path):
+    # Still ends with .zip, so convert_flow writes a zip file
+    return part_path[:-len('.zip')] + '.tmp.zip'
+
+def export_pipeline(manifest, fd_uid_to_slack_user_map, fd_users_index, jobs, incremental, options=None,
+                    writer=None):
+    """
+    Run the flows of manifest through the stages of a pipeline (see
+    pipeline.py), recording each one in the manifest as it goes:
+
+     - fetch: download the API flows that aren't cached yet, a few at a time
+       over one session (see flowdock_fetch.FlowFetcher)
+     - convert: convert each flow into its part, at most jobs at a time,
+       downloading its files as it goes with attachments_dir set
+     - package: with writer (a ShardWriter), add the parts to it in the
+       order of the manifest
+
+    Flows which already have their part only go through package. Returns the
+    pipeline, for its report.
+    """
+    entries = manifest.flows
+    to_convert = set(manifest.to_convert())
+    progress = Progress('flows', len(to_convert), unit='flows') if jobs > 1 else None
+    progress_lock = threading.Lock()
+    executor = None
+    fetcher = None
+
+    def fetch(key):
+        entry = entries[key]
+        if key in to_convert:
+            try:
+                if entry['source'] == 'api':
+                    fetch_flow(entry['name'], entry['flow_param'], fetcher)
+                manifest.set_status(key, 'fetched')
+            except Exception as e:
+                manifest.fail(key, 'fetch', e)
+        return key
+
+    def convert(key):
+        entry = entries[key]
+        if key not in to_convert or entry['status'] != 'fetched':
+            return key
+        manifest.attempt(key)
+        part_path = manifest.part_path(key)
+        flow_job = (entry['source'], entry['flow_param'], entry['name'], tmp_part_path(part_path), incremental)
+        try:
+            if executor:
+                flow_metrics, cache_stats = executor.submit(convert_flow_in_worker, *flow_job).result()
+                api_cache.add_stats(cache_stats)
+            else:
+                flow_metrics = convert_flow(*flow_job)
+        except Exception as e:
+            manifest.fail(key, 'convert', e)
+            if os.path.exists(tmp_part_path(part_path)):
+                os.remove(tmp_part_path(part_path))
+        else:
+            # Only complete parts get their final name
+            os.replace(tmp_part_path(part_path), part_path)
+            manifest.set_status(key, 'converted' if flow_metrics['converted'] else 'skipped', metrics=flow_metrics)
+        if progress:
+            with progress_lock:
+                progress.update(progress.done + 1)
+        return key
+
+    in_order = InOrder(entries)
+    def package(key):
+        for ready in in_order.add(key):
+            if manifest.reached(ready, 'converted'):
+                writer.add_part(manifest.part_path(ready))
+                manifest.set_status(ready, 'written')
+
+    pipeline = Pipeline()
+    pipeline.add_stage('fetch', fetch, workers=config.get('fetch_concurrency', 4),
+                       queue_size=config.get('fetch_concurrency', 4))
+    pipeline.add_stage('convert', convert, workers=jobs, queue_size=jobs)
+    if writer:
+        pipeline.add_stage('package', package, queue_size=jobs * 2)
+
+    def run_pipeline():
+        # The fetcher has a thread of its own too, so it starts here
+        nonlocal fetcher
+        if any(entries[key]['source'] == 'api' for key in to_convert):
+            from flowdock_fetch import FlowFetcher
+            fetcher = FlowFetcher(config['flowdock_token'], flowdock_org, cache_dir, flowdock_url,
+                                  config.get('fetch_concurrency', 4))
+        try:
+            pipeline.run(list(entries))
+        finally:
+            if fetcher:
+                fetcher.close()
+
+    if jobs == 1:
+        init_convert_worker(fd_uid_to_slack_user_map, fd_users_index, dict(options or {}, progress=True))
+        run_pipeline()
+        return pipeline
+
+    with ProcessPoolExecutor(max_workers=jobs,
+                             initializer=init_convert_worker,
+                             initargs=(fd_uid_to_slack_user_map, fd_users_index, options, config)) as executor:
+        # Fork all the workers before the pipeline starts its threads, a
+        # process forked while other threads hold locks can hang
+        list(executor.map(int, range(jobs)))
+        run_pipeline()
+    if progress:
+        progress.finish()
+    return pipeline
+
+def convert_flows(flow_jobs, fd_uid_to_slack_user_map, fd_users_index, outputs, jobs, incremental, options=None):
+    """
+    Transform the messages from each flow to a Slack channel, writing flow
+    number n to outputs[n]. Returns the result of convert_flow for each flow.
+    """
+    if jobs > 1:
+        # The user maps are read-only, so hand them to each worker once when it
+        # starts instead of pickling them for every flow. With the default fork
+        # start method they aren't copied at all.
+        with ProcessPoolExecutor(max_workers=jobs,
+                                 initializer=init_convert_worker,
+                                 initargs=(fd_uid_to_slack_user_map, fd_users_index, options, config)) as executor:
+            futures = [executor.submit(convert_flow_in_worker, *flow_job, output, incremental)
+                       for flow_job, output in zip(flow_jobs, outputs)]
+            progress = Progress('flows', len(futures), unit='flows')
+            for done, future in enumerate(as_completed(futures), 1):
+                progress.update(done)
+            progress.finish()
+            results = []
+            for future in futures:
+                flow_metrics, cache_stats = future.result()
+                api_cache.add_stats(cache_stats)
+                results.append(flow_metrics)
+            return results
+
+    init_convert_worker(fd_uid_to_slack_user_map, fd_users_index, dict(options or {}, progress=True))
+    return [convert_flow(*flow_job, output, incremental) for flow_job, output in zip(flow_jobs, outputs)]
+
+# Read-only state shared by the conversion workers, see init_convert_worker
+worker_user_maps = {}
+worker_options = {} # progress, profile and trace_memory
+
+def init_convert_worker(fd_uid_to_slack_user_map, fd_users_index, options=None, worker_config=None):
+    # Forked workers have the configuration already, spawned ones get it here
+    if worker_config is not None:
+        configure(worker_config)
+    worker_user_maps['fd_uid_to_slack_user_map'] = fd_uid_to_slack_user_map
+    worker_user_maps['fd_users_index'] = fd_users_index
+    worker_options.clear()
+    worker_options.update(options or {})
+
+def flow_messages_loader(source, flow_param, flow_name):
+    """
+    Returns a function which returns a fresh iterable of the flow's messages
+    each time it is called. Exports are streamed from disk again, API flows
+    are only read from the cache once.
+    """
+    if source == 'export':
+        path = '%s/%s/messages.json' % (import_dir, flow_param)
+        return lambda: iter_json_array(path)
+    if staging:
+        get_flow_messages(flow_name, flow_param) # downloads the flow if needed
+        return lambda: staging.iter_messages(flow_param)
+    messages = get_flow_messages(flow_name, flow_param)
+    return lambda: messages
+
+def convert_flow_in_worker(*flow_job):
+    """
+    convert_flow in a worker process. Also returns what it added to the
+    cache statistics of the worker, for the parent to count.
+    """
+    before = dict(api_cache.stats)
+    flow_metrics = convert_flow(*flow_job)
+    return flow_metrics, {name: value - before[name] for name, value in api_cache.stats.items()}
+
+def convert_flow(source, flow_param, flow_name, output, incremental=False):
+    """
+    Convert one flow into a channel. Runs in a worker process when converting
+    in parallel. output is the export directory, an open zipfile.ZipFile, or
+    the path of a zip file to create for this flow.
+    Returns the metrics of the flow, with converted False if it was skipped.
+    """
+    if isinstance(output, str) and output.endswith('.zip'):
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_STORED) as zip_file:
+            return convert_flow(source, flow_param, flow_name, zip_file, incremental)
+
+    fd_uid_to_slack_user_map = worker_user_maps['fd_uid_to_slack_user_map']
+    fd_users_index = worker_user_maps['fd_users_index']
+
+    try:
+        if incremental:
+            flow_metrics = convert_new_flow_messages(source, flow_param, flow_name, fd_uid_to_slack_user_map, fd_users_index, output)
+        else:
+            flow_metrics = transform_and_write_messages(flow_messages_loader(source, flow_param, flow_name)(),
+                                                        flow_param, flow_name, fd_uid_to_slack_user_map, fd_users_index, output)
+    except FileNotFoundError:
+        if source != 'export':
+            raise
+        print('Could not find downloaded messages for %s' % flow_name)
+        flow_metrics = None
+
+    if not flow_metrics:
+        return {'flow': flow_name, 'converted': False}
+    print('Converted %(flow)s: %(messages_in)d messages in %(seconds).1fs (%(messages_per_second)d/s)' % flow_metrics)
+    return flow_metrics
+
+def convert_new_flow_messages(source, flow_param, flow_name, fd_uid_to_slack_user_map, fd_users_index, output):
+    """
+    Convert only the messages that arrived since the last run, and the threads
+    they touch, see incremental.py. Returns the metrics of the flow, or None if
+    there was nothing new.
+    """
+    load_messages = flow_messages_loader(source, flow_param, flow_name)
+    state = load_flow_state(state_dir, flow_param)
+    new_messages = NewMessages(load_messages(), state)
+    try:
+        first_message = next(iter(new_messages), None)
+    except StaleStateError as e:
+        print('%s, converting %s from scratch' % (e, flow_name))
+        state = None
+        new_messages = NewMessages(load_messages())
+        first_message = next(iter(new_messages), None)
+
+    if first_message is None:
+        print('No new messages in %s' % flow_name)
+        return None
+
+    # Again from the start, this one describes the state to save
+    new_messages = NewMessages(load_messages(), state)
+    threads = open_flow_threads(state_dir, flow_param, state, thread_cache_size)
+    flow_metrics = transform_and_write_messages(new_messages, flow_param, flow_name,
+                                                fd_uid_to_slack_user_map, fd_users_index, output, threads)
+
+    save_flow_state(state_dir, flow_param, {
+        'last_id': new_messages.last_id,
+        'count': new_messages.count,
+        'hash': new_messages.hexdigest()
+    }, threads)
+    return flow_metrics
+
+def channel_messages(flowdock_messages, flow_param, fd_uid_to_slack_user_map, fd_users_index, threads):
+    """
+    The (message, parent) pairs of a channel, followed by the parents from an
+    earlier run which got new replies and have to be written again.
+    threads is the ThreadIndex to convert with.
+    """
+    yield from iter_fd_messages_to_slack(flowdock_messages, flow_param, fd_uid_to_slack_user_map, fd_users_index, threads)
+
+    for parent in threads.touched_old_parents():
+        # Long messages which start a thread are only written as their parts
+        if len(parent.text) <= slack_message_max_length:
+            yield parent, None
+
+def count_items(items, counts, key):
+    for item in items:
+        counts[key] += 1
+        yield item
+
+def transform_and_write_messages(flowdock_messages, flow_param, flow_name, fd_uid_to_slack_user_map, fd_users_index, output, threads=None):
+    """
+    Convert flowdock_messages into the channel of the flow in output, a
+    directory or an open zipfile.ZipFile.
+    threads is the ThreadIndex to continue, by default a new temporary one.
+    Returns the metrics of the flow.
+    """
+    channel_name = export_channel_prefix + flow_name
+    temporary_threads = threads is None
+    if temporary_threads:
+        threads = ThreadIndex(cache_size=thread_cache_size)
+    flow_metrics = {
+        'flow': flow_name,
+        'converted': True,
+        'messages_in': 0, # Flowdock messages
+        'messages_out': 0 # Slack messages
+    }
+    start = time.perf_counter()
+
+    if isinstance(output, zipfile.ZipFile):
+        writer = ZipChannelWriter(output, channel_name, threads, indent=output_indent)
+    else:
+        # make a directory per channel
+        channel_dir = '%s/%s' % (output, channel_name)
+        os.mkdir(channel_dir)
+        writer = ChannelWriter(channel_dir, threads, indent=output_indent)
+
+    total = len(flowdock_messages) if hasattr(flowdock_messages, '__len__') else None
+    progress = Progress(flow_name, total) if worker_options.get('progress') else None
+    fetcher = None
+    if attachments:
+        # The files are downloaded while the messages are read, a little
+        # ahead of converting them
+        from attachments import AttachmentFetcher, with_attachments
+        fetcher = AttachmentFetcher(attachments, flowdock_url, config['flowdock_token'],
+                                    config.get('attachments_concurrency', 8))
+        flowdock_messages = with_attachments(flowdock_messages, fetcher)
+    flowdock_messages = count_items(flowdock_messages, flow_metrics, 'messages_in')
+
+    # write the messages into one file per day as we convert them
+    write_seconds = 0.0
+    profile_name = '%s/profile-%s' % (output_path, flow_param)
+    try:
+        with profiled(profile_name, worker_options.get('profile'), worker_options.get('trace_memory'), flow_metrics):
+            for sm, parent in channel_messages(flowdock_messages, flow_param, fd_uid_to_slack_user_map, fd_users_index, threads):
+                write_start = time.perf_counter()
+                writer.write(sm, parent)
+                write_seconds += time.perf_counter() - write_start
+                flow_metrics['messages_out'] += 1
+                if progress and flow_metrics['messages_out'] % 1000 == 0:
+                    progress.update(flow_metrics['messages_in'])
+            write_start = time.perf_counter()
+            days = writer.close()
+            write_seconds += time.perf_counter() - write_start
+    finally:
+        if fetcher:
+            fetcher.close()
+    if fetcher:
+        flow_metrics['attachments_downloaded'] = fetcher.counts['downloaded']
+        flow_metrics['attachments_failed'] = fetcher.counts['failed']
+        if fetcher.counts['downloaded'] or fetcher.counts['failed']:
+            print('Attachments of %s: %d files, %d downloaded, %d failed' % (
+                flow_name, len(fetcher.futures), fetcher.counts['downloaded'], fetcher.counts['failed']))
+    if progress:
+        progress.update(flow_metrics['messages_in'])
+        progress.finish()
+    thread_count = len(threads)
+    if temporary_threads:
+        threads.close()
+
+    seconds = time.perf_counter() - start
+    flow_metrics.update({
+        'seconds': round(seconds, 3),
+        'write_seconds': round(write_seconds, 3),
+        'messages_per_second': round(flow_metrics['messages_in'] / seconds) if seconds else 0,
+        'bytes_written': writer.bytes_written,
+        'threads': thread_count,
+        'days': len(days)
+    })
+    return flow_metrics
+
+def add_package_arguments(parser):
+    parser.add_argument('--shard-by', choices=shard_modes,
+                        help='split the export into output/latest-<n>.zip by flow, date or size, '
+                             'listed in output/latest-shards.json')
+    parser.add_argument('--shard-size', type=int, metavar='MB',
+                        help='max uncompressed size of a shard, for --shard-by size (default: 1000) or flow')
+    parser.add_argument('--shard-period', choices=('year', 'month'), default='year',
+                        help='the dates in a shard, for --shard-by date (default: year)')
+    parser.add_argument('--compression-level', type=int, default=6, choices=range(0, 10), metavar='0-9',
+                        help='deflate level of the export zip (default: 6)')
+
+def parse_args(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description='Convert Flowdock flows into a Slack export')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of flows to convert in parallel (default: 1)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only convert messages that are new since the last --incremental run')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the last run, only converting the flows it did not finish')
+    parser.add_argument('--keep-parts', action='store_true',
+                        help='keep the converted flows after building the export, to package them again')
+    add_package_arguments(parser)
+    parser.add_argument('--output-dir', action='store_true',
+                        help='also write the export as an output/slack-export-<timestamp> directory, for debugging')
+    parser.add_argument('--profile', action='store_true',
+                        help='run the transform of each flow under cProfile, saved as output/profile-<flow>.prof')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='trace memory allocations of the transform with tracemalloc (slow)')
+    return parser.parse_args(argv)
+
+def sharding_options(args):
+    if not args.shard_by:
+        return None
+    shard_size = args.shard_size or (1000 if args.shard_by == 'size' else None)
+    return {
+        'mode': args.shard_by,
+        'max_bytes': shard_size << 20 if shard_size else None,
+        'period': args.shard_period
+    }
+
+def main(argv=None, prog=None):
+    args = parse_args(argv, prog)
+    configure(load_configuration())
+    with run_metrics.stage('users'):
+        slack_users = get_slack_users()
+        flowdock_users = get_flowdock_users()
+        fd_uid_to_slack_user_map = build_fd_uid_to_slack_user_map(flowdock_users, slack_users)
+        fd_users_index = build_fd_users_index(flowdock_users, slack_users)
+    completed = migrate_flows_to_slack_format(slack_users, fd_uid_to_slack_user_map, fd_users_index,
+                                              jobs=args.jobs, incremental=args.incremental,
+                                              write_directory=args.output_dir, compression_level=args.compression_level,
+                                              options={'profile': args.profile, 'trace_memory': args.trace_memory},
+                                              resume=args.resume, sharding=sharding_options(args),
+                                              keep_parts=args.keep_parts)
+    print('Cache: %(hits)d hits, %(misses)d misses (%(stale)d stale), %(writes)d writes, %(evictions)d evictions' % api_cache.stats)
+
+    from flowdock_fetch import request_stats
+    run_metrics.set('cache', api_cache.stats)
+    run_metrics.set('flowdock_api', request_stats)
+    run_metrics.write(output_path + '/latest-metrics.json')
+    if not completed:
+        sys.exit(1)
+
+def package_run(sharding=None, compression_level=6, jobs=1, skip_failed=False):
+    """
+    Build the export again from the parts of the last run, e.g. sharded
+    differently. The parts are only there until the run is packaged, unless
+    it was converted with --keep-parts. With skip_failed the flows without a
+    part are left out, otherwise they have to be converted first.
+    """
+    path = output_path + '/run-manifest.json'
+    if not os.path.exists(path):
+        raise RuntimeError('There is no run to package, convert the flows first')
+    manifest = RunManifest.load(path)
+    if not os.path.isdir(manifest.parts_dir):
+        raise RuntimeError('The parts of run %s are gone, convert with --keep-parts to package a run again'
+                           % manifest.run)
+    entries = manifest.flows
+    keys = [key for key in entries if entries[key]['status'] != 'skipped']
+    converted = [key for key in keys if manifest.reached(key, 'converted') and os.path.exists(manifest.part_path(key))]
+    if len(converted) < len(keys):
+        if not skip_failed:
+            raise RuntimeError('%d flows of run %s are not converted, convert --resume them or use --skip-failed'
+                               % (len(keys) - len(converted), manifest.run))
+        print('Leaving out %s' % ', '.join(entries[key]['name'] for key in keys if key not in converted))
+
+    export_bytes = package_export([manifest.part_path(key) for key in converted],
+                                  [entries[key]['name'] for key in converted],
+                                  get_slack_users(), compression_level, sharding, jobs)
+    for key in converted:
+        if not manifest.reached(key, 'written'):
+            manifest.set_status(key, 'written', save=False)
+    manifest.save()
+    if manifest.options.get('incremental'):
+        commit_flow_states(entries[key]['flow_param'] for key in converted)
+    print('Packaged %d flows of run %s, %.1f MB' % (len(converted), manifest.run, export_bytes / (1 << 20)))
+
+def package_main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description='Build the export again from the converted flows of '
+                                                            'the last run')
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='number of shards to build in parallel (default: 1)')
+    parser.add_argument('--skip-failed', action='store_true',
+                        help='leave out the flows which failed or are not converted yet')
+    add_package_arguments(parser)
+    args = parser.parse_args(argv)
+    configure(load_configuration())
+    package_run(sharding_options(args), args.compression_level, args.jobs, args.skip_failed)
 
-def transform_and_write_messages(flowdock_messages, flow_param, flow_name, fd_uid_to_slack_user_map, fd_users_index, output_dir):
-    slack_messages = transform_fd_messages_to_slack(flowdock_messages, flow_param, fd_uid_to_slack_user_map, fd_users_index)
-    # make a directory per channel
-    channel_dir = '%s/%s%s' % (output_dir, export_channel_prefix, flow_name)
-    os.mkdir(channel_dir)
-    # write the messages into the channel directory
-    write_json_file(slack_messages, channel_dir, 'messages.json')
-
-def main():
-    slack_users = get_slack_users()
-    flowdock_users = get_flowdock_users()
-    fd_uid_to_slack_user_map = build_fd_uid_to_slack_user_map(flowdock_users, slack_users)
-    fd_users_index = build_fd_users_index(flowdock_users, slack_users)
-    migrate_flows_to_slack_format(slack_users, fd_uid_to_slack_user_map, fd_users_index)
-    
 if __name__ == '__main__':
     main()
 
 """
 TODO:
- - Handle attachements?
  - Reaction emojis - did this but Slack can't import it's own exports!
 """
@@ -3,25 +3,187 @@ Downloads all the Flowdock emoji's
 I found the list of emojis using the Chome dev tools, there isn't much point
 in reverse engineering the Flowdock API to get the list.
 
+Emojis are downloaded several at a time over one pooled connection, with
+retries when the server has a problem. The ETag / Last-Modified of every
+emoji is kept in <output>/emoji-state.json, so running this again only asks
+whether they changed. Files whose content no longer matches the stored hash
+(partial or corrupt) are downloaded again. Emojis with the same image are
+stored once and become aliases of the first one.
+
 Once you've got all the emoji's in a directory upload to slack using:
   https://github.com/smartlyio/slack-emojinator/tree/fix_fetch_api_tokens
+<output>/emoji-manifest.json lists the files to upload and the aliases to add.
+
+Usage: python cli.py emoji --emojis test/flowdock-emojis.json --output output/emojis
 """
-import wget
-import os
+import argparse
+import asyncio
+import hashlib
 import json
+import os
+
+import aiohttp
+
+from metrics import Progress
+from slack_export import dump_json_file
 
-def get_flowdock_emojis():
-    return load_json_file('test/flowdock-emojis.json')
+max_retries = 5
+
+image_types = [(b'\x89PNG', 'png'), (b'GIF8', 'gif'), (b'\xff\xd8\xff', 'jpg')]
 
 def load_json_file(path):
     with open(path) as f:
         return json.load(f)
 
-fd_emojis = get_flowdock_emojis()
-for emoji in fd_emojis:
+def get_flowdock_emojis(path='test/flowdock-emojis.json'):
+    return load_json_file(path)
+
+def image_extension(content):
+    for magic, extension in image_types:
+        if content.startswith(magic):
+            return extension
+    return 'png'
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def write_file_atomic(path, content):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+def is_intact(output_dir, entry):
+    # The file we wrote last time is still there with the same content
+    path = '%s/%s' % (output_dir, entry.get('file', ''))
+    return 'sha256' in entry and os.path.isfile(path) and file_sha256(path) == entry['sha256']
+
+async def fetch_emoji(session, emoji, entry, output_dir, files_by_hash, intact=False):
+    """
+    Download one emoji unless it is unchanged. entry is its state from the
+    last run (url, etag, last_modified, sha256, file) and is updated in place,
+    intact tells whether its file was still good when the run started.
+    Returns 'downloaded', 'unchanged' or 'duplicate'.
+    """
     url = emoji['image_url']
-    out = 'output/%s.png' % emoji['id']
-    if not os.path.isfile(out):
-        wget.download(url, out=out)
+    headers = {}
+    if entry.get('url') == url and intact:
+        # Only conditional requests for files we know are good
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    delay = 1
+    for attempt in range(max_retries + 1):
+        try:
+            async with session.get(url, headers=headers) as r:
+                if r.status == 304:
+                    return 'unchanged'
+                if r.status == 429 or r.status >= 500:
+                    retry_after = r.headers.get('Retry-After')
+                    if attempt == max_retries:
+                        r.raise_for_status()
+                else:
+                    r.raise_for_status()
+                    content = await r.read()
+                    etag = r.headers.get('ETag')
+                    last_modified = r.headers.get('Last-Modified')
+                    break
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError):
+            # Also when the connection dropped half way through the image
+            if attempt == max_retries:
+                raise
+            retry_after = None
+        await asyncio.sleep(float(retry_after) if retry_after else delay)
+        delay *= 2
+
+    sha256 = hashlib.sha256(content).hexdigest()
+    entry.update({'url': url, 'etag': etag, 'last_modified': last_modified, 'sha256': sha256})
+
+    file = '%s.%s' % (emoji['id'], image_extension(content))
+    existing = files_by_hash.setdefault(sha256, file)
+    if existing != file:
+        # Same image as an emoji we already have
+        entry['file'] = existing
+        return 'duplicate'
+    entry['file'] = file
+    write_file_atomic('%s/%s' % (output_dir, file), content)
+    return 'downloaded'
+
+def build_manifest(emojis, state):
+    """
+    The first emoji with each image is uploaded, the others are aliases
+    """
+    manifest = {'emojis': [], 'aliases': []}
+    names_by_file = {}
+    for emoji in emojis:
+        entry = state.get(emoji['id'])
+        if not entry or 'file' not in entry:
+            continue
+        if entry['file'] in names_by_file:
+            manifest['aliases'].append({'name': emoji['id'], 'alias_for': names_by_file[entry['file']]})
+        else:
+            names_by_file[entry['file']] = emoji['id']
+            manifest['emojis'].append({'name': emoji['id'], 'file': entry['file']})
+    return manifest
+
+async def fetch_emojis(emojis, output_dir, concurrency=8):
+    """
+    Download emojis into output_dir. Returns the counts of each result.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    state_path = '%s/emoji-state.json' % output_dir
+    state = load_json_file(state_path) if os.path.exists(state_path) else {}
+
+    # Files from earlier runs that are still fine, so duplicates point to them.
+    # Checked once before downloading, so all the aliases of a corrupt file
+    # are downloaded again, also when the file was repaired in the meantime.
+    files_by_hash = {}
+    intact = set()
+    for emoji_id, entry in state.items():
+        if is_intact(output_dir, entry):
+            files_by_hash.setdefault(entry['sha256'], entry['file'])
+            intact.add(emoji_id)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    progress = Progress('emoji', len(emojis), 'emojis')
+    counts = {'downloaded': 0, 'unchanged': 0, 'duplicate': 0, 'failed': 0}
+
+    async def fetch_one(session, emoji):
+        async with semaphore:
+            entry = state.setdefault(emoji['id'], {})
+            try:
+                result = await fetch_emoji(session, emoji, entry, output_dir, files_by_hash,
+                                           emoji['id'] in intact)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print('Could not download %s: %s' % (emoji['id'], e))
+                result = 'failed'
+            counts[result] += 1
+            progress.update(progress.done + 1)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[fetch_one(session, emoji) for emoji in emojis])
+    progress.finish()
+
+    dump_json_file(state, state_path, indent=4)
+    dump_json_file(build_manifest(emojis, state), '%s/emoji-manifest.json' % output_dir, indent=4)
+    return counts
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description='Download the Flowdock emojis')
+    parser.add_argument('--emojis', default='test/flowdock-emojis.json', help='list of {id, image_url}')
+    parser.add_argument('--output', default='output', help='directory for the images (default: output)')
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args(argv)
 
+    counts = asyncio.run(fetch_emojis(get_flowdock_emojis(args.emojis), args.output, args.concurrency))
+    print('Emojis: %(downloaded)d downloaded, %(unchanged)d unchanged, %(duplicate)d duplicates, %(failed)d failed' % counts)
 
+if __name__ == '__main__':
+    main()
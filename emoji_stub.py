@@ -0,0 +1,211 @@
+"""
+A local stand-in for the server of the Flowdock emoji images, with ETag and
+Last-Modified headers and 304 answers to conditional requests like a CDN,
+so downloading the emojis can be tried without Flowdock.
+
+Every fifth emoji has the same image as an earlier one. Downloads can be made
+to fail: with --rate-limit-every n the first request for every nth emoji
+gets a 429, with --error-every the next one a 503 and with --drop-every the
+next one is cut off half way through the image. The request after that works.
+
+Usage: python emoji_stub.py --emojis 500 --list output/stub-emojis.json --port 8903
+and then: python cli.py emoji --emojis output/stub-emojis.json --output output/emojis
+
+python emoji_stub.py --check downloads emojis from the stub with emoji.py and
+checks that failures are retried, that a second run only makes conditional
+requests and that a corrupt file is downloaded again.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import emoji
+
+image_magic = [b'\x89PNG\r\n\x1a\n', b'GIF89a', b'\xff\xd8\xff\xe0']
+last_modified = 'Wed, 01 Apr 2020 12:00:00 GMT'
+
+def build_images(count, seed=0):
+    """
+    emoji id -> image content
+    """
+    rng = random.Random(seed)
+    images = {}
+    for number in range(count):
+        if number % 5 == 4:
+            images['emoji%d' % number] = images['emoji%d' % rng.randrange(number - 1)]
+        else:
+            images['emoji%d' % number] = rng.choice(image_magic) + bytes(rng.getrandbits(8) for _ in range(200))
+    return images
+
+def etag(content):
+    return '"%s"' % hashlib.sha256(content).hexdigest()[:16]
+
+class EmojiHandler(BaseHTTPRequestHandler):
+    images = {}
+    rate_limit_every = 0
+    error_every = 0
+    drop_every = 0
+    numbers = {} # emoji id -> its number, counting from 1
+    attempts = {} # emoji id -> requests for it so far
+    conditional = 0 # requests with If-None-Match or If-Modified-Since
+    downloads = {} # emoji id -> times its image was sent
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, content=b'', headers=None, cut=False):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if cut:
+            self.wfile.write(content[:len(content) // 2])
+            self.close_connection = True
+        else:
+            self.wfile.write(content)
+
+    def failure(self, emoji_id):
+        # The failure due for this request of the emoji, if any
+        handler = EmojiHandler
+        attempt = handler.attempts[emoji_id] = handler.attempts.get(emoji_id, 0) + 1
+        due = [failure for failure, every in (('rate_limit', handler.rate_limit_every),
+                                              ('error', handler.error_every),
+                                              ('drop', handler.drop_every))
+               if every and handler.numbers[emoji_id] % every == 0]
+        return due[attempt - 1] if attempt <= len(due) else None
+
+    def do_GET(self):
+        handler = EmojiHandler
+        match = re.fullmatch(r'/emojis/([^/]+)', self.path)
+        if not match or match.group(1) not in self.images:
+            return self.send(404)
+        failure = self.failure(match.group(1))
+        if failure == 'rate_limit':
+            return self.send(429, headers={'Retry-After': '0'})
+        if failure == 'error':
+            return self.send(503, headers={'Retry-After': '0'})
+
+        content = self.images[match.group(1)]
+        if 'If-None-Match' in self.headers or 'If-Modified-Since' in self.headers:
+            handler.conditional += 1
+            if self.headers.get('If-None-Match') == etag(content) or \
+                    self.headers.get('If-Modified-Since') == last_modified:
+                return self.send(304)
+
+        handler.downloads[match.group(1)] = handler.downloads.get(match.group(1), 0) + 1
+        self.send(200, content, {'Content-Type': 'image/png', 'ETag': etag(content),
+                                 'Last-Modified': last_modified}, failure == 'drop')
+
+def emoji_list(base_url, images):
+    return [{'id': emoji_id, 'image_url': '%s/emojis/%s' % (base_url, emoji_id)} for emoji_id in images]
+
+def serve(port):
+    """
+    Start the stub in a background thread. Returns the server, port 0 picks
+    a free one.
+    """
+    server = ThreadingHTTPServer(('localhost', port), EmojiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def set_failures(rate_limit_every=0, error_every=0, drop_every=0):
+    EmojiHandler.rate_limit_every = rate_limit_every
+    EmojiHandler.error_every = error_every
+    EmojiHandler.drop_every = drop_every
+    EmojiHandler.numbers = {emoji_id: number for number, emoji_id in enumerate(EmojiHandler.images, 1)}
+    EmojiHandler.attempts = {}
+    EmojiHandler.conditional = 0
+    EmojiHandler.downloads = {}
+
+def check():
+    """
+    Download emojis from the stub and check the retries and conditional
+    refreshes of emoji.py
+    """
+    EmojiHandler.images = build_images(40)
+    server = serve(0)
+    emojis = emoji_list('http://localhost:%d' % server.server_address[1], EmojiHandler.images)
+    output_dir = tempfile.mkdtemp()
+    try:
+        def fetch():
+            return asyncio.run(emoji.fetch_emojis(emojis, output_dir, concurrency=4))
+
+        def assert_intact():
+            # Every file to upload has the image of its emoji
+            manifest = emoji.load_json_file('%s/emoji-manifest.json' % output_dir)
+            for entry in manifest['emojis']:
+                with open('%s/%s' % (output_dir, entry['file']), 'rb') as f:
+                    assert f.read() == EmojiHandler.images[entry['name']], '%s is not intact' % entry['file']
+            return manifest
+
+        # Rate limits, server errors and dropped connections are retried
+        set_failures(rate_limit_every=2, error_every=3, drop_every=5)
+        counts = fetch()
+        assert counts['failed'] == 0, '%d emojis failed' % counts['failed']
+        assert counts['downloaded'] == 32 and counts['duplicate'] == 8, counts
+        manifest = assert_intact()
+        assert len(manifest['aliases']) == 8, 'the duplicates are not aliases'
+        print('ok: 429, 503 and dropped connections are retried, duplicates are aliases')
+
+        # Nothing changed, so a second run only makes conditional requests
+        set_failures()
+        counts = fetch()
+        assert counts['unchanged'] == 40 and not EmojiHandler.downloads, counts
+        print('ok: a second run gets a 304 for all %d emojis' % EmojiHandler.conditional)
+
+        # A corrupt file doesn't match its hash and is downloaded again
+        aliases = {}
+        for alias in manifest['aliases']:
+            aliases.setdefault(alias['alias_for'], []).append(alias['name'])
+        corrupt = next(entry for entry in manifest['emojis'] if entry['name'] in aliases)
+        with open('%s/%s' % (output_dir, corrupt['file']), 'wb') as f:
+            f.write(b'corrupt')
+        set_failures()
+        counts = fetch()
+        # and so are its aliases, which point to the same file, while all
+        # the others only get a 304
+        names = [corrupt['name']] + aliases[corrupt['name']]
+        assert sorted(EmojiHandler.downloads) == sorted(names), EmojiHandler.downloads
+        assert counts['unchanged'] == 40 - len(names) and counts['failed'] == 0, counts
+        assert_intact()
+        print('ok: the corrupt %s was downloaded again for %s' % (corrupt['file'], ', '.join(names)))
+    finally:
+        server.shutdown()
+        shutil.rmtree(output_dir)
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve fake Flowdock emoji images')
+    parser.add_argument('--emojis', type=int, default=100, help='how many emojis to serve')
+    parser.add_argument('--list', default='output/stub-emojis.json',
+                        help='where to write the list of emojis for emoji.py --emojis')
+    parser.add_argument('--rate-limit-every', type=int, default=0, help='answer the first request for every nth emoji with a 429')
+    parser.add_argument('--error-every', type=int, default=0, help='then a 503')
+    parser.add_argument('--drop-every', type=int, default=0, help='then cut off the image half way')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--port', type=int, default=8903)
+    parser.add_argument('--check', action='store_true',
+                        help='check the retries and refreshes of emoji.py against the stub and exit')
+    args = parser.parse_args()
+
+    if args.check:
+        return check()
+
+    EmojiHandler.images = build_images(args.emojis, args.seed)
+    set_failures(args.rate_limit_every, args.error_every, args.drop_every)
+    os.makedirs(os.path.dirname(os.path.abspath(args.list)), exist_ok=True)
+    with open(args.list, 'w') as f:
+        json.dump(emoji_list('http://localhost:%d' % args.port, EmojiHandler.images), f, indent=4)
+    print('Serving %d emojis on http://localhost:%d, listed in %s' % (args.emojis, args.port, args.list))
+    ThreadingHTTPServer(('localhost', args.port), EmojiHandler).serve_forever()
+
+if __name__ == '__main__':
+    main()
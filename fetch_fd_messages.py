@@ -1,56 +1,81 @@
+import argparse
 import os
-from remotezip import RemoteZip
-import mechanicalsoup
 import re
-import yaml
+from concurrent.futures import ThreadPoolExecutor
+
+from ranged_zip import extract_member
 
 '''
 Download the messages.json files from the huge zip archives Flowdock provides.
+
+Several archives are fetched at the same time, and within an archive
+messages.json is downloaded in parallel ranges, see ranged_zip.py. Running
+this again resumes interrupted downloads.
+
+Usage: python cli.py fetch --archives 4 --connections 8
 '''
 
 def load_configuration():
+    import yaml
     with open(config_file) as f:
         return yaml.safe_load(f)
 
 config_file = 'config.yml'
-config = load_configuration()
 
-# First get a list of URLs from export emails
 email_dir = 'input/emails/'
-emails = os.listdir(email_dir)
-fd_exports = []
-for email in emails:
-	with open(email_dir + email) as f:
-		email_content = f.read()
-		regex = r"(https://www.flowdock.com.*)=\n(.*)=\n(.*)\?"
-		results = re.findall(regex, email_content)[0]
-		url = ''.join(results)
-		fd_exports.append(url)
-
 download_dir = 'input/exports'
 login_url = 'https://www.flowdock.com/login'
-fd_username = config['flowdock_user']
-fd_password = config['flowdock_password']
+flow_name_regex = r"/([a-zA-Z-]+)-2020-"
 
-# To download the zip files we need to authenticate
-browser = mechanicalsoup.StatefulBrowser()
+def get_export_urls():
+    # Get the list of URLs from the export emails
+    fd_exports = []
+    for email in os.listdir(email_dir):
+        with open(email_dir + email) as f:
+            email_content = f.read()
+            regex = r"(https://www.flowdock.com.*)=\n(.*)=\n(.*)\?"
+            results = re.findall(regex, email_content)[0]
+            fd_exports.append(''.join(results))
+    return fd_exports
 
-browser.open(login_url)
-login_form = browser.select_form() 
+def login(fd_username, fd_password):
+    # To download the zip files we need to authenticate
+    import mechanicalsoup
+    browser = mechanicalsoup.StatefulBrowser()
 
-browser['user_session[email]'] = fd_username
-browser['user_session[password]'] = fd_password
+    browser.open(login_url)
+    browser.select_form()
 
-login_response = browser.submit_selected()
-request_headers = login_response.request.headers
+    browser['user_session[email]'] = fd_username
+    browser['user_session[password]'] = fd_password
 
-flow_name_regex = r"/([a-zA-Z-]+)-2020-"
+    login_response = browser.submit_selected()
+    # Only the cookies etc, the ranges are set per request
+    return {name: value for name, value in login_response.request.headers.items()
+            if name.lower() not in ('content-length', 'content-type', 'range')}
+
+def fetch_export(fd_export, request_headers, chunk_executor):
+    flow_name = re.findall(flow_name_regex, fd_export)[0]
+    output_path = '%s/%s/messages.json' % (download_dir, flow_name)
+    size = extract_member(fd_export, 'messages.json', output_path, request_headers, chunk_executor)
+    print('%s: %d MB' % (flow_name, size >> 20))
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description='Download messages.json from the Flowdock export archives')
+    parser.add_argument('--archives', type=int, default=4, help='archives to download at the same time')
+    parser.add_argument('--connections', type=int, default=8, help='range requests in flight in total')
+    args = parser.parse_args(argv)
+
+    config = load_configuration()
+    fd_exports = get_export_urls()
+    request_headers = login(config['flowdock_user'], config['flowdock_password'])
 
-for fd_export in fd_exports:
-	print(fd_export)
-	flow_name = re.findall(flow_name_regex, fd_export)[0]
-	zip = RemoteZip(fd_export, headers=request_headers)
-	messages_file = zip.getinfo('messages.json')
-	output_dir = '%s/%s/' % (download_dir, flow_name)
-	zip.extract(messages_file, output_dir)
+    with ThreadPoolExecutor(args.connections) as chunk_executor, \
+            ThreadPoolExecutor(args.archives) as archive_executor:
+        futures = [archive_executor.submit(fetch_export, fd_export, request_headers, chunk_executor)
+                   for fd_export in fd_exports]
+        for future in futures:
+            future.result()
 
+if __name__ == '__main__':
+    main()
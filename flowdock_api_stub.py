@@ -0,0 +1,361 @@
+"""
+A local stand-in for the Flowdock API, serving flows of synthetic messages
+(see synthetic_flowdock.py) with since_id pagination like the real one, so
+downloading flows can be tried and timed without an organization.
+
+The files of the file messages are served at their path with Range
+support, every seventh one with the same content as the file before it.
+
+Pages and files can be made to fail: with --rate-limit-every n the first
+request for every nth page of a flow or every nth file gets a 429, with
+--error-every the next one a 503 and with --drop-every the next one is cut
+off half way through, like a network problem during a download. The request
+after that works.
+
+Usage: python flowdock_api_stub.py --flows general,random --messages 5000 --port 8902
+and in config.yml: flowdock_api_url: http://localhost:8902
+
+python flowdock_api_stub.py --check downloads flows from the stub with
+flowdock_fetch and checks that rate limits, errors and dropped connections
+are retried, and that a download which keeps failing resumes from its
+checkpoint. It does the same for attachments.py, and checks that a partial
+file is continued with a Range request and that verify() drops corrupt
+files.
+"""
+import argparse
+import bisect
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import attachments
+import flowdock_fetch
+from synthetic_flowdock import generate_flowdock_users, generate_messages
+
+max_limit = 100
+
+def build_flows(flow_params, messages, users, seed=0):
+    flowdock_users = generate_flowdock_users(users, seed)
+    return {flow_param: list(generate_messages(messages, flowdock_users, flow=flow_param, seed=seed))
+            for flow_param in flow_params}
+
+def build_files(flows):
+    """
+    path -> content of the files posted in flows. Every seventh file has
+    the content of the one before it, like a screenshot posted twice.
+    """
+    paths = dict.fromkeys(path for messages in flows.values() for path in attachments.file_paths(messages))
+    files = {}
+    for number, path in enumerate(paths, 1):
+        seed = number - 1 if number % 7 == 0 else number
+        block = hashlib.sha256(b'%d' % seed).digest()
+        files[path] = block * (100 + seed * 7919 % 2000) # 3 to 67 kB
+    return files
+
+class FlowdockApiHandler(BaseHTTPRequestHandler):
+    org = 'stub'
+    flows = {} # flow_param -> messages
+    ids = {} # flow_param -> the ids of its messages
+    files = {} # path -> content
+    file_numbers = {} # path -> its number, counting from 1
+    ranges = True # answer Range requests, or always send the whole file
+    users = []
+    closed = set() # flows which have to be opened first
+    rate_limit_every = 0
+    error_every = 0
+    drop_every = 0
+    attempts = {} # (flow_param, page) or file path -> requests for it so far
+    since_ids = [] # (flow_param, since_id) of every page served
+    offsets = [] # (path, offset) of every file request with a Range
+    cut = False # close the connection half way through this answer
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        self.send(status, json.dumps(body).encode(), 'application/json; charset=utf-8', headers)
+
+    def send(self, status, content, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.cut:
+            self.wfile.write(content[:len(content) // 2])
+            self.close_connection = True
+        else:
+            self.wfile.write(content)
+
+    def failed(self, key, number):
+        # Answers the request with the failure due for this request of the
+        # page or file, if any. number is the page of the flow or the file
+        # number, counting from 1.
+        handler = FlowdockApiHandler
+        attempt = handler.attempts[key] = handler.attempts.get(key, 0) + 1
+        due = [failure for failure, every in (('rate_limit', handler.rate_limit_every),
+                                              ('error', handler.error_every),
+                                              ('drop', handler.drop_every))
+               if every and number % every == 0]
+        failure = due[attempt - 1] if attempt <= len(due) else None
+        self.cut = failure == 'drop'
+        if failure == 'rate_limit':
+            self.send_json(429, {'message': 'Too many requests'}, {'Retry-After': '0'})
+        elif failure == 'error':
+            self.send_json(503, {'message': 'Service unavailable'}, {'Retry-After': '0'})
+        return failure in ('rate_limit', 'error')
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        if url.path == '/flows/all':
+            return self.send_json(200, [{'name': flow_param.capitalize(), 'parameterized_name': flow_param}
+                                        for flow_param in self.flows])
+        if url.path == '/organizations/%s/users' % self.org:
+            return self.send_json(200, self.users)
+        if url.path in self.files:
+            return self.send_file(url.path)
+
+        match = re.fullmatch(r'/flows/([^/]+)/([^/]+)(/messages)?', url.path)
+        if not match or match.group(1) != self.org or match.group(2) not in self.flows:
+            return self.send_json(404, {'message': 'Not found'})
+        flow_param = match.group(2)
+        if not match.group(3):
+            return self.send_json(200, {'parameterized_name': flow_param, 'open': flow_param not in self.closed})
+
+        since_id = int(params.get('since_id', 0))
+        limit = min(int(params.get('limit', 30)), max_limit)
+        # The ids are in ascending order
+        messages = self.flows[flow_param]
+        start = bisect.bisect_right(self.ids[flow_param], since_id)
+        page = start // limit + 1
+        if self.failed((flow_param, page), page):
+            return
+        FlowdockApiHandler.since_ids.append((flow_param, since_id))
+        self.send_json(200, messages[start:start + limit])
+
+    def send_file(self, path):
+        if self.failed(path, self.file_numbers[path]):
+            return
+        content = self.files[path]
+        match = re.fullmatch(r'bytes=(\d+)-', self.headers.get('Range', ''))
+        if not match or not self.ranges:
+            return self.send(200, content, 'image/png')
+        offset = int(match.group(1))
+        FlowdockApiHandler.offsets.append((path, offset))
+        if offset >= len(content):
+            return self.send(416, b'', 'image/png', {'Content-Range': 'bytes */%d' % len(content)})
+        self.send(206, content[offset:], 'image/png',
+                  {'Content-Range': 'bytes %d-%d/%d' % (offset, len(content) - 1, len(content))})
+
+    def do_PUT(self):
+        match = re.fullmatch(r'/flows/([^/]+)/([^/]+)', urlparse(self.path).path)
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if not match or match.group(2) not in self.flows:
+            return self.send_json(404, {'message': 'Not found'})
+        if body.get('open'):
+            FlowdockApiHandler.closed.discard(match.group(2))
+        self.send_json(200, {'parameterized_name': match.group(2), 'open': match.group(2) not in self.closed})
+
+def serve(port):
+    """
+    Start the stub in a background thread. Returns the server, port 0 picks
+    a free one.
+    """
+    server = ThreadingHTTPServer(('localhost', port), FlowdockApiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def set_flows(flows):
+    FlowdockApiHandler.flows = flows
+    FlowdockApiHandler.ids = {flow_param: [message['id'] for message in messages]
+                              for flow_param, messages in flows.items()}
+    FlowdockApiHandler.files = build_files(flows)
+    FlowdockApiHandler.file_numbers = {path: number for number, path in enumerate(FlowdockApiHandler.files, 1)}
+
+def set_failures(rate_limit_every=0, error_every=0, drop_every=0):
+    FlowdockApiHandler.rate_limit_every = rate_limit_every
+    FlowdockApiHandler.error_every = error_every
+    FlowdockApiHandler.drop_every = drop_every
+    FlowdockApiHandler.attempts = {}
+    FlowdockApiHandler.offsets = []
+    FlowdockApiHandler.since_ids = []
+
+def check_fetch(base_url):
+    """
+    Download flows from the stub and check the retry and resume paths of
+    flowdock_fetch
+    """
+    FlowdockApiHandler.closed = {'random'}
+    checkpoint_dir = tempfile.mkdtemp()
+    try:
+        def download(flow_params):
+            return flowdock_fetch.download_flows(flow_params, 'token', FlowdockApiHandler.org, checkpoint_dir,
+                                                 base_url, concurrency=2)
+
+        def assert_complete(paths, flow_param):
+            messages = flowdock_fetch.read_checkpoint(paths[flow_param])
+            assert messages == FlowdockApiHandler.flows[flow_param], '%s is not complete' % flow_param
+            os.remove(paths[flow_param])
+
+        # Rate limits, server errors and dropped connections are retried,
+        # a closed flow is opened
+        set_failures(rate_limit_every=2, error_every=3, drop_every=2)
+        retries = flowdock_fetch.request_stats['retries']
+        paths = download(['general', 'random'])
+        assert sorted(paths) == ['general', 'random'], 'not every flow was downloaded'
+        for flow_param in paths:
+            assert_complete(paths, flow_param)
+        assert flowdock_fetch.request_stats['retries'] > retries, 'nothing was retried'
+        assert not FlowdockApiHandler.closed, 'the closed flow was not opened'
+        print('ok: 429, 503 and dropped connections are retried')
+
+        # A connection which keeps dropping fails the flow but keeps its
+        # checkpoint
+        max_retries = flowdock_fetch.max_retries
+        flowdock_fetch.max_retries = 0
+        set_failures(drop_every=3)
+        try:
+            assert download(['general']) == {}, 'the download did not fail'
+        finally:
+            flowdock_fetch.max_retries = max_retries
+        path = flowdock_fetch.checkpoint_path(checkpoint_dir, 'general')
+        count, last_id = flowdock_fetch.scan_checkpoint(path)
+        assert 0 < count < 350, 'no partial checkpoint was left'
+
+        # Half a line written when the process died is dropped
+        with open(path, 'a') as f:
+            f.write('{"id": %d, "content": "cut o' % (last_id + 1))
+
+        # The rerun continues after the last message it has
+        set_failures()
+        paths = download(['general'])
+        assert FlowdockApiHandler.since_ids[0] == ('general', last_id), \
+            'resumed from %s instead of %d' % (FlowdockApiHandler.since_ids[0][1], last_id)
+        assert_complete(paths, 'general')
+        print('ok: an interrupted download resumes from message %d of its checkpoint' % last_id)
+    finally:
+        shutil.rmtree(checkpoint_dir)
+
+def check_attachments(base_url):
+    """
+    Download the files of the flows from the stub and check the retry and
+    resume paths of attachments.py
+    """
+    files = FlowdockApiHandler.files
+    paths = [path for messages in FlowdockApiHandler.flows.values() for path in attachments.file_paths(messages)]
+    store_dir = tempfile.mkdtemp()
+    try:
+        def download(store):
+            return attachments.download_attachments(paths, store, base_url, 'token', concurrency=4)
+
+        def assert_stored(store):
+            for path, content in files.items():
+                sha256, size, content_type = store.get(path)
+                with open(store.object_path(sha256), 'rb') as f:
+                    assert f.read() == content, '%s is not intact' % path
+
+        # Failures are retried, a file cut off is continued where it stopped
+        store = attachments.AttachmentStore(store_dir + '/retry')
+        set_failures(rate_limit_every=2, error_every=3, drop_every=5)
+        counts = download(store)
+        assert counts == {'downloaded': len(files), 'failed': 0}, counts
+        assert_stored(store)
+        assert FlowdockApiHandler.offsets and all(offset for path, offset in FlowdockApiHandler.offsets), \
+            'no download was continued with a Range'
+        objects = sum(len(names) for root, dirs, names in os.walk(store_dir + '/retry/objects'))
+        assert objects < len(files), 'files with the same content are stored twice'
+        print('ok: %d files posted %d times are stored as %d objects, %d were continued with a Range' % (
+            len(files), len(paths), objects, len(FlowdockApiHandler.offsets)))
+
+        # A file which failed is continued by the next run
+        def fail_all(store):
+            max_retries = attachments.max_retries
+            attachments.max_retries = 0
+            set_failures(drop_every=1)
+            try:
+                assert download(store)['failed'] == len(files), 'the downloads did not fail'
+            finally:
+                attachments.max_retries = max_retries
+            set_failures()
+
+        store = attachments.AttachmentStore(store_dir + '/resume')
+        fail_all(store)
+        counts = download(store)
+        assert counts == {'downloaded': len(files), 'failed': 0}, counts
+        assert_stored(store)
+        assert sorted(FlowdockApiHandler.offsets) == sorted((path, len(content) // 2)
+                                                            for path, content in files.items()), \
+            'not every download continued where the last run stopped'
+        print('ok: the next run continues %d partial files where they stopped' % len(files))
+
+        # A server which ignores the Range gets the whole file again
+        store = attachments.AttachmentStore(store_dir + '/no-range')
+        fail_all(store)
+        FlowdockApiHandler.ranges = False
+        try:
+            counts = download(store)
+        finally:
+            FlowdockApiHandler.ranges = True
+        assert counts == {'downloaded': len(files), 'failed': 0}, counts
+        assert_stored(store)
+        print('ok: a partial file starts over when the server ignores the Range')
+
+        # verify() drops a corrupt file, and the next run gets it again
+        sha256 = store.get(paths[0])[0]
+        with open(store.object_path(sha256), 'ab') as f:
+            f.write(b'corrupt')
+        assert store.verify() == 1, 'the corrupt file was not found'
+        counts = download(store)
+        assert counts['downloaded'] == sum(1 for content in files.values()
+                                           if hashlib.sha256(content).hexdigest() == sha256), counts
+        assert_stored(store)
+        print('ok: verify() drops a corrupt file and the next run downloads it again')
+    finally:
+        shutil.rmtree(store_dir)
+
+def check():
+    set_flows(build_flows(['general', 'random'], 350, 20))
+    server = serve(0)
+    base_url = 'http://localhost:%d' % server.server_address[1]
+    try:
+        check_fetch(base_url)
+        check_attachments(base_url)
+    finally:
+        server.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve fake Flowdock flows')
+    parser.add_argument('--flows', default='general', help='comma separated flow names')
+    parser.add_argument('--messages', type=int, default=1000, help='messages in each flow')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--org', default=FlowdockApiHandler.org, help='flowdock_org in config.yml')
+    parser.add_argument('--rate-limit-every', type=int, default=0, help='answer the first request for every nth page or file with a 429')
+    parser.add_argument('--error-every', type=int, default=0, help='then a 503')
+    parser.add_argument('--drop-every', type=int, default=0, help='then cut off the answer half way')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--port', type=int, default=8902)
+    parser.add_argument('--check', action='store_true',
+                        help='check the retries and resuming of flowdock_fetch and attachments.py against the stub and exit')
+    args = parser.parse_args()
+
+    if args.check:
+        return check()
+
+    FlowdockApiHandler.org = args.org
+    set_flows(build_flows(args.flows.split(','), args.messages, args.users, args.seed))
+    FlowdockApiHandler.users = generate_flowdock_users(args.users, args.seed)
+    set_failures(args.rate_limit_every, args.error_every, args.drop_every)
+    print('Serving %d flows of %d messages on http://localhost:%d' % (len(FlowdockApiHandler.flows), args.messages,
+                                                                      args.port))
+    ThreadingHTTPServer(('localhost', args.port), FlowdockApiHandler).serve_forever()
+
+if __name__ == '__main__':
+    main()
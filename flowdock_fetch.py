@@ -0,0 +1,209 @@
+"""
+Download the messages of several flows from the Flowdock API concurrently.
+
+Flowdock gives us at most 100 messages per request, so a big flow is thousands
+of requests. Every page is appended to a checkpoint file
+(cache/flow-<flow>.partial.jsonl, one message per line) as soon as it arrives,
+so an interrupted download continues from the last since_id instead of id 0.
+
+base_url can point to a local stub server for testing.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+
+import aiohttp
+
+from metrics import Progress
+
+page_size = 100 # the max Flowdock allows
+max_retries = 5
+# A request which hangs is given up and retried like a dropped connection
+request_timeout = aiohttp.ClientTimeout(total=120, sock_connect=30, sock_read=60)
+
+# API latency, for the metrics report
+request_stats = {'requests': 0, 'retries': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+
+def checkpoint_path(checkpoint_dir, flow_param):
+    return '%s/flow-%s.partial.jsonl' % (checkpoint_dir, flow_param)
+
+def read_checkpoint(path):
+    """
+    Returns the messages saved so far
+    """
+    return list(iter_checkpoint(path))
+
+def iter_checkpoint(path):
+    with open(path) as f:
+        for line in f:
+            yield json.loads(line)
+
+def scan_checkpoint(path):
+    """
+    Returns (count, last id) of the messages saved so far. A line cut in half
+    by a crash is dropped from the file so we can keep appending to it.
+    """
+    count = 0
+    last_id = 0 # We start with the oldest possible message
+    if not os.path.exists(path):
+        return count, last_id
+    valid_bytes = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                last_id = json.loads(line)['id']
+            except ValueError:
+                break
+            count += 1
+            valid_bytes += len(line)
+    with open(path, 'ab') as f:
+        f.truncate(valid_bytes)
+    return count, last_id
+
+def append_checkpoint(path, page):
+    data = ''.join(json.dumps(message) + '\n' for message in page)
+    with open(path, 'a') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+async def request_json(session, method, url, **kwargs):
+    """
+    Make a request, backing off when Flowdock rate limits us (429), has
+    a temporary problem (5xx) or the connection fails or times out.
+    """
+    delay = 1
+    for attempt in range(max_retries + 1):
+        retry_after = None
+        start = time.perf_counter()
+        try:
+            async with session.request(method, url, **kwargs) as r:
+                latency = time.perf_counter() - start
+                request_stats['requests'] += 1
+                request_stats['seconds'] += latency
+                request_stats['max_seconds'] = max(request_stats['max_seconds'], latency)
+                if r.status == 429 or r.status >= 500:
+                    if attempt == max_retries:
+                        r.raise_for_status()
+                    retry_after = r.headers.get('Retry-After')
+                else:
+                    r.raise_for_status()
+                    return await r.json()
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError):
+            # Also when the connection dropped half way through a page
+            if attempt == max_retries:
+                raise
+        request_stats['retries'] += 1
+        await asyncio.sleep(float(retry_after) if retry_after else delay)
+        delay *= 2
+
+async def fetch_flow_messages(session, base_url, org, flow_param, checkpoint_dir, progress=None):
+    """
+    Fetch all messages of a flow, resuming from its checkpoint file.
+    Returns the path of the completed checkpoint.
+    """
+    path = checkpoint_path(checkpoint_dir, flow_param)
+    count, since_id = scan_checkpoint(path)
+
+    # Check if we can read the flow and fix if needed
+    flow_url = '{url}/flows/{org}/{flow}'.format(url=base_url, org=org, flow=flow_param)
+    flow_metadata = await request_json(session, 'GET', flow_url)
+    if not flow_metadata['open']:
+        await request_json(session, 'PUT', flow_url, json={'open': True})
+
+    while True:
+        page = await request_json(session, 'GET', flow_url + '/messages', params={
+            'event': 'file,message,comment',
+            'limit': page_size,
+            'since_id': since_id,
+            'sort': 'asc'
+        })
+        if not page:
+            break
+        append_checkpoint(path, page)
+        since_id = page[-1]['id'] # move the id to the last message
+        count += len(page)
+        if progress:
+            progress.update(progress.done + len(page))
+
+    print('Downloaded %d messages from %s' % (count, flow_param))
+    return path
+
+def open_session(token, concurrency):
+    # Call in the event loop the session is used in
+    return aiohttp.ClientSession(headers={'Authorization': 'Basic %s' % token},
+                                 connector=aiohttp.TCPConnector(limit=concurrency), timeout=request_timeout)
+
+async def fetch_flows(flow_params, token, org, checkpoint_dir, base_url, concurrency=4):
+    """
+    Fetch several flows at once over one pooled connection. Returns a dict of
+    flow_param -> checkpoint path for the flows that completed.
+    """
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    semaphore = asyncio.Semaphore(concurrency)
+    progress = Progress('fetch')
+
+    async def fetch_one(session, flow_param):
+        async with semaphore:
+            return await fetch_flow_messages(session, base_url, org, flow_param, checkpoint_dir, progress)
+
+    async with open_session(token, concurrency) as session:
+        results = await asyncio.gather(
+            *[fetch_one(session, flow_param) for flow_param in flow_params],
+            return_exceptions=True
+        )
+    progress.finish()
+
+    paths = {}
+    for flow_param, result in zip(flow_params, results):
+        if isinstance(result, Exception):
+            print('Could not download %s, rerun to resume: %s' % (flow_param, result))
+        else:
+            paths[flow_param] = result
+    return paths
+
+def download_flows(flow_params, token, org, checkpoint_dir, base_url, concurrency=4):
+    return asyncio.run(fetch_flows(flow_params, token, org, checkpoint_dir, base_url, concurrency))
+
+class FlowFetcher:
+    """
+    Fetch flows one at a time for other threads, like the stages of
+    pipeline.py. The downloads all run on one event loop in a thread of its
+    own with one pooled session, so they reuse connections and at most
+    concurrency of them run at once, however many threads ask for flows.
+    """
+    def __init__(self, token, org, checkpoint_dir, base_url, concurrency=4):
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.org = org
+        self.checkpoint_dir = checkpoint_dir
+        self.base_url = base_url
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='flow-fetcher', daemon=True)
+        self.thread.start()
+        self.session, self.semaphore = self.run(self.open(token, concurrency))
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def open(self, token, concurrency):
+        return open_session(token, concurrency), asyncio.Semaphore(concurrency)
+
+    async def fetch_one(self, flow_param):
+        async with self.semaphore:
+            return await fetch_flow_messages(self.session, self.base_url, self.org, flow_param,
+                                             self.checkpoint_dir)
+
+    def fetch(self, flow_param):
+        """
+        Download a flow, waiting for it in the calling thread. Returns the
+        path of its completed checkpoint.
+        """
+        return self.run(self.fetch_one(flow_param))
+
+    def close(self):
+        self.run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
@@ -0,0 +1,142 @@
+"""
+State for incremental (delta) conversion of flows.
+
+After a flow is converted we store, in state/flow-<flow>.json:
+ - last_id: the id of the last Flowdock message converted
+ - hash: a hash of the content of all messages up to last_id
+ - count: how many messages that was
+ - threads: the file name of the ThreadIndex with the thread parents, next to
+   the state. Each run writes a new one, so a run that dies half way through
+   leaves the last state and its threads as they were.
+
+A new state is saved as state/flow-<flow>.pending.json and only replaces the
+state with commit_flow_state() once the export with its messages is built.
+If the run fails before that, the next one converts those messages again.
+
+On the next run only the messages after last_id are converted, reusing the
+stored thread parents so replies to old threads still land in the right place.
+If the hash of the old messages changed (edits, or a different export) the
+state can't be trusted and the flow is converted from scratch.
+"""
+import json
+import os
+import shutil
+from hashlib import blake2b
+
+from slack_export import dump_json_file
+from thread_index import ThreadIndex
+
+class StaleStateError(Exception):
+    pass
+
+def state_path(state_dir, flow_param):
+    return '%s/flow-%s.json' % (state_dir, flow_param)
+
+def load_flow_state(state_dir, flow_param):
+    path = state_path(state_dir, flow_param)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        state = json.load(f)
+    if not isinstance(state.get('threads'), str) or not os.path.exists('%s/%s' % (state_dir, state['threads'])):
+        # From before threads were kept in a ThreadIndex, or its file is gone
+        return None
+    return state
+
+def open_flow_threads(state_dir, flow_param, state, cache_size=100000):
+    """
+    A ThreadIndex to convert the new messages with: a copy of the one in
+    state, or an empty one without a state
+    """
+    os.makedirs(state_dir, exist_ok=True)
+    path = '%s/flow-%s.threads.sqlite.tmp' % (state_dir, flow_param)
+    if os.path.exists(path):
+        os.remove(path)
+    if state:
+        shutil.copyfile('%s/%s' % (state_dir, state['threads']), path)
+    return ThreadIndex(path, cache_size)
+
+def pending_path(state_dir, flow_param):
+    return '%s/flow-%s.pending.json' % (state_dir, flow_param)
+
+def save_flow_state(state_dir, flow_param, state, threads):
+    """
+    Save state with threads, the ThreadIndex from open_flow_threads, which is
+    closed. The state stays pending until commit_flow_state(), so a run
+    whose export isn't built converts the same messages again.
+    """
+    threads.close()
+    old_pending = None
+    if os.path.exists(pending_path(state_dir, flow_param)):
+        with open(pending_path(state_dir, flow_param)) as f:
+            old_pending = json.load(f)
+    state['threads'] = 'flow-%s.threads-%d.sqlite' % (flow_param, state['last_id'])
+    os.replace(threads.path, '%s/%s' % (state_dir, state['threads']))
+    dump_json_file(state, pending_path(state_dir, flow_param))
+
+    current_state = load_flow_state(state_dir, flow_param)
+    if old_pending and old_pending['threads'] not in (state['threads'], current_state and current_state['threads']):
+        old_threads = '%s/%s' % (state_dir, old_pending['threads'])
+        if os.path.exists(old_threads):
+            os.remove(old_threads)
+
+def commit_flow_state(state_dir, flow_param):
+    """
+    Make the pending state of the flow its state, once the messages it
+    covers are in the export
+    """
+    if not os.path.exists(pending_path(state_dir, flow_param)):
+        return
+    old_state = load_flow_state(state_dir, flow_param)
+    with open(pending_path(state_dir, flow_param)) as f:
+        state = json.load(f)
+    os.replace(pending_path(state_dir, flow_param), state_path(state_dir, flow_param))
+    if old_state and old_state['threads'] != state['threads']:
+        os.remove('%s/%s' % (state_dir, old_state['threads']))
+
+def message_fingerprint(fm):
+    return json.dumps(fm, sort_keys=True).encode()
+
+class NewMessages:
+    """
+    Iterates over the messages after the ones recorded in state, checking
+    the hash of the old ones on the way. Raises StaleStateError before
+    yielding anything if the old messages changed.
+
+    After iterating, last_id, count and hexdigest() describe all the messages,
+    old and new, ready to be saved as the next state.
+    """
+    def __init__(self, flowdock_messages, state=None):
+        self.flowdock_messages = flowdock_messages
+        self.state = state
+        self.hasher = blake2b(digest_size=16)
+        self.last_id = 0
+        self.count = 0
+        self.new_count = 0
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+    def check_old_messages(self):
+        if self.count != self.state['count'] or self.hexdigest() != self.state['hash']:
+            raise StaleStateError('Messages up to %s changed since the last run' % self.state['last_id'])
+
+    def __iter__(self):
+        state_last_id = self.state['last_id'] if self.state else None
+        checked = not self.state
+
+        for fm in self.flowdock_messages:
+            if not checked and fm['id'] > state_last_id:
+                self.check_old_messages()
+                checked = True
+
+            self.hasher.update(message_fingerprint(fm))
+            self.last_id = fm['id']
+            self.count += 1
+
+            if checked:
+                self.new_count += 1
+                yield fm
+
+        if not checked:
+            self.check_old_messages()
@@ -0,0 +1,97 @@
+"""
+Incremental reader for the huge messages.json files in Flowdock exports.
+
+The exports are a single top-level JSON array which can be several gigabytes,
+so instead of json.load() we decode one element at a time from a sliding
+buffer and hand them out from a generator.
+"""
+import json
+
+read_size = 1 << 20 # 1 MiB per read
+
+whitespace = ' \t\n\r'
+
+def iter_json_array(path, chunk_size=read_size):
+    """
+    Yield the elements of the top-level JSON array in path one at a time.
+    Memory use is bounded by the largest single element, not the file size.
+    """
+    with open(path, encoding='utf-8') as f:
+        yield from iter_json_array_from_file(f, chunk_size)
+
+def iter_json_array_from_file(f, chunk_size=read_size):
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    eof = False
+
+    def fill(buffer, pos, size):
+        # Drop what we already decoded and append the next chunk
+        chunk = f.read(size)
+        return buffer[pos:] + chunk, 0, not chunk
+
+    # Find the opening bracket
+    while True:
+        while pos < len(buffer) and buffer[pos] in whitespace:
+            pos += 1
+        if pos < len(buffer):
+            break
+        if eof:
+            raise ValueError('Expected a JSON array but the file is empty')
+        buffer, pos, eof = fill(buffer, pos, chunk_size)
+
+    if buffer[pos] != '[':
+        raise ValueError('Expected a JSON array but found %r' % buffer[pos])
+    pos += 1
+
+    expect_value = True # False while we wait for a ',' or ']'
+    first = True
+    while True:
+        while pos < len(buffer) and buffer[pos] in whitespace:
+            pos += 1
+        if pos == len(buffer):
+            if eof:
+                raise ValueError('Unexpected end of file inside the JSON array')
+            buffer, pos, eof = fill(buffer, pos, chunk_size)
+            continue
+
+        char = buffer[pos]
+        if char == ']' and (not expect_value or first):
+            break
+        if not expect_value:
+            if char != ',':
+                raise ValueError('Expected , or ] but found %r' % char)
+            pos += 1
+            expect_value = True
+            continue
+
+        # Decode the next element, reading more data until it is complete.
+        # The read size doubles so very large elements stay linear.
+        size = chunk_size
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+                # A number at the end of the buffer may continue in the next chunk
+                if end < len(buffer) or eof:
+                    break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            buffer, pos, eof = fill(buffer, pos, size)
+            size *= 2
+
+        yield value
+        pos = end
+        expect_value = False
+        first = False
+
+    # Only whitespace may follow the closing bracket
+    pos += 1
+    while True:
+        while pos < len(buffer) and buffer[pos] in whitespace:
+            pos += 1
+        if pos < len(buffer):
+            raise ValueError('Unexpected %r after the end of the JSON array' % buffer[pos])
+        if eof:
+            return
+        buffer, pos, eof = fill(buffer, pos, chunk_size)
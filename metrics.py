@@ -0,0 +1,128 @@
+"""
+Timing, counters and progress reporting for a migration run.
+
+Metrics collects how long each stage took (fetch, users, convert, package),
+per-flow numbers returned by the conversion workers and any other counters,
+and writes them as a JSON report at the end of the run.
+
+Progress draws a single live status line with rate and ETA when stderr is a
+terminal.
+"""
+import cProfile
+import json
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {} # name -> {'seconds', 'calls'}
+        self.flows = [] # per-flow metrics, see convert.transform_and_write_messages
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+            stage['seconds'] += time.perf_counter() - start
+            stage['calls'] += 1
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        self.counters[name] = value
+
+    def report(self):
+        seconds = time.time() - self.started
+        messages = sum(flow.get('messages_in', 0) for flow in self.flows)
+        return {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.started)),
+            'seconds': round(seconds, 3),
+            'messages': messages,
+            'messages_per_second': round(messages / seconds) if seconds else None,
+            'bytes_written': sum(flow.get('bytes_written', 0) for flow in self.flows),
+            'stages': {name: {'seconds': round(stage['seconds'], 3), 'calls': stage['calls']}
+                       for name, stage in self.stages.items()},
+            'counters': self.counters,
+            'flows': self.flows
+        }
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=4)
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+class Progress:
+    """
+    A status line like '[big] 120000/300000 messages 5300/s ETA 0:00:33'.
+    Only drawn when the stream is a terminal, and at most every interval seconds.
+    """
+    def __init__(self, label, total=None, unit='messages', interval=0.5, stream=sys.stderr):
+        self.label = label
+        self.total = total
+        self.unit = unit
+        self.interval = interval
+        self.stream = stream
+        self.enabled = stream.isatty()
+        self.started = time.perf_counter()
+        self.last_draw = 0
+        self.done = 0
+
+    def update(self, done):
+        self.done = done
+        now = time.perf_counter()
+        if self.enabled and now - self.last_draw >= self.interval:
+            self.last_draw = now
+            self.draw(now)
+
+    def draw(self, now):
+        elapsed = now - self.started
+        rate = self.done / elapsed if elapsed else 0
+        line = '[%s] %d' % (self.label, self.done)
+        if self.total:
+            line += '/%d' % self.total
+        line += ' %s %d/s' % (self.unit, rate)
+        if self.total and rate:
+            line += ' ETA %s' % format_duration((self.total - self.done) / rate)
+        self.stream.write('\r\033[K' + line)
+        self.stream.flush()
+
+    def finish(self):
+        if self.enabled:
+            self.draw(time.perf_counter())
+            self.stream.write('\n')
+            self.stream.flush()
+
+@contextmanager
+def profiled(name, profile=False, trace_memory=False, results=None):
+    """
+    Optionally run a block under cProfile (stats saved to <name>.prof) and/or
+    tracemalloc (peak and top allocations stored in results)
+    """
+    profiler = cProfile.Profile() if profile else None
+    if trace_memory:
+        tracemalloc.start()
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(name + '.prof')
+        if trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+            tracemalloc.stop()
+            if results is not None:
+                results['traced_peak_bytes'] = peak
+                results['traced_top'] = ['%s: %d bytes' % (stat.traceback, stat.size) for stat in top]
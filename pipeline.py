@@ -0,0 +1,163 @@
+"""
+A pipeline of stages which run at the same time, each in its own threads,
+connected by bounded queues.
+
+Each stage takes items from its input queue, calls its function on them and
+puts the result in the queue of the next stage. A queue only holds a few
+items, so a slow stage holds back the ones before it (backpressure) instead
+of letting their results pile up, and a fast one waits for work. For the
+migration this means flow n + 1 is downloaded while flow n is converted and
+flow n - 1 is written into the export.
+
+Every stage records how long its workers were busy, waiting for an item and
+blocked on the full queue of the next stage, and the depth of each queue is
+sampled while the pipeline runs. The stage with the highest utilization is
+the bottleneck: the queue in front of it is usually full and the ones after
+it empty.
+"""
+import queue
+import threading
+import time
+
+end = object() # one for each worker of a stage after the last item
+
+class Stage:
+    def __init__(self, name, fn, workers=1, queue_size=2):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.queue = queue.Queue(max(1, queue_size))
+        self.lock = threading.Lock()
+        self.running = workers
+        self.items = 0
+        self.busy = 0.0
+        self.idle = 0.0 # waiting for an item
+        self.blocked = 0.0 # waiting for room in the next queue
+        self.depths = []
+
+    def add_times(self, idle, busy, blocked):
+        with self.lock:
+            self.items += 1
+            self.idle += idle
+            self.busy += busy
+            self.blocked += blocked
+
+    def report(self, seconds):
+        depths = self.depths or [0]
+        return {
+            'workers': self.workers,
+            'items': self.items,
+            'busy_seconds': round(self.busy, 3),
+            'idle_seconds': round(self.idle, 3),
+            'blocked_seconds': round(self.blocked, 3),
+            'utilization': round(self.busy / (seconds * self.workers), 3) if seconds else 0,
+            'queue_size': self.queue.maxsize,
+            'queue_mean': round(sum(depths) / len(depths), 2),
+            'queue_max': max(depths),
+            'queue_full': round(sum(1 for depth in depths if depth >= self.queue.maxsize) / len(depths), 3)
+        }
+
+class Pipeline:
+    def __init__(self, sample_interval=0.1):
+        self.stages = []
+        self.sample_interval = sample_interval
+        self.errors = [] # (stage name, item, exception)
+        self.seconds = 0.0
+
+    def add_stage(self, name, fn, workers=1, queue_size=2):
+        """
+        Add a stage calling fn(item) in workers threads, with an input queue
+        of queue_size items. What fn returns goes to the next stage, unless
+        it's None.
+        """
+        self.stages.append(Stage(name, fn, workers, queue_size))
+
+    def work(self, stage, next_stage, results):
+        while True:
+            start = time.perf_counter()
+            item = stage.queue.get()
+            if item is end:
+                break
+            got = time.perf_counter()
+            try:
+                result = stage.fn(item)
+            except Exception as e:
+                # The other items carry on, run() raises it at the end
+                self.errors.append((stage.name, item, e))
+                result = None
+            done = time.perf_counter()
+            if result is not None:
+                if next_stage:
+                    next_stage.queue.put(result)
+                else:
+                    results.append(result)
+            stage.add_times(got - start, done - got, time.perf_counter() - done)
+
+        with stage.lock:
+            stage.running -= 1
+            last = stage.running == 0
+        if last and next_stage:
+            for worker in range(next_stage.workers):
+                next_stage.queue.put(end)
+
+    def sample(self, finished):
+        while not finished.wait(self.sample_interval):
+            for stage in self.stages:
+                stage.depths.append(stage.queue.qsize())
+
+    def run(self, items):
+        """
+        Feed items through the stages. Returns what the last stage returned,
+        in the order it finished them. The first exception a stage raised is
+        raised again once all the items are through.
+        """
+        results = []
+        threads = []
+        for number, stage in enumerate(self.stages):
+            next_stage = self.stages[number + 1] if number + 1 < len(self.stages) else None
+            for worker in range(stage.workers):
+                # Daemons, so Ctrl-C doesn't wait for the stages to drain
+                threads.append(threading.Thread(target=self.work, args=(stage, next_stage, results),
+                                                name='%s-%d' % (stage.name, worker), daemon=True))
+        finished = threading.Event()
+        threads.append(threading.Thread(target=self.sample, args=(finished,), daemon=True))
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for item in items:
+            self.stages[0].queue.put(item)
+        for worker in range(self.stages[0].workers):
+            self.stages[0].queue.put(end)
+        for thread in threads[:-1]:
+            thread.join()
+        finished.set()
+        self.seconds = time.perf_counter() - start
+
+        if self.errors:
+            raise self.errors[0][2]
+        return results
+
+    def report(self):
+        return {
+            'seconds': round(self.seconds, 3),
+            'bottleneck': self.bottleneck(),
+            'stages': {stage.name: stage.report(self.seconds) for stage in self.stages}
+        }
+
+    def bottleneck(self):
+        if not self.stages or not self.seconds:
+            return None
+        return max(self.stages, key=lambda stage: stage.busy / stage.workers).name
+
+def format_report(report):
+    lines = ['Pipeline: %.1fs' % report['seconds'], '%-12s %7s %6s %9s %6s %9s %9s %12s' % (
+        'stage', 'workers', 'items', 'busy s', 'util', 'idle s', 'blocked s', 'queue avg/max')]
+    for name, stage in report['stages'].items():
+        lines.append('%-12s %7d %6d %9.1f %5.0f%% %9.1f %9.1f %6.1f/%d of %d' % (
+            name, stage['workers'], stage['items'], stage['busy_seconds'], stage['utilization'] * 100,
+            stage['idle_seconds'], stage['blocked_seconds'], stage['queue_mean'], stage['queue_max'],
+            stage['queue_size']))
+    if report['bottleneck']:
+        lines.append('Bottleneck: %s' % report['bottleneck'])
+    return '\n'.join(lines)
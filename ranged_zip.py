@@ -0,0 +1,232 @@
+"""
+Extract a member of a remote zip file with parallel HTTP range requests.
+
+Flowdock exports are multi-GB zips and all we need from each is
+messages.json. Instead of streaming the member with one request, the
+compressed bytes are split into chunks which are downloaded in parallel into
+<output>.part, while the chunks that are complete are decompressed in order
+straight into the output file.
+
+ - finished chunks are logged in <output>.chunks (one index per line), so an
+   interrupted extraction only downloads what is missing
+ - a failed range is retried from where it broke off, with backoff
+ - the CRC of the decompressed data is checked against the one in the zip
+"""
+import io
+import os
+import struct
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+
+chunk_size = 16 << 20
+max_retries = 5
+local_header = struct.Struct('<4s5H3L2H')
+
+sessions = threading.local()
+
+def get_session(headers=None):
+    # requests sessions aren't meant to be shared between threads
+    if not hasattr(sessions, 'session'):
+        sessions.session = requests.Session()
+    sessions.session.headers.update(headers or {})
+    return sessions.session
+
+def request_range(url, start, end, headers=None):
+    """
+    GET bytes start..end (inclusive), retrying temporary failures.
+    Returns the streaming response.
+    """
+    delay = 1
+    for attempt in range(max_retries + 1):
+        try:
+            r = get_session(headers).get(url, headers={'Range': 'bytes=%d-%d' % (start, end)},
+                                         stream=True, timeout=60)
+            if r.status_code == 206:
+                return r
+            if r.status_code != 429 and r.status_code < 500:
+                r.raise_for_status()
+                raise IOError('%s does not support range requests (status %d)' % (url, r.status_code))
+            r.close()
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == max_retries:
+                raise
+        if attempt == max_retries:
+            raise IOError('Giving up on bytes %d-%d of %s' % (start, end, url))
+        time.sleep(delay)
+        delay *= 2
+
+def iter_range(url, start, end, headers=None):
+    """
+    Yields bytes start..end in pieces. When the connection breaks, the rest
+    is requested again from where it stopped.
+    """
+    position = start
+    for attempt in range(max_retries + 1):
+        try:
+            with request_range(url, position, end, headers) as r:
+                for data in r.iter_content(1 << 20):
+                    yield data
+                    position += len(data)
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+            if attempt == max_retries:
+                raise
+        if position > end:
+            return
+        time.sleep(min(2 ** attempt, 30))
+    raise IOError('Could not download bytes %d-%d of %s' % (start, end, url))
+
+def fetch_range(url, start, end, headers=None):
+    return b''.join(iter_range(url, start, end, headers))
+
+class HttpRangeFile(io.RawIOBase):
+    """
+    A read-only file over HTTP range requests, enough for zipfile to read
+    the central directory of a remote zip
+    """
+    def __init__(self, url, headers=None):
+        self.url = url
+        self.headers = headers
+        self.position = 0
+        r = request_range(url, 0, 0, headers)
+        r.close()
+        self.size = int(r.headers['Content-Range'].split('/')[1])
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = offset
+        return self.position
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else min(self.size, self.position + size)
+        if end <= self.position:
+            return b''
+        data = fetch_range(self.url, self.position, end - 1, self.headers)
+        self.position += len(data)
+        return data
+
+def read_done_chunks(path, info):
+    """
+    The chunks logged as done, None when the log is missing or for another
+    version of the member
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        if f.readline() != 'crc %d %d\n' % (info.CRC, info.compress_size):
+            return None
+        # The last line can be half written if we were killed
+        return {int(line) for line in f if line.strip().isdigit() and line.endswith('\n')}
+
+def download_chunk(url, headers, data_start, part_fd, start, end, done_path, index, lock):
+    """
+    Download bytes start..end of the member's data into the part file, then
+    log the chunk as done
+    """
+    position = start
+    for data in iter_range(url, data_start + start, data_start + end, headers):
+        os.pwrite(part_fd, data, position)
+        position += len(data)
+
+    os.fsync(part_fd)
+    with lock:
+        with open(done_path, 'a') as f:
+            f.write('%d\n' % index)
+
+def extract_member(url, name, output_path, headers=None, executor=None, chunk_bytes=chunk_size):
+    """
+    Extract the member name of the zip at url into output_path. executor is
+    the thread pool to download the chunks with, shared when extracting from
+    several zips at once.
+    """
+    with zipfile.ZipFile(HttpRangeFile(url, headers)) as zip_file:
+        info = zip_file.getinfo(name)
+    if info.compress_type == zipfile.ZIP_DEFLATED:
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    elif info.compress_type == zipfile.ZIP_STORED:
+        decompressor = None
+    else:
+        raise ValueError('%s in %s uses an unsupported compression method %d' % (name, url, info.compress_type))
+
+    # The local header can have a different extra field than the central one
+    header = local_header.unpack(fetch_range(url, info.header_offset, info.header_offset + local_header.size - 1, headers))
+    data_start = info.header_offset + local_header.size + header[9] + header[10]
+    chunks = [(offset, min(offset + chunk_bytes, info.compress_size) - 1)
+              for offset in range(0, info.compress_size, chunk_bytes)]
+
+    part_path = output_path + '.part'
+    done_path = output_path + '.chunks'
+    tmp_path = output_path + '.tmp'
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    done = read_done_chunks(done_path, info) if os.path.exists(part_path) else None
+    if done is None:
+        # A fresh start, or a different archive than last time
+        done = set()
+        with open(done_path, 'w') as f:
+            f.write('crc %d %d\n' % (info.CRC, info.compress_size))
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(8)
+    part_fd = os.open(part_path, os.O_RDWR | os.O_CREAT)
+    lock = threading.Lock()
+    futures = {}
+    crc = 0
+    try:
+        os.ftruncate(part_fd, info.compress_size)
+        for index, (start, end) in enumerate(chunks):
+            if index not in done:
+                futures[index] = executor.submit(download_chunk, url, headers, data_start, part_fd, start, end,
+                                                 done_path, index, lock)
+
+        # Decompress the chunks in order as they arrive
+        with open(tmp_path, 'wb') as out:
+            for index, (start, end) in enumerate(chunks):
+                if index in futures:
+                    futures[index].result()
+                data = os.pread(part_fd, end - start + 1, start)
+                if decompressor:
+                    data = decompressor.decompress(data)
+                crc = zlib.crc32(data, crc)
+                out.write(data)
+            if decompressor:
+                data = decompressor.flush()
+                crc = zlib.crc32(data, crc)
+                out.write(data)
+    except zlib.error:
+        crc = None
+    finally:
+        # On errors, let the running downloads finish before the file is closed
+        for future in futures.values():
+            future.cancel()
+        wait(futures.values())
+        os.close(part_fd)
+        if own_executor:
+            executor.shutdown()
+
+    if crc != info.CRC:
+        # Start over next time
+        for path in (part_path, done_path, tmp_path):
+            os.remove(path)
+        raise IOError('%s in %s is corrupt, the CRC does not match' % (name, url))
+
+    os.replace(tmp_path, output_path)
+    os.remove(part_path)
+    os.remove(done_path)
+    return info.file_size
@@ -0,0 +1,131 @@
+"""
+The manifest of a migration run, so a run that dies half way can be resumed.
+
+output/run-manifest.json records every flow of the run and how far it got:
+
+ - pending: nothing done yet
+ - fetched: its messages are downloaded (or the export is there)
+ - converted: its channel is in its own part zip in the run's parts directory
+ - written: the part is in the export zip(s), without sharding as soon as
+   it's converted
+ - packaged: the export is complete and the parts are removed, unless
+   they are kept for packaging again (convert --keep-parts, cli.py package)
+
+Flows with nothing to convert (no export, no new messages) are skipped. A
+flow that raises is marked failed with the stage and the error, and the
+other flows carry on. convert.py --resume continues the last run: flows whose
+part is already there are not converted again, pending and failed ones are,
+and the export zip is built again from all the parts.
+"""
+import json
+import os
+import threading
+import traceback
+
+from slack_export import dump_json_file
+
+statuses = ('pending', 'fetched', 'converted', 'written', 'packaged')
+
+class RunManifest:
+    def __init__(self, path, run, parts_dir, options=None):
+        self.path = path
+        self.run = run
+        self.parts_dir = parts_dir
+        self.options = options or {}
+        self.flows = {} # key -> {source, flow_param, name, status, attempts, ...}
+        # The stages of the pipeline update their flows from several threads
+        self.lock = threading.RLock()
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            contents = json.load(f)
+        manifest = cls(path, contents['run'], contents['parts_dir'], contents['options'])
+        manifest.flows = contents['flows']
+        return manifest
+
+    def save(self):
+        with self.lock:
+            self.dump()
+
+    def dump(self):
+        dump_json_file({
+            'run': self.run,
+            'parts_dir': self.parts_dir,
+            'options': self.options,
+            'flows': self.flows
+        }, self.path, indent=4)
+
+    def add_flow(self, source, flow_param, flow_name):
+        """
+        Add the flow unless it's there already. Returns its key.
+        """
+        key = '%s/%s' % (source, flow_param)
+        self.flows.setdefault(key, {
+            'source': source,
+            'flow_param': flow_param,
+            'name': flow_name,
+            'status': 'pending',
+            'attempts': 0
+        })
+        return key
+
+    def part_path(self, key):
+        return '%s/%s.zip' % (self.parts_dir, key.replace('/', '-'))
+
+    def reached(self, key, status):
+        entry = self.flows[key]
+        return entry['status'] in statuses and statuses.index(entry['status']) >= statuses.index(status)
+
+    def set_status(self, key, status, save=True, **fields):
+        with self.lock:
+            entry = self.flows[key]
+            entry['status'] = status
+            entry.pop('error', None)
+            entry.pop('failed_stage', None)
+            entry.update(fields)
+            if save:
+                self.save()
+
+    def fail(self, key, stage, error):
+        with self.lock:
+            entry = self.flows[key]
+            entry['status'] = 'failed'
+            entry['failed_stage'] = stage
+            entry['error'] = ''.join(traceback.format_exception_only(type(error), error)).strip()
+            self.save()
+
+    def attempt(self, key):
+        with self.lock:
+            self.flows[key]['attempts'] += 1
+
+    def to_convert(self):
+        """
+        The flows without a complete part, in the order they were added
+        """
+        return [key for key, entry in self.flows.items() if entry['status'] != 'skipped'
+                and not (self.reached(key, 'converted') and os.path.exists(self.part_path(key)))]
+
+    def counts(self):
+        counts = dict.fromkeys(statuses + ('failed', 'skipped'), 0)
+        for entry in self.flows.values():
+            counts[entry['status']] += 1
+        return counts
+
+class InOrder:
+    """
+    Puts keys back in order: add() takes them in any order and returns the
+    ones that can go next, in the order of keys
+    """
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self.arrived = set()
+        self.next = 0
+
+    def add(self, key):
+        self.arrived.add(key)
+        ready = []
+        while self.next < len(self.keys) and self.keys[self.next] in self.arrived:
+            ready.append(self.keys[self.next])
+            self.next += 1
+        return ready
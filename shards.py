@@ -0,0 +1,199 @@
+"""
+Splitting the export into several zips (shards) which are smaller to build,
+upload and import than one zip with every flow.
+
+The channels are taken from the part zips of a run (see runner.py), one
+entry per channel and day, and grouped into shards:
+
+ - flow: whole channels, one per shard, or as many as fit in max_bytes
+ - date: all the days of the same year (or month) in one shard
+ - size: days in export order until the shard reaches max_bytes, so a big
+   channel can be spread over several shards
+
+Sizes are the uncompressed size of the day files, so shards come out
+smaller than max_bytes. Every shard gets the full users.json and a
+channels.json with the channels in it, with the same ids in every shard.
+The index lists which shard holds which channel and days.
+
+An export without shards is a single shard, written by ShardWriter while the
+flows are still being converted.
+"""
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from slack_export import apply_patch
+
+shard_modes = ('flow', 'date', 'size')
+
+class Day:
+    __slots__ = ('channel', 'day', 'size', 'part_path', 'entry', 'patch')
+
+    def __init__(self, channel, day, size, part_path, entry, patch=None):
+        self.channel = channel
+        self.day = day
+        self.size = size
+        self.part_path = part_path
+        self.entry = entry # the name in the part zip
+        self.patch = patch # the name of its patch in the part zip, if any
+
+def part_days(part_path):
+    """
+    The channel days in the part zip at part_path, in the order they were
+    written. A day with a patch (channel/YYYY-MM-DD.patch.json, see
+    slack_export.ZipChannelWriter) counts the patch in its size.
+    """
+    with zipfile.ZipFile(part_path) as part:
+        days = {}
+        patches = []
+        for info in part.infolist():
+            channel, file_name = info.filename.split('/', 1)
+            if file_name.endswith('.patch.json'):
+                patches.append(info)
+            else:
+                day = file_name[:-len('.json')]
+                days[channel, day] = Day(channel, day, info.file_size, part_path, info.filename)
+        for info in patches:
+            channel, file_name = info.filename.split('/', 1)
+            day = days[channel, file_name[:-len('.patch.json')]]
+            day.patch = info.filename
+            day.size += info.file_size
+        return list(days.values())
+
+def plan_shards(days, mode, max_bytes=None, period='year'):
+    """
+    Group days into shards, a list of lists of days
+    """
+    if mode == 'date':
+        key_length = 4 if period == 'year' else 7 # YYYY or YYYY-MM
+        shards = {}
+        for day in days:
+            shards.setdefault(day.day[:key_length], []).append(day)
+        return [shards[key] for key in sorted(shards)]
+
+    if mode == 'flow':
+        channels = {}
+        for day in days:
+            channels.setdefault(day.channel, []).append(day)
+        groups = list(channels.values())
+    elif mode == 'size':
+        groups = [[day] for day in days]
+    else:
+        raise ValueError('Unknown shard mode %s, use one of %s' % (mode, ', '.join(shard_modes)))
+
+    # Fill each shard until the next group doesn't fit, a group bigger than
+    # max_bytes gets a shard of its own
+    shards = []
+    size = 0
+    for group in groups:
+        group_size = sum(day.size for day in group)
+        if not shards or max_bytes is None or size + group_size > max_bytes:
+            shards.append([])
+            size = 0
+        shards[-1].extend(group)
+        size += group_size
+    return shards
+
+class ShardWriter:
+    """
+    Writes a shard zip as the days come: users.json first, the days in the
+    order they are added and channels.json when it's closed. The zip only
+    gets its name once it's complete.
+    """
+    def __init__(self, path, users_json, compression_level=6):
+        self.path = path
+        self.zip_file = zipfile.ZipFile(path + '.tmp', 'w', zipfile.ZIP_DEFLATED, compresslevel=compression_level)
+        self.zip_file.writestr('users.json', users_json)
+        self.parts = {}
+
+    def add_days(self, days):
+        for day in days:
+            if day.part_path not in self.parts:
+                self.parts[day.part_path] = zipfile.ZipFile(day.part_path)
+            part = self.parts[day.part_path]
+            with self.zip_file.open(day.entry, 'w', force_zip64=True) as dst:
+                if day.patch:
+                    dst.write(apply_patch(part.read(day.entry), part.read(day.patch)))
+                    continue
+                with part.open(day.entry) as src:
+                    while True:
+                        data = src.read(1 << 20)
+                        if not data:
+                            break
+                        dst.write(data)
+
+    def add_part(self, part_path):
+        """
+        Add all the days of a part zip, and close it
+        """
+        self.add_days(part_days(part_path))
+        part = self.parts.pop(part_path, None)
+        if part:
+            part.close()
+
+    def close_parts(self):
+        for part in self.parts.values():
+            part.close()
+        self.parts = {}
+
+    def close(self, channels_json):
+        """
+        Finish the zip. Returns its size.
+        """
+        try:
+            self.zip_file.writestr('channels.json', channels_json)
+        finally:
+            self.zip_file.close()
+            self.close_parts()
+        os.replace(self.path + '.tmp', self.path)
+        return os.path.getsize(self.path)
+
+    def discard(self):
+        self.zip_file.close()
+        self.close_parts()
+        os.remove(self.path + '.tmp')
+
+def build_shard(path, days, users_json, channels_json, compression_level=6):
+    """
+    Write the zip at path with users_json, the days and channels_json.
+    Returns the size of the zip.
+    """
+    writer = ShardWriter(path, users_json, compression_level)
+    try:
+        writer.add_days(days)
+    except BaseException:
+        writer.discard()
+        raise
+    return writer.close(channels_json)
+
+def build_shards(paths, shards, users_json, channels_json_for, compression_level=6, jobs=1):
+    """
+    Build the shards in parallel, shard n at paths[n]. channels_json_for
+    returns the channels.json of a list of channel names. Returns the size
+    of each zip.
+    """
+    def build(path, days):
+        channels = list(dict.fromkeys(day.channel for day in days))
+        return build_shard(path, days, users_json, channels_json_for(channels), compression_level)
+
+    # zlib releases the GIL while compressing, so threads are enough
+    with ThreadPoolExecutor(max(1, jobs)) as executor:
+        return list(executor.map(build, paths, shards))
+
+def shard_index(paths, shards, sizes):
+    """
+    Which shard has which channel and days, for the index file
+    """
+    index = {'shards': [], 'channels': {}}
+    for path, days, size in zip(paths, shards, sizes):
+        file = os.path.basename(path)
+        channels = {}
+        for day in days:
+            channel = channels.setdefault(day.channel, {'first_day': day.day, 'last_day': day.day, 'days': 0})
+            channel['first_day'] = min(channel['first_day'], day.day)
+            channel['last_day'] = max(channel['last_day'], day.day)
+            channel['days'] += 1
+        index['shards'].append({'file': file, 'bytes': size, 'channels': channels})
+        for channel in channels:
+            index['channels'].setdefault(channel, []).append(file)
+    return index
@@ -0,0 +1,185 @@
+"""
+A local stand-in for the Slack API, serving users.list with cursor
+pagination and rate limiting like the real one, so fetching the user
+directory can be tried and timed without a workspace.
+
+The users are the synthetic ones of synthetic_flowdock.py. --changed gives
+that many of them a newer 'updated' time, to see what a refresh writes.
+
+Usage: python slack_api_stub.py --users 50000 --port 8901
+and in config.yml: slack_api_url: http://localhost:8901/api/
+
+python slack_api_stub.py --check fetches the users from the stub with
+slack_users.py and checks that every page is fetched, that rate limits are
+waited out and retried, and that a refresh which fails changes nothing.
+"""
+import argparse
+import base64
+import json
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from synthetic_flowdock import generate_flowdock_users, generate_slack_users
+
+max_limit = 1000
+
+def build_users(count, changed=0, seed=0):
+    users = generate_slack_users(generate_flowdock_users(count, seed), seed=seed)
+    for number, user in enumerate(users):
+        user['updated'] = 1600000000 + (1 if number < changed else 0)
+    return users
+
+def encode_cursor(offset):
+    return base64.b64encode(b'offset:%d' % offset).decode()
+
+def decode_cursor(cursor):
+    return int(base64.b64decode(cursor).split(b':')[1]) if cursor else 0
+
+class SlackApiHandler(BaseHTTPRequestHandler):
+    users = []
+    rate_limit_every = 0
+    requests = 0
+    rate_limited = 0 # requests answered with a 429
+    offsets = [] # the offset of each page sent
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = url.query
+        if self.command == 'POST':
+            # The Slack client posts the arguments as a form
+            query += '&' + self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        params = {name: values[0] for name, values in parse_qs(query).items()}
+        if url.path != '/api/users.list':
+            return self.send_json(200, {'ok': False, 'error': 'unknown_method'})
+
+        SlackApiHandler.requests += 1
+        if self.rate_limit_every and SlackApiHandler.requests % self.rate_limit_every == 0:
+            SlackApiHandler.rate_limited += 1
+            return self.send_json(429, {'ok': False, 'error': 'ratelimited'}, {'Retry-After': '1'})
+
+        offset = decode_cursor(params.get('cursor'))
+        SlackApiHandler.offsets.append(offset)
+        limit = min(int(params.get('limit', 100)), max_limit)
+        members = self.users[offset:offset + limit]
+        next_offset = offset + limit
+        self.send_json(200, {
+            'ok': True,
+            'members': members,
+            'cache_ts': int(time.time()),
+            'response_metadata': {'next_cursor': encode_cursor(next_offset) if next_offset < len(self.users) else ''}
+        })
+
+    do_POST = do_GET
+
+def serve(port):
+    """
+    Start the stub in a background thread. Returns the server, port 0 picks
+    a free one.
+    """
+    server = ThreadingHTTPServer(('localhost', port), SlackApiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def set_users(users, rate_limit_every=0):
+    SlackApiHandler.users = users
+    SlackApiHandler.rate_limit_every = rate_limit_every
+    SlackApiHandler.requests = 0
+    SlackApiHandler.rate_limited = 0
+    SlackApiHandler.offsets = []
+
+def check():
+    """
+    Fetch the users from the stub and check the pagination and retries of
+    slack_users.py
+    """
+    from slack import WebClient
+    from slack.errors import SlackApiError
+    import slack_users
+
+    server = serve(0)
+    client = WebClient(token='token', base_url='http://localhost:%d/api/' % server.server_address[1])
+    directory_dir = tempfile.mkdtemp()
+    directory = slack_users.SlackUserDirectory(directory_dir + '/slack-users.sqlite')
+    try:
+        def refresh():
+            return directory.refresh(slack_users.iter_user_pages(client))
+
+        def assert_users(users):
+            assert [user['id'] for user in directory.users()] == sorted(user['id'] for user in users), \
+                'the directory is not the users of the stub'
+
+        # Every page is fetched by its cursor, rate limits are retried
+        users = build_users(2500)
+        set_users(users, rate_limit_every=2)
+        counts = refresh()
+        assert counts == {'added': len(users), 'changed': 0, 'removed': 0, 'users': len(users)}, counts
+        assert SlackApiHandler.offsets == list(range(0, len(users), max_limit)), SlackApiHandler.offsets
+        assert SlackApiHandler.rate_limited, 'nothing was rate limited'
+        assert_users(users)
+        print('ok: %d pages of users, %d rate limits waited out' % (len(SlackApiHandler.offsets),
+                                                                      SlackApiHandler.rate_limited))
+
+        # A refresh only writes the users which changed
+        users = build_users(2500, changed=10)[:-100]
+        set_users(users)
+        counts = refresh()
+        assert counts == {'added': 0, 'changed': 10, 'removed': 100, 'users': len(users)}, counts
+        assert_users(users)
+        print('ok: a refresh changes 10 users and removes 100')
+
+        # Rate limited too often, the refresh fails and changes nothing
+        max_retries = slack_users.max_retries
+        slack_users.max_retries = 1
+        set_users(build_users(2500), rate_limit_every=1)
+        try:
+            refresh()
+        except SlackApiError:
+            pass
+        else:
+            raise AssertionError('the refresh did not fail')
+        finally:
+            slack_users.max_retries = max_retries
+        assert_users(users)
+        print('ok: a refresh which fails leaves the directory as it was')
+    finally:
+        directory.close()
+        server.shutdown()
+        shutil.rmtree(directory_dir)
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a fake Slack users.list')
+    parser.add_argument('--users', type=int, default=1000, help='Flowdock users to generate Slack users for')
+    parser.add_argument('--changed', type=int, default=0, help='users with a newer updated time')
+    parser.add_argument('--rate-limit-every', type=int, default=0, help='answer every nth request with a 429')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--port', type=int, default=8901)
+    parser.add_argument('--check', action='store_true',
+                        help='check the pagination and retries of slack_users.py against the stub and exit')
+    args = parser.parse_args()
+
+    if args.check:
+        return check()
+
+    set_users(build_users(args.users, args.changed, args.seed), args.rate_limit_every)
+    print('Serving %d Slack users on http://localhost:%d/api/' % (len(SlackApiHandler.users), args.port))
+    ThreadingHTTPServer(('localhost', args.port), SlackApiHandler).serve_forever()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""
+Writes converted messages (slack_message.SlackMessage) into a channel
+directory the same way Slack exports do: one channel/YYYY-MM-DD.json file per
+day.
+
+Messages are written as they are produced so only the current day is kept in
+memory. Thread parents keep changing after they were written (replies update
+reply_count, replies, latest_reply, ...), so when a reply arrives for a parent
+in a day that has already been written we remember the day and rewrite it with
+the final parents from the thread index (see thread_index.py) once the channel
+is closed.
+
+ZipChannelWriter writes the days straight into the part zip of a flow instead.
+Zip entries can't be rewritten, so it adds the changes to the days written
+already to the part as patches, which are applied when the days are copied
+into the export. The messages are converted only once either way.
+"""
+import json
+import os
+import time
+
+from slack_message import json_default
+
+def day_of(ts):
+    # Slack timestamps look like '1585637388.000200'
+    return time.strftime('%Y-%m-%d', time.gmtime(float(ts.split('.')[0])))
+
+def encode_json(contents, indent=None):
+    """
+    contents as UTF-8 JSON. Without an indent the output is as compact as
+    possible.
+    """
+    separators = None if indent else (',', ':')
+    # In one go: json.dump() always runs the pure Python encoder, dumps()
+    # the C one unless there is an indent
+    return json.dumps(contents, indent=indent, separators=separators, default=json_default).encode('utf-8')
+
+def write_file(data, path):
+    # Atomically, so a run that dies doesn't leave half a file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def dump_json_file(contents, path, indent=None):
+    """
+    Write contents to path atomically. Without an indent the output is as
+    compact as possible.
+    """
+    write_file(encode_json(contents, indent), path)
+
+class ChannelWriter:
+    def __init__(self, channel_dir, threads, indent=None):
+        self.channel_dir = channel_dir
+        self.threads = threads # the ThreadIndex the messages are converted with
+        self.indent = indent
+        self.day = None # the day we are currently collecting
+        self.messages = [] # messages of the current day
+        self.written_days = set()
+        self.patch_days = set() # days with parents updated after writing
+        self.late = {} # day -> messages that arrived after their day was written
+        self.message_count = 0
+        self.bytes_written = 0
+
+    def day_file(self, day):
+        return '%s/%s.json' % (self.channel_dir, day)
+
+    def write(self, message, parent=None):
+        """
+        Add a message to the channel. parent is the thread parent that this
+        message updated, if any.
+        """
+        day = day_of(message.ts)
+        if day != self.day:
+            if day in self.written_days:
+                self.late.setdefault(day, []).append(message)
+            else:
+                self.flush()
+                self.day = day
+                self.messages.append(message)
+        else:
+            self.messages.append(message)
+        self.message_count += 1
+
+        if parent is not None:
+            parent_day = day_of(parent.ts)
+            if parent_day in self.written_days:
+                self.patch_days.add(parent_day)
+
+    def flush(self):
+        if self.day is None:
+            return
+        self.save_day(self.day, encode_json(self.messages, self.indent))
+        self.written_days.add(self.day)
+        self.day = None
+        self.messages = []
+
+    def save_day(self, day, data):
+        write_file(data, self.day_file(day))
+        self.bytes_written += len(data)
+
+    def load_day(self, day):
+        with open(self.day_file(day), 'rb') as f:
+            return json.load(f)
+
+    def close(self):
+        """
+        Write the last day and patch the days that changed after they were
+        written. Returns the days written, in order.
+        """
+        self.flush()
+
+        for day in sorted(self.patch_days | set(self.late)):
+            messages = self.load_day(day)
+            if day in self.patch_days:
+                messages = [self.final_parent(m) or m for m in messages]
+            messages.extend(m.to_slack() for m in self.late.get(day, []))
+            messages.sort(key=lambda m: float(m['ts']))
+            self.save_day(day, encode_json(messages, self.indent))
+
+        self.patch_days = set()
+        self.late = {}
+        return sorted(self.written_days)
+
+    def final_parent(self, message):
+        # message is Slack JSON read back from a day file. Thread parents
+        # have their own ts as thread_ts
+        if message.get('thread_ts') == message['ts']:
+            return self.threads.parent_json(message['ts'], message.get('client_msg_id'))
+
+class ZipChannelWriter(ChannelWriter):
+    """
+    Writes a channel into an open zipfile.ZipFile of a part (see runner.py)
+    as channel/YYYY-MM-DD.json, each day as soon as it's complete. Zip
+    entries can't be rewritten, so the changes to the days written already
+    go into channel/YYYY-MM-DD.patch.json when the channel is closed, and
+    apply_patch makes them while the day is copied into the export.
+    """
+    def __init__(self, zip_file, channel_name, threads, indent=None):
+        super().__init__(channel_name, threads, indent) # the channel directory in the zip
+        self.zip_file = zip_file
+        self.patch_parents = {} # day -> ts and client_msg_id of its parents updated after writing
+
+    def write(self, message, parent=None):
+        super().write(message, parent)
+        if parent is not None and day_of(parent.ts) in self.written_days:
+            self.patch_parents.setdefault(day_of(parent.ts), set()).add((parent.ts, parent.client_msg_id))
+
+    def save_day(self, day, data):
+        self.zip_file.writestr(self.day_file(day), data)
+        self.bytes_written += len(data)
+
+    def close(self):
+        self.flush()
+
+        for day in sorted(self.patch_days | set(self.late)):
+            parents = [self.threads.parent_json(ts, client_msg_id)
+                       for ts, client_msg_id in sorted(self.patch_parents.get(day, ()))]
+            patch = encode_json({
+                'indent': self.indent,
+                'parents': [parent for parent in parents if parent],
+                'late': [m.to_slack() for m in self.late.get(day, [])]
+            })
+            self.zip_file.writestr('%s/%s.patch.json' % (self.channel_dir, day), patch)
+            self.bytes_written += len(patch)
+
+        self.patch_days = set()
+        self.patch_parents = {}
+        self.late = {}
+        return sorted(self.written_days)
+
+def apply_patch(data, patch):
+    """
+    The day file data with the patch from ZipChannelWriter applied: its
+    thread parents in their final version and the messages which came late
+    """
+    patch = json.loads(patch)
+    parents = {(m['ts'], m.get('client_msg_id')): m for m in patch['parents']}
+    messages = [parents.get((m['ts'], m.get('client_msg_id')), m) if m.get('thread_ts') == m['ts'] else m
+                for m in json.loads(data)]
+    messages.extend(patch['late'])
+    messages.sort(key=lambda m: float(m['ts']))
+    return encode_json(messages, patch['indent'])
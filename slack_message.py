@@ -0,0 +1,97 @@
+"""
+Compact in-memory form of the Slack messages we build.
+
+A big flow keeps a lot of messages and thread parents around. As plain dicts
+every message had its own user_profile dict and three team fields, and every
+reply was another dict. SlackMessage keeps only the fields that differ per
+message in __slots__, shares one profile dict per user and keeps replies as
+(user, ts) tuples. The Slack export JSON is only built when a message is
+written, see to_slack() and json_default().
+"""
+
+fields = ('text', 'user', 'ts', 'thread_ts', 'parent_user_id', 'client_msg_id', 'profile',
+          'reactions', 'replies', 'reply_users', 'latest_reply')
+
+class SlackMessage:
+    # __weakref__ so thread_index.ThreadIndex can tell which parents are still in use
+    __slots__ = fields + ('__weakref__',)
+
+    def __init__(self, text, user, client_msg_id, profile, reactions=None, ts=None):
+        self.text = text
+        self.user = user
+        self.ts = ts
+        self.thread_ts = None
+        self.parent_user_id = None
+        self.client_msg_id = client_msg_id
+        self.profile = profile # shared by all messages of the user, includes the team
+        self.reactions = reactions # ((name, (user, ...)), ...), None for no reactions field at all
+        self.replies = None # [(user, ts), ...] once this is a thread parent
+        self.reply_users = None
+        self.latest_reply = None
+
+    def copy(self):
+        message = SlackMessage.__new__(SlackMessage)
+        for name in fields:
+            setattr(message, name, getattr(self, name))
+        return message
+
+    def to_slack(self):
+        team = self.profile['team']
+        message = {
+            'type': 'message',
+            'text': self.text,
+            'user': self.user,
+            'client_msg_id': self.client_msg_id,
+            'team': team,
+            'user_team': team,
+            'source_team': team,
+            'user_profile': self.profile
+        }
+        if self.reactions is not None:
+            message['reactions'] = [{'name': name, 'users': list(users), 'count': len(users)}
+                                    for name, users in self.reactions]
+        message['ts'] = self.ts
+        if self.thread_ts is not None:
+            message['thread_ts'] = self.thread_ts
+        if self.parent_user_id is not None:
+            message['parent_user_id'] = self.parent_user_id
+        if self.replies is not None:
+            message['replies'] = [{'user': user, 'ts': ts} for user, ts in self.replies]
+            message['reply_users'] = list(self.reply_users)
+            message['reply_users_count'] = len(self.reply_users)
+            message['reply_count'] = len(self.replies)
+            message['latest_reply'] = self.latest_reply
+            message['last_read'] = self.latest_reply # mark all the imports as read
+            message['subscribed'] = False
+        return message
+
+    @classmethod
+    def from_slack(cls, message, profiles=None):
+        """
+        The opposite of to_slack(), for messages stored as JSON. Pass the same
+        profiles dict for all messages to share their profiles again.
+        """
+        reactions = message.get('reactions')
+        if reactions is not None:
+            reactions = tuple((reaction['name'], tuple(reaction['users'])) for reaction in reactions)
+        profile = message['user_profile']
+        if profiles is not None:
+            profile = intern_profile(profile, profiles)
+
+        sm = cls(message['text'], message['user'], message.get('client_msg_id'), profile, reactions, message['ts'])
+        sm.thread_ts = message.get('thread_ts')
+        sm.parent_user_id = message.get('parent_user_id')
+        if 'replies' in message:
+            sm.replies = [(reply['user'], reply['ts']) for reply in message['replies']]
+            sm.reply_users = message['reply_users']
+            sm.latest_reply = message['latest_reply']
+        return sm
+
+def intern_profile(profile, profiles):
+    return profiles.setdefault(tuple(sorted(profile.items())), profile)
+
+def json_default(o):
+    # default= for json.dump, so lists of messages can be dumped as they are
+    if isinstance(o, SlackMessage):
+        return o.to_slack()
+    raise TypeError('Object of type %s is not JSON serializable' % type(o).__name__)
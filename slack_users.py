@@ -0,0 +1,123 @@
+"""
+The Slack user directory, fetched page by page and kept in SQLite.
+
+users.list returns a page of users and a next_cursor for the rest, a single
+call only gets the first page. iter_user_pages() follows the cursors with
+the biggest pages Slack allows, waits as long as Slack asks when we are rate
+limited, and requests the next page while the current one is stored.
+
+SlackUserDirectory keeps the users in a table indexed by id and email. A
+refresh goes through the whole directory (users.list can't filter), but only
+writes the users whose 'updated' time changed and removes the ones that are
+gone, so a warm directory of 50k users is just read back.
+
+slack_api_stub.py serves a fake users.list to try this without a workspace.
+"""
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from slack.errors import SlackApiError
+
+page_limit = 1000 # the most users.list returns at once
+max_retries = 5
+
+schema = '''
+CREATE TABLE IF NOT EXISTS slack_users (
+    id TEXT PRIMARY KEY, email TEXT, updated INTEGER, user TEXT
+);
+CREATE INDEX IF NOT EXISTS slack_users_email ON slack_users (email);
+
+CREATE TABLE IF NOT EXISTS slack_users_fetched (
+    id INTEGER PRIMARY KEY CHECK (id = 0), fetched REAL
+);
+'''
+
+def request_page(client, cursor=None, limit=page_limit):
+    params = {'limit': limit}
+    if cursor:
+        params['cursor'] = cursor
+    for attempt in range(max_retries + 1):
+        try:
+            return client.users_list(**params)
+        except SlackApiError as e:
+            if e.response.status_code != 429 or attempt == max_retries:
+                raise
+            time.sleep(int(e.response.headers.get('Retry-After', 1)))
+
+def iter_user_pages(client, limit=page_limit):
+    """
+    Yields the members of each page of users.list. The next page is
+    requested in the background while the caller handles this one.
+    """
+    with ThreadPoolExecutor(1) as executor:
+        future = executor.submit(request_page, client, None, limit)
+        while future is not None:
+            response = future.result()
+            cursor = (response.get('response_metadata') or {}).get('next_cursor')
+            future = executor.submit(request_page, client, cursor, limit) if cursor else None
+            yield response['members']
+
+def user_email(user):
+    email = user.get('profile', {}).get('email')
+    return email.lower() if email else None
+
+class SlackUserDirectory:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(schema)
+
+    def close(self):
+        self.db.close()
+
+    def fetched(self):
+        """
+        When the directory was last refreshed, None if it never was
+        """
+        row = self.db.execute('SELECT fetched FROM slack_users_fetched').fetchone()
+        return row[0] if row else None
+
+    def is_fresh(self, ttl=None):
+        fetched = self.fetched()
+        return fetched is not None and (ttl is None or time.time() - fetched <= ttl)
+
+    def refresh(self, pages):
+        """
+        Bring the directory up to date with pages, lists of users as
+        returned by iter_user_pages(). Nothing changes unless all the pages
+        are read. Returns how many users were added, changed and removed.
+        """
+        counts = {'added': 0, 'changed': 0, 'removed': 0, 'users': 0}
+        with self.db:
+            known = dict(self.db.execute('SELECT id, updated FROM slack_users'))
+            seen = set()
+            for users in pages:
+                rows = []
+                for user in users:
+                    seen.add(user['id'])
+                    updated = user.get('updated')
+                    if user['id'] not in known:
+                        counts['added'] += 1
+                    elif known[user['id']] != updated:
+                        counts['changed'] += 1
+                    else:
+                        continue
+                    rows.append((user['id'], user_email(user), updated, json.dumps(user, separators=(',', ':'))))
+                self.db.executemany('INSERT OR REPLACE INTO slack_users VALUES (?, ?, ?, ?)', rows)
+            removed = [(id,) for id in known if id not in seen]
+            self.db.executemany('DELETE FROM slack_users WHERE id = ?', removed)
+            self.db.execute('INSERT OR REPLACE INTO slack_users_fetched VALUES (0, ?)', (time.time(),))
+        counts['removed'] = len(removed)
+        counts['users'] = len(seen)
+        return counts
+
+    def users(self):
+        return [json.loads(row[0]) for row in self.db.execute('SELECT user FROM slack_users ORDER BY id')]
+
+    def find_user(self, id=None, email=None):
+        if id is not None:
+            row = self.db.execute('SELECT user FROM slack_users WHERE id = ?', (id,)).fetchone()
+        else:
+            row = self.db.execute('SELECT user FROM slack_users WHERE email = ?', (email.lower(),)).fetchone()
+        return json.loads(row[0]) if row else None
@@ -0,0 +1,173 @@
+"""
+Optional SQLite store for the data we fetch from Flowdock and Slack, used
+instead of the cache/ files when staging_db is set in config.yml.
+
+The cache keeps each flow as one blob which has to be loaded in full. Here
+every message is a row indexed by flow, id, thread_id and sent time, and
+users by id and email, so the converter can stream one flow, a date window
+or one thread without loading everything:
+
+    store = StagingStore('staging.sqlite')
+    store.add_messages('main', messages)
+    for message in store.iter_messages('main', start=1420070400000):
+        ...
+
+Messages are inserted in batches inside one transaction, so ingesting keeps
+up with the API fetcher. When each kind of data was fetched is recorded so
+callers can apply the same TTLs as the cache.
+"""
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+
+schema = '''
+CREATE TABLE IF NOT EXISTS messages (
+    flow TEXT, id INTEGER, thread_id TEXT, sent INTEGER, message TEXT,
+    PRIMARY KEY (flow, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS messages_thread ON messages (flow, thread_id);
+CREATE INDEX IF NOT EXISTS messages_sent ON messages (flow, sent);
+
+CREATE TABLE IF NOT EXISTS users (
+    source TEXT, id TEXT, email TEXT, user TEXT,
+    PRIMARY KEY (source, id)
+);
+CREATE INDEX IF NOT EXISTS users_email ON users (source, email);
+
+CREATE TABLE IF NOT EXISTS flows (
+    parameterized_name TEXT PRIMARY KEY, name TEXT, flow TEXT
+);
+
+CREATE TABLE IF NOT EXISTS fetched (
+    key TEXT PRIMARY KEY, fetched REAL
+);
+'''
+
+def dumps(value):
+    return json.dumps(value, separators=(',', ':'))
+
+class StagingStore:
+    def __init__(self, path, batch_size=5000):
+        self.path = path
+        self.batch_size = batch_size
+        self.local = threading.local()
+
+    def connection(self):
+        # Worker processes and the threads of the pipeline get their own
+        # connection, sqlite ones can't be shared
+        local = self.local
+        if getattr(local, 'db', None) is None or local.pid != os.getpid():
+            local.db = sqlite3.connect(self.path, timeout=60)
+            local.db.execute('PRAGMA journal_mode = WAL')
+            local.db.execute('PRAGMA synchronous = NORMAL')
+            local.db.executescript(schema)
+            local.pid = os.getpid()
+        return local.db
+
+    def close(self):
+        local = self.local
+        if getattr(local, 'db', None) is not None and local.pid == os.getpid():
+            local.db.close()
+        local.db = None
+
+    # When things were fetched, for the TTLs
+
+    def mark_fetched(self, key):
+        db = self.connection()
+        with db:
+            db.execute('INSERT OR REPLACE INTO fetched VALUES (?, ?)', (key, time.time()))
+
+    def is_fresh(self, key, ttl=None):
+        """
+        True when key was fetched, and not longer than ttl seconds ago
+        """
+        row = self.connection().execute('SELECT fetched FROM fetched WHERE key = ?', (key,)).fetchone()
+        return row is not None and (ttl is None or time.time() - row[0] <= ttl)
+
+    # Messages
+
+    def add_messages(self, flow, messages, replace=False):
+        """
+        Insert (or update) messages of flow, batch_size rows at a time in a
+        single transaction. With replace the flow's old messages are removed.
+        Returns how many messages were added.
+        """
+        db = self.connection()
+        count = 0
+        rows = ((flow, m['id'], m.get('thread_id'), m['sent'], dumps(m)) for m in messages)
+        with db:
+            if replace:
+                db.execute('DELETE FROM messages WHERE flow = ?', (flow,))
+            while True:
+                batch = list(itertools.islice(rows, self.batch_size))
+                if not batch:
+                    break
+                db.executemany('INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)', batch)
+                count += len(batch)
+        return count
+
+    def iter_messages(self, flow, start=None, end=None, thread_id=None, after_id=None):
+        """
+        Yields the messages of flow in id order, optionally only the ones sent
+        in [start, end) (milliseconds, like 'sent'), of one thread, or after
+        the message after_id. Rows are read as they are needed.
+        """
+        query = 'SELECT message FROM messages WHERE flow = ?'
+        params = [flow]
+        for condition, value in (('sent >= ?', start), ('sent < ?', end),
+                                 ('thread_id = ?', thread_id), ('id > ?', after_id)):
+            if value is not None:
+                query += ' AND ' + condition
+                params.append(value)
+        # A cursor of its own, so other queries can run while we iterate
+        cursor = self.connection().execute(query + ' ORDER BY id', params)
+        for row in cursor:
+            yield json.loads(row[0])
+
+    def staged_flows(self):
+        return [row[0] for row in self.connection().execute('SELECT DISTINCT flow FROM messages ORDER BY flow')]
+
+    def count_messages(self, flow):
+        return self.connection().execute('SELECT count(*) FROM messages WHERE flow = ?', (flow,)).fetchone()[0]
+
+    # Users, source is 'flowdock' or 'slack'
+
+    def set_users(self, source, users):
+        db = self.connection()
+        with db:
+            db.execute('DELETE FROM users WHERE source = ?', (source,))
+            db.executemany('INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)',
+                           [(source, str(user['id']), user_email(user), dumps(user)) for user in users])
+
+    def get_users(self, source):
+        return [json.loads(row[0]) for row in self.connection().execute(
+            'SELECT user FROM users WHERE source = ? ORDER BY rowid', (source,))]
+
+    def find_user(self, source, id=None, email=None):
+        if id is not None:
+            row = self.connection().execute('SELECT user FROM users WHERE source = ? AND id = ?',
+                                            (source, str(id))).fetchone()
+        else:
+            row = self.connection().execute('SELECT user FROM users WHERE source = ? AND email = ?',
+                                            (source, email.lower())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    # The flow list
+
+    def set_flows(self, flows):
+        db = self.connection()
+        with db:
+            db.execute('DELETE FROM flows')
+            db.executemany('INSERT OR REPLACE INTO flows VALUES (?, ?, ?)',
+                           [(flow['parameterized_name'], flow['name'], dumps(flow)) for flow in flows])
+
+    def get_flows(self):
+        return [json.loads(row[0]) for row in self.connection().execute('SELECT flow FROM flows ORDER BY rowid')]
+
+def user_email(user):
+    # Flowdock users have the email at the top, Slack users in their profile
+    email = user.get('email') or user.get('profile', {}).get('email')
+    return email.lower() if email else None
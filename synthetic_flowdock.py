@@ -0,0 +1,157 @@
+"""
+Generates synthetic Flowdock data for benchmarks: users, a matching Slack
+user list and flows of any size, written in the same format as the
+input/exports/<flow>/messages.json files from Flowdock exports.
+
+Messages are generated lazily so flows with millions of messages can be
+written without holding them in memory.
+
+Usage: python synthetic_flowdock.py --messages 1000000 --flow synthetic
+"""
+import argparse
+import json
+import os
+import random
+
+words = ('the deploy is done can someone review this PR please build failed again '
+         'lunch anyone? thanks looks good to me merged rolling back prod staging '
+         'customer ticket meeting in 5 minutes ok sounds good').split()
+
+log_line = '2020-03-30T12:00:00.000Z INFO [worker-3] request_id=%08x handled GET /api/v1/campaigns in 42ms status=200\n'
+
+def generate_flowdock_users(count, seed=0):
+    rng = random.Random(seed)
+    users = []
+    for uid in range(1, count + 1):
+        first = rng.choice(['Jane', 'John', 'Alex', 'Kim', 'Sam', 'Maria', 'Peter', 'Anna'])
+        users.append({
+            'id': uid,
+            'email': 'user%d@example.com' % uid,
+            'nick': '%s%d' % (first, uid),
+            'name': '%s Doe%d - Team %d' % (first, uid, uid % 10)
+        })
+    return users
+
+def generate_slack_users(flowdock_users, email_share=0.8, name_share=0.1, seed=0):
+    """
+    Slack users for the given Flowdock users: email_share of them match by
+    email, name_share by name only, the rest don't have a Slack account.
+    """
+    rng = random.Random(seed)
+    slack_users = []
+    for fd_user in flowdock_users:
+        r = rng.random()
+        if r >= email_share + name_share:
+            continue
+        real_name = fd_user['name'].split(' - ')[0]
+        slack_users.append({
+            'id': 'U%08d' % fd_user['id'],
+            'name': fd_user['nick'].lower(),
+            'real_name': real_name,
+            'profile': {
+                'email': fd_user['email'] if r < email_share else 'other%d@example.com' % fd_user['id'],
+                'image_72': 'https://avatars.example.com/%d_72.jpg' % fd_user['id'],
+                'avatar_hash': '%012x' % fd_user['id'],
+                'display_name': fd_user['nick'],
+                'real_name': real_name
+            }
+        })
+    return slack_users
+
+def generate_messages(count, users, flow='synthetic', thread_depth=20, reply_share=0.6,
+                      long_share=0.001, reaction_share=0.05, file_share=0.03, seed=0):
+    """
+    Yields count Flowdock messages in ascending id order.
+
+    thread_depth is the max number of replies in a thread and reply_share how
+    many messages are replies. long_share of the messages are pasted logs
+    longer than the 3900 character Slack split.
+    """
+    rng = random.Random(seed)
+    uids = [str(user['id']) for user in users]
+    nicks = [user['nick'] for user in users]
+    sent = 1420070400000 # 2015-01-01
+    open_threads = [] # [thread_id, replies left]
+
+    for message_id in range(1, count + 1):
+        sent += int(rng.expovariate(1 / 60000)) + 1 # about one message a minute
+
+        if open_threads and rng.random() < reply_share:
+            thread = rng.choice(open_threads[-50:])
+            thread[1] -= 1
+            if thread[1] <= 0:
+                open_threads.remove(thread)
+            thread_id = thread[0]
+        else:
+            thread_id = 't%d' % message_id
+            open_threads.append([thread_id, rng.randint(1, thread_depth)])
+            if len(open_threads) > 1000:
+                del open_threads[0]
+
+        r = rng.random()
+        if r < file_share:
+            event = 'file'
+            content = {'file_name': 'screenshot-%d.png' % message_id, 'path': '/files/%d' % message_id}
+        elif r < file_share + long_share:
+            event = 'message'
+            content = ''.join(log_line % rng.getrandbits(32) for _ in range(rng.randint(40, 400)))
+        else:
+            event = 'message' if rng.random() < 0.95 else 'comment'
+            content = ' '.join(rng.choice(words) for _ in range(rng.randint(1, 30)))
+            if rng.random() < 0.1:
+                content = '@%s %s' % (rng.choice(nicks), content)
+
+        reactions = {}
+        if rng.random() < reaction_share:
+            for emoji in rng.sample([':+1:', ':tada:', ':eyes:', ':smile:'], rng.randint(1, 2)):
+                reactions[emoji] = rng.sample(uids, min(len(uids), rng.randint(1, 3)))
+
+        yield {
+            'id': message_id,
+            'app': 'chat',
+            'event': event,
+            'content': content,
+            'sent': sent,
+            'user': rng.choice(uids),
+            'flow': flow,
+            'tags': [],
+            'thread_id': thread_id,
+            'emojiReactions': reactions
+        }
+
+def write_json_array(items, path):
+    # Like json.dump for a list, without needing the list
+    with open(path, 'w') as f:
+        f.write('[')
+        for count, item in enumerate(items):
+            if count:
+                f.write(',\n')
+            json.dump(item, f)
+        f.write(']\n')
+
+def write_export(path, messages):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_json_array(messages, path)
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic Flowdock export')
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--flow', default='synthetic')
+    parser.add_argument('--thread-depth', type=int, default=20)
+    parser.add_argument('--long-share', type=float, default=0.001)
+    parser.add_argument('--reaction-share', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='input/exports',
+                        help='writes <output>/<flow>/messages.json (default: input/exports)')
+    args = parser.parse_args()
+
+    users = generate_flowdock_users(args.users, args.seed)
+    messages = generate_messages(args.messages, users, args.flow, args.thread_depth,
+                                 long_share=args.long_share, reaction_share=args.reaction_share, seed=args.seed)
+    write_export('%s/%s/messages.json' % (args.output, args.flow), messages)
+    write_json_array(users, '%s/%s/users.json' % (args.output, args.flow))
+    write_json_array(generate_slack_users(users, seed=args.seed), '%s/%s/slack-users.json' % (args.output, args.flow))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+import random
+
+from text_transform import fence, split_text
+
+def assert_balanced(parts, max_length):
+    for part in parts:
+        assert len(part) <= max_length, part
+        assert part.count(fence) % 2 == 0, parts
+
+def test_split_text_keeps_code_blocks_closed():
+    text = 'intro\n```\n' + 'x = 1\n' * 200 + '```\noutro'
+    parts = list(split_text(text, 100))
+    assert len(parts) > 1
+    assert_balanced(parts, 100)
+    assert parts[1].startswith(fence + '\n')
+
+def test_split_text_adjacent_fences():
+    text = ('``` ```xyzxyzxyz``````' + 'y' * 30 + '```\n') * 20
+    for max_length in range(20, 80):
+        assert_balanced(list(split_text(text, max_length)), max_length)
+
+def test_split_text_long_backtick_runs():
+    rng = random.Random(0)
+    pieces = ['`', '``', '```', '````', '``````', '`' * 40, ' ', '\n', 'xyz', '<a|b>', '&amp;']
+    for _ in range(2000):
+        text = ''.join(rng.choice(pieces) for _ in range(rng.randint(1, 60)))
+        if text.count(fence) % 2:
+            text += '\n' + fence
+        max_length = rng.randint(14, 200)
+        assert_balanced(list(split_text(text, max_length)), max_length)
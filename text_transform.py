@@ -0,0 +1,152 @@
+"""
+Rewrites the text of Flowdock messages into Slack markup in a single pass.
+
+ - @nick becomes <@U12345> when we know the Slack user of that Flowdock nick,
+   @team / @everyone / @all become <!channel>
+ - :emoji: names are renamed when Flowdock and Slack call them differently
+ - &, < and > are escaped the way Slack expects
+ - nothing but escaping happens inside `code` and ```code blocks```
+
+Hashtags don't need any markup in Slack, so they are left as they are.
+
+All of this is one precompiled regex with a branch per kind of token, so each
+message is scanned once however many rules there are.
+"""
+import re
+
+broadcast_mentions = {'team', 'everyone', 'all'}
+
+escapes = {'&': '&amp;', '<': '&lt;', '>': '&gt;'}
+
+code_pattern = r'(?P<code>```.*?```|`[^`\n]*`)'
+mention_pattern = r'(?<![\w@.])@(?P<mention>\w+)'
+emoji_pattern = r':(?P<emoji>[\w+-]+):'
+escape_pattern = r'(?P<escape>[&<>])'
+
+def escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def message_text(fm):
+    """
+    The text of a message or comment event, None for everything else
+    (files, actions, ...) whose content isn't text
+    """
+    if fm['event'] == 'message':
+        return str(fm['content'])
+    if fm['event'] == 'comment':
+        # Comments on files and inbox items have the text in a dict
+        content = fm['content']
+        return content.get('text', '') if isinstance(content, dict) else str(content)
+    return None
+
+def build_mentions(fd_uid_to_slack_user_map, fd_users_index):
+    """
+    Flowdock nick (lower case) -> Slack user id, for the users we could match
+    """
+    mentions = {}
+    for fd_uid, slack_user in fd_uid_to_slack_user_map.items():
+        fd_user = fd_users_index.get(fd_uid)
+        if fd_user and fd_user.get('nick'):
+            mentions[fd_user['nick'].lower()] = slack_user['id']
+    return mentions
+
+class TextTransformer:
+    def __init__(self, mentions, emoji_aliases=None):
+        self.mentions = mentions
+        self.emoji_aliases = emoji_aliases or {}
+
+        branches = [code_pattern, mention_pattern]
+        if self.emoji_aliases:
+            # Without aliases every :emoji: stays the same, so don't look for them
+            branches.append(emoji_pattern)
+        branches.append(escape_pattern)
+        self.pattern = re.compile('|'.join(branches), re.DOTALL)
+
+    def transform(self, text):
+        return self.pattern.sub(self.replace, text)
+
+    def replace(self, match):
+        kind = match.lastgroup
+        if kind == 'escape':
+            return escapes[match.group('escape')]
+        if kind == 'mention':
+            nick = match.group('mention')
+            slack_id = self.mentions.get(nick.lower())
+            if slack_id:
+                return '<@%s>' % slack_id
+            if nick.lower() in broadcast_mentions:
+                return '<!channel>'
+            return match.group(0)
+        if kind == 'emoji':
+            name = match.group('emoji')
+            return ':%s:' % self.emoji_aliases.get(name, name)
+        return escape(match.group('code'))
+
+fence = '```'
+backtick_runs = re.compile('`+')
+
+def split_text(text, max_length):
+    """
+    Yields text in parts of at most max_length characters, for messages which
+    are too long for Slack. Parts end at a newline when there is one in the
+    second half of the part, otherwise at a space, otherwise anywhere that
+    doesn't cut a <link>, an &entity; or a run of backticks in two. A code
+    block that is split is closed at the end of the part and opened again at
+    the start of the next one.
+
+    Each part takes one bounded scan of the text, so splitting is linear in
+    the length of the text and parts are only made as they are needed.
+    """
+    # Room for closing and reopening a fence
+    budget = max_length - 2 * (len(fence) + 1)
+    if budget < len(fence):
+        raise ValueError('max_length %d is too small to split with' % max_length)
+    start = 0
+    in_fence = False
+    while len(text) - start > max_length - (len(fence) + 1 if in_fence else 0):
+        end = start + budget
+        half = start + budget // 2
+        cut = text.rfind('\n', half, end)
+        if cut < 0:
+            cut = max(text.rfind(' ', half, end), text.rfind('\t', half, end))
+        skip = 1 # drop the newline or space we split at
+        if cut < 0:
+            cut = end
+            skip = 0
+        cut = safe_cut(text, start, half, cut)
+        if cut != end and text[cut] not in '\n \t':
+            skip = 0
+
+        ends_in_fence = in_fence ^ (fence_count(text, start, cut) % 2 == 1)
+        yield (fence + '\n' if in_fence else '') + text[start:cut] + ('\n' + fence if ends_in_fence else '')
+        in_fence = ends_in_fence
+        start = cut + skip
+    yield (fence + '\n' if in_fence else '') + text[start:]
+
+def fence_count(text, start, end):
+    """
+    The number of fences in text[start:end], each run of backticks has one
+    for every three backticks in it
+    """
+    return sum(len(run.group()) // len(fence) for run in backtick_runs.finditer(text, start, end))
+
+def safe_cut(text, start, low, cut):
+    """
+    Move cut back so it isn't inside a <link>, an &entity; or a run of
+    backticks, as long as it stays after low. A run of backticks that
+    starts before low is cut after a whole number of fences instead.
+    """
+    link = text.rfind('<', low, cut)
+    if link > text.rfind('>', low, cut):
+        cut = link
+    entity = text.rfind('&', max(low, cut - 8), cut)
+    if entity >= 0 and text.find(';', entity, cut) < 0:
+        cut = entity
+    if text[cut - 1:cut + 1] != '``':
+        return cut
+    run = cut - 1
+    while run > start and text[run - 1] == '`':
+        run -= 1
+    if run > low or (run > start and cut - run < len(fence)):
+        return run
+    return run + max((cut - run) // len(fence), 1) * len(fence)
@@ -0,0 +1,117 @@
+"""
+Thread parents of a flow, kept in SQLite instead of in memory.
+
+iter_fd_messages_to_slack needs the parent of every thread that may still get
+replies, and the writers need the final version of each parent (replies,
+reply_users, latest_reply) when they write the day it is in. For flows with
+millions of threads that doesn't fit in memory, so ThreadIndex keeps the
+recently used parents in an LRU cache and the rest in a SQLite table, stored
+as Slack JSON and indexed by their ts and client_msg_id.
+
+A ThreadIndex can be used like the thread_mapping dict (thread_id -> parent).
+Parents handed out are updated in place, the same object is returned for a
+thread as long as anyone still holds it, and changes are written back when a
+parent leaves the cache.
+"""
+import collections
+import json
+import sqlite3
+import weakref
+
+from slack_message import SlackMessage
+
+class ThreadIndex:
+    def __init__(self, path='', cache_size=100000):
+        """
+        path is the SQLite database, the default '' is a temporary database
+        which is removed when it is closed
+        """
+        self.path = path
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict() # thread_id -> parent, least recently used first
+        self.live = weakref.WeakValueDictionary() # thread_id -> parent that left the cache but is still used
+        self.profiles = {} # shared user profiles of the parents we load
+        self.touched_old = {} # thread_ids from an earlier run which got replies, in order
+
+        self.db = sqlite3.connect(path)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS threads (
+            thread_id TEXT PRIMARY KEY, ts TEXT, client_msg_id TEXT, old INTEGER, parent TEXT)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS threads_message ON threads (ts, client_msg_id)')
+        # Everything already stored is from an earlier run
+        self.db.execute('UPDATE threads SET old = 1')
+        self.db.commit()
+        # Most lookups are for new threads, don't ask the database while it is empty
+        self.stored = self.db.execute('SELECT 1 FROM threads LIMIT 1').fetchone() is not None
+
+    def get(self, thread_id, default=None):
+        thread_id = str(thread_id)
+        parent = self.cache.get(thread_id)
+        if parent is not None:
+            self.cache.move_to_end(thread_id)
+            return parent
+
+        parent = self.live.get(thread_id)
+        if parent is None:
+            if not self.stored:
+                return default
+            row = self.db.execute('SELECT parent, old FROM threads WHERE thread_id = ?', (thread_id,)).fetchone()
+            if row is None:
+                return default
+            parent = SlackMessage.from_slack(json.loads(row[0]), self.profiles)
+            if row[1]:
+                self.touched_old[thread_id] = True
+        self.add(thread_id, parent)
+        return parent
+
+    def __setitem__(self, thread_id, parent):
+        self.add(str(thread_id), parent)
+
+    def add(self, thread_id, parent):
+        self.cache[thread_id] = parent
+        if len(self.cache) > self.cache_size:
+            evicted = [self.cache.popitem(last=False) for _ in range(len(self.cache) // 10)]
+            self.store(evicted)
+            self.live.update(evicted)
+
+    def store(self, items):
+        self.db.executemany('''INSERT INTO threads (thread_id, ts, client_msg_id, old, parent) VALUES (?, ?, ?, 0, ?)
+            ON CONFLICT (thread_id) DO UPDATE SET ts = excluded.ts, client_msg_id = excluded.client_msg_id,
+            parent = excluded.parent''',
+            [(thread_id, parent.ts, parent.client_msg_id, json.dumps(parent.to_slack(), separators=(',', ':')))
+             for thread_id, parent in items])
+        self.stored = True
+
+    def flush(self):
+        """
+        Write every cached parent to the database. The parents stay live, so
+        updating them later is still fine.
+        """
+        self.store(self.cache.items())
+        self.live.update(self.cache)
+        self.cache.clear()
+        self.db.commit()
+
+    def __len__(self):
+        self.flush()
+        return self.db.execute('SELECT count(*) FROM threads').fetchone()[0]
+
+    def parent_json(self, ts, client_msg_id):
+        """
+        The stored Slack JSON of the thread parent with this ts and
+        client_msg_id, or None if that message isn't a thread parent.
+        Call this once all replies are in.
+        """
+        if self.cache:
+            self.flush()
+        row = self.db.execute('SELECT parent FROM threads WHERE ts = ? AND client_msg_id = ?',
+                              (ts, client_msg_id)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def touched_old_parents(self):
+        # The parents from an earlier run which got new replies in this one
+        for thread_id in list(self.touched_old):
+            yield self.get(thread_id)
+
+    def close(self):
+        self.flush()
+        self.db.close()
@@ -0,0 +1,81 @@
+"""
+Match Flowdock users to Slack users.
+
+Each matcher is a rule name plus a function that extracts a key from a Slack
+user and one that extracts a key from a Flowdock user. We build a dict index
+of the Slack users per matcher, then try the matchers in order for every
+Flowdock user, so matching is linear in the number of users.
+"""
+
+def normalize_email(email):
+    return email.strip().lower() if email else None
+
+def normalize_name(name):
+    # Collapse whitespace and ignore case: 'Jane  Doe' matches 'jane doe'
+    return ' '.join(name.split()).casefold() if name else None
+
+def flowdock_real_name(fd_user):
+    # Flowdock names often look like 'Jane Doe - Team Foo'
+    return fd_user.get('name', '').split(' - ')[0]
+
+def slack_real_name(slack_user):
+    return slack_user.get('real_name') or slack_user['profile'].get('real_name')
+
+# (rule, slack key, flowdock key) tried in this order
+default_matchers = [
+    ('email',
+     lambda slack_user: normalize_email(slack_user['profile'].get('email')),
+     lambda fd_user: normalize_email(fd_user.get('email'))),
+    ('name',
+     lambda slack_user: normalize_name(slack_real_name(slack_user)),
+     lambda fd_user: normalize_name(flowdock_real_name(fd_user))),
+    ('display_name',
+     lambda slack_user: normalize_name(slack_user['profile'].get('display_name')),
+     lambda fd_user: normalize_name(fd_user.get('nick'))),
+]
+
+def build_index(slack_users, slack_key):
+    index = {}
+    for slack_user in slack_users:
+        key = slack_key(slack_user)
+        if key:
+            # Like the old nested loop, the first Slack user with a key wins
+            index.setdefault(key, slack_user)
+    return index
+
+def match_flowdock_users(flowdock_users, slack_users, matchers=default_matchers):
+    """
+    Returns a dict where the key is a flowdock uid (as a string, like in the
+    messages) and the value is a (slack_user, rule) tuple. Unmatched users
+    are left out.
+    """
+    indexes = [(rule, build_index(slack_users, slack_key), fd_key)
+               for rule, slack_key, fd_key in matchers]
+
+    matches = {}
+    for fd_user in flowdock_users:
+        for rule, index, fd_key in indexes:
+            key = fd_key(fd_user)
+            slack_user = index.get(key) if key else None
+            if slack_user:
+                matches[str(fd_user['id'])] = (slack_user, rule)
+                break
+    return matches
+
+def match_report(flowdock_users, matches):
+    """
+    A list describing how each Flowdock user was matched, rule is None for
+    users without a match.
+    """
+    report = []
+    for fd_user in flowdock_users:
+        slack_user, rule = matches.get(str(fd_user['id']), (None, None))
+        report.append({
+            'flowdock_id': str(fd_user['id']),
+            'email': fd_user.get('email'),
+            'nick': fd_user.get('nick'),
+            'name': fd_user.get('name'),
+            'slack_id': slack_user['id'] if slack_user else None,
+            'rule': rule
+        })
+    return report